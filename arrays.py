@@ -0,0 +1,64 @@
+# Storage behind .lang array values. Elements are kept unboxed in a numpy
+# array when numpy is installed and in an array.array otherwise, the rest of
+# the compiler only goes through the functions here.
+import array
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+INT = 'int'
+FLOAT = 'float'
+
+_TYPECODES = {INT: 'i', FLOAT: 'd'}
+if numpy is not None:
+    _DTYPES = {INT: numpy.int32, FLOAT: numpy.float64}
+
+
+def new(kind, values):
+    if numpy is not None:
+        return numpy.array(values, dtype=_DTYPES[kind])
+    return array.array(_TYPECODES[kind], values)
+
+
+def zeros(kind, n):
+    if numpy is not None:
+        return numpy.zeros(n, dtype=_DTYPES[kind])
+    return array.array(_TYPECODES[kind], bytes(n * array.array(_TYPECODES[kind]).itemsize))
+
+
+def copy(buf):
+    if numpy is not None:
+        return buf.copy()
+    return array.array(buf.typecode, buf)
+
+
+def get(buf, i):
+    # a plain python int or float
+    return buf[i].item() if numpy is not None else buf[i]
+
+
+def put(buf, i, value):
+    buf[i] = value
+
+
+def to_list(buf):
+    return buf.tolist()
+
+
+def apply(name, fn, kind, *operands):
+    # an element wise operation over buffers of one length, scalar operands
+    # are broadcast. name is the numpy ufunc, fn the same operation on python
+    # values for when numpy is missing.
+    if numpy is not None:
+        return getattr(numpy, name)(*operands).astype(_DTYPES[kind], copy=False)
+    columns = [op if isinstance(op, array.array) else itertools.repeat(op) for op in operands]
+    return new(kind, [fn(*values) for values in zip(*columns)])
+
+
+def any_zero(buf):
+    if numpy is not None:
+        return not buf.all()
+    return not all(buf)
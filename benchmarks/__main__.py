@@ -0,0 +1,65 @@
+import argparse
+import sys
+
+from benchmarks.programs import SHAPES
+from benchmarks import runner
+
+
+def _print_scaling(report):
+    print('\nscaling (time ~ size^k):')
+    for shape, backend, phase, exponent, superlinear in runner.scaling(report):
+        flag = '  <-- superlinear' if superlinear else ''
+        print('{:<16} {:<8} {:<12} k={:.2f}{}'.format(shape, backend, phase, exponent, flag))
+
+
+def _cmd_run(args):
+    report = runner.run_benchmarks(shapes=args.shapes,
+                                   sizes=args.sizes,
+                                   backends=args.backends,
+                                   repeat=args.repeat,
+                                   log=print)
+    runner.save(report, args.out)
+    _print_scaling(report)
+    print('\nwrote ' + args.out)
+
+
+def _cmd_compare(args):
+    old = runner.load(args.old)
+    new = runner.load(args.new)
+    print('{} -> {}'.format(old['meta'].get('revision'), new['meta'].get('revision')))
+    regressions = 0
+    for shape, backend, phase, size, old_t, new_t, ratio, slower in \
+            runner.compare(old, new, args.threshold):
+        flag = '  <-- regression' if slower else ''
+        regressions += slower
+        print('{:<16} {:<8} {:<12} {:>6} {:.4f} -> {:.4f} x{:.2f}{}'.format(
+            shape, backend, phase, size, old_t, new_t, ratio, flag))
+    _print_scaling(new)
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python3 -m benchmarks')
+    sub = parser.add_subparsers(dest='cmd')
+    sub.required = True
+
+    run = sub.add_parser('run', help='time generated programs and store the results as JSON')
+    run.add_argument('--shapes', nargs='+', choices=sorted(SHAPES), default=None)
+    run.add_argument('--sizes', nargs='+', type=int, default=list(runner.DEFAULT_SIZES))
+    run.add_argument('--backends', nargs='+', choices=runner.BACKENDS, default=list(runner.BACKENDS))
+    run.add_argument('--repeat', type=int, default=1)
+    run.add_argument('--out', default='bench_output.json')
+    run.set_defaults(func=_cmd_run)
+
+    cmp = sub.add_parser('compare', help='compare two result files')
+    cmp.add_argument('old')
+    cmp.add_argument('new')
+    cmp.add_argument('--threshold', type=float, default=1.2)
+    cmp.set_defaults(func=_cmd_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
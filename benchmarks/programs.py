@@ -0,0 +1,115 @@
+# Generators for .lang benchmark programs. Every generator takes a size and
+# returns source text whose amount of work grows linearly with that size, so
+# any superlinear growth in the measured phases points at the compiler.
+
+
+def _main(body_lns, indent=1):
+    lns = ['fn main:int() {']
+    lns += ['    ' * indent + ln for ln in body_lns]
+    lns += ['    return 0;', '}']
+    return lns
+
+
+def deep_nesting(size):
+    body = ['x:int = 0;']
+    for depth in range(size):
+        pad = '    ' * depth
+        if depth % 2 == 0:
+            body.append(pad + 'if x > -1 {')
+        else:
+            body.append(pad + 'c{}:int = 1;'.format(depth))
+            body.append(pad + 'while c{} {{'.format(depth))
+            body.append(pad + '    c{} = 0;'.format(depth))
+        body.append(pad + '    x = x + 1;')
+
+    # close innermost first, keeping each if's else attached to it
+    tail = []
+    for depth in reversed(range(size)):
+        pad = '    ' * depth
+        if depth % 2 == 0:
+            tail += [pad + '} else {', pad + '    x = x - 1;', pad + '}']
+        else:
+            tail.append(pad + '}')
+    return '\n'.join(_main(body + tail))
+
+
+def long_function(size):
+    body = ['v0:int = 1;']
+    for i in range(1, size):
+        body.append('v{}:int = v{} * 3 + {};'.format(i, i - 1, i))
+    return '\n'.join(_main(body))
+
+
+def many_functions(size):
+    lns = []
+    for i in range(size):
+        lns += [
+            'fn f{}:int(a:int, b:int) {{'.format(i),
+            '    c:int = a * 2 + b;',
+            '    return c - {};'.format(i),
+            '}',
+            '',
+        ]
+    body = ['total:int = 0;']
+    for i in range(size):
+        body.append('total = total + f{}({}, total);'.format(i, i))
+    return '\n'.join(lns + _main(body))
+
+
+def loop_heavy(size):
+    body = [
+        'i:int = 0;',
+        'acc:int = 0;',
+        'while i < {} {{'.format(size * 25),
+        '    acc = acc + i * 3 - acc / 7;',
+        '    i = i + 1;',
+        '}',
+    ]
+    return '\n'.join(_main(body))
+
+
+def mixin_heavy(size):
+    lns = [
+        'fn gen:string(s:string) {',
+        '    return s + " * 2 + 1";',
+        '}',
+        '',
+    ]
+    body = []
+    for i in range(size):
+        if i % 2:
+            body.append('v{}:int = mixin(gen("{}"));'.format(i, i))
+        else:
+            body.append('mixin("v{}:int = {}");'.format(i, i))
+    return '\n'.join(lns + _main(body))
+
+
+def class_heavy(size):
+    lns = []
+    for i in range(size):
+        lns += [
+            'class C{} {{'.format(i),
+            '    a:int = {};'.format(i),
+            '    b:int;',
+            '    c:int = {};'.format(i * 2),
+            '}',
+            '',
+        ]
+    body = []
+    for i in range(size):
+        body.append('o{}:C{} = C{}();'.format(i, i, i))
+    return '\n'.join(lns + _main(body))
+
+
+SHAPES = {
+    'deep_nesting': deep_nesting,
+    'long_function': long_function,
+    'many_functions': many_functions,
+    'loop_heavy': loop_heavy,
+    'mixin_heavy': mixin_heavy,
+    'class_heavy': class_heavy,
+}
+
+
+def gen_program(shape, size):
+    return SHAPES[shape](size)
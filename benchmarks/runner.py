@@ -0,0 +1,164 @@
+import io
+import json
+import math
+import multiprocessing
+import platform
+import subprocess
+import sys
+import time
+
+from benchmarks.programs import SHAPES, gen_program
+
+BACKENDS = ('run', 'compile')
+DEFAULT_SIZES = (10, 20, 40, 80)
+
+# a phase whose time grows faster than size**SUPERLINEAR_EXPONENT is reported
+SUPERLINEAR_EXPONENT = 1.3
+
+
+def _measure(shape, size, backend):
+    # imported here so every measurement gets a fresh interpreter, the
+    # compiler still keeps global state between files (see typeSystem)
+    from compiler import Compiler
+
+    src = gen_program(shape, size)
+    fname = '{}_{}.lang'.format(shape, size)
+    compiler = Compiler()
+    result = {'shape': shape, 'size': size, 'backend': backend,
+              'phases': {}, 'error': None}
+
+    start = time.perf_counter()
+    sys.stdout = io.StringIO()
+    try:
+        if backend == 'run':
+            compiler.run_file(fname, src)
+        else:
+            compiler.compile_file(fname, src)
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    finally:
+        sys.stdout = sys.__stdout__
+    result['phases'] = dict(compiler.phase_times)
+    result['phases']['total'] = time.perf_counter() - start
+
+    # run_file and compile_file report errors in the program rather than raise
+    if result['error'] is None and compiler.error is not None:
+        result['error'] = '{}: {}'.format(type(compiler.error).__name__, compiler.error)
+    return result
+
+
+def measure(shape, size, backend, repeat=1):
+    mp_ctx = multiprocessing.get_context('spawn')
+    best = None
+    for _ in range(repeat):
+        with mp_ctx.Pool(1) as pool:
+            result = pool.apply(_measure, (shape, size, backend))
+        if best is None:
+            best = result
+            continue
+        for phase, t in result['phases'].items():
+            best['phases'][phase] = min(best['phases'].get(phase, t), t)
+    return best
+
+
+def _revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True)
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def run_benchmarks(shapes=None, sizes=DEFAULT_SIZES, backends=BACKENDS, repeat=1, log=None):
+    shapes = shapes or list(SHAPES)
+    results = []
+    for shape in shapes:
+        for backend in backends:
+            for size in sizes:
+                result = measure(shape, size, backend, repeat)
+                results.append(result)
+                if log:
+                    log(_format_result(result))
+    return {
+        'meta': {
+            'revision': _revision(),
+            'python': platform.python_version(),
+            'timestamp': time.time(),
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def _format_result(result):
+    head = '{:<16} {:<8} {:>6}'.format(result['shape'], result['backend'], result['size'])
+    if result['error']:
+        return head + '  error: ' + result['error']
+    phases = ('{}={:.4f}'.format(k, v) for k, v in sorted(result['phases'].items()))
+    return head + '  ' + ' '.join(phases)
+
+
+def save(report, fname):
+    with open(fname, 'w') as out:
+        json.dump(report, out, indent=2, sort_keys=True)
+
+
+def load(fname):
+    with open(fname) as src:
+        return json.load(src)
+
+
+def _series(report):
+    # (shape, backend, phase) -> [(size, seconds)]
+    series = {}
+    for result in report['results']:
+        if result['error']:
+            continue
+        for phase, t in result['phases'].items():
+            key = (result['shape'], result['backend'], phase)
+            series.setdefault(key, []).append((result['size'], t))
+    return series
+
+
+def _growth_exponent(points):
+    # least squares slope of log(time) against log(size)
+    points = [(math.log(n), math.log(t)) for n, t in points if n > 0 and t > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    if not var:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+
+def scaling(report, min_time=1e-3):
+    rows = []
+    for key, points in sorted(_series(report).items()):
+        # tiny phases are all noise, their slope means nothing
+        if max(t for _, t in points) < min_time:
+            continue
+        exponent = _growth_exponent(points)
+        if exponent is not None:
+            rows.append(key + (exponent, exponent > SUPERLINEAR_EXPONENT))
+    return rows
+
+
+def compare(old_report, new_report, threshold=1.2, min_time=1e-3):
+    old = {}
+    for key, points in _series(old_report).items():
+        for size, t in points:
+            old[key + (size,)] = t
+
+    rows = []
+    for key, points in sorted(_series(new_report).items()):
+        for size, t in points:
+            old_t = old.get(key + (size,))
+            if old_t is None or max(old_t, t) < min_time:
+                continue
+            ratio = t / old_t if old_t else float('inf')
+            rows.append(key + (size, old_t, t, ratio, ratio > threshold))
+    return rows
@@ -17,6 +17,16 @@ class CallStack:
 	def _pop(self):
 		self._stack.pop()
 
+	def push_func(self, func):
+		self._stack.append(func)
+
+	def pop(self):
+		self._stack.pop()
+
+	@property
+	def depth(self):
+		return len(self._stack)
+
 	def peek(self):
 		return self._stack[-1]
 
@@ -1,12 +1,18 @@
 import subprocess
 import os
+from diagnostics import Diagnostics, ERROR, INFO
 
-def compile_cpp(code, exe_fname='build/a.out', src_fname='build/tmp.cpp', run=True):
+def compile_cpp(code, exe_fname='build/a.out', src_fname='build/tmp.cpp', run=True, diag=None):
+	diag = diag or Diagnostics()
 	subprocess.run(['mkdir', '-p', 'build'])
 	with open(src_fname, 'w') as src_file:
 		src_file.write('\n'.join(code))
-	error = subprocess.run(['g++', src_fname, '-o', exe_fname]).returncode
-	if not error:
+	completedProcess = subprocess.run(['g++', src_fname, '-o', exe_fname], universal_newlines=True,
+									  stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	error = completedProcess.returncode
+	if error:
+		diag.log(ERROR, completedProcess.stdout)
+	elif run:
 		completedProcess = subprocess.run([exe_fname], universal_newlines=True, stdout=subprocess.PIPE)
 		print(completedProcess.stdout)
-	print('rtn:', error)
+	diag.log(INFO, 'rtn: {}', error)
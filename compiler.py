@@ -1,30 +1,86 @@
 #! /usr/bin/python3
 
+import multiprocessing
+import pickle
 import subprocess
 import sys
+import time
 import unittest
+import ropes
 from compile_cpp import compile_cpp
 from position import Position
-from exceptions import LarkErrorWithPos
+from exceptions import ArgumentCountMismatch, IllegalOperation, LarkErrorWithPos, TypeMismatchException
 from instruction_tree_compiler import InstrnTreeCompiler
-from instruction_tree_runner import InstrnTreeRunner
+from instruction_tree_runner import InstrnTreeRunner, DEFAULT_MAX_CALL_DEPTH
 from call_stack import CallStack
 from instruction_tree_visitor import  InstrnTreePrinter
-from context import Context, ScopeTreePrinter
+from context import VALUE, Context, ScopeTreePrinter
 from lark import Lark
 from lark.exceptions import LarkError, UnexpectedEOF, UnexpectedInput
 from virtual_machine import VirtualMachine
+from type_system import Ref, Void, typeSystem
+from typed_data import RValue
+from instructions import Call, Func
 from instruction_generator import InstructionGenerator
+from diagnostics import Diagnostics, DEBUG, ERROR, INFO
 
 from scope_maker import ScopeMaker
+from purity import PurityAnalysis
+from inliner import Inliner
+from ir import Lowering
+from optimizer import Optimizer
+from dead_code import DeadCode
 
 # TODO cmd line arg, propagate thru program..
 TAB_SIZE = 4
 
+# the calls handed to a worker process at a time by call_many
+BATCH_CHUNK_SIZE = 64
+
+_BATCH_POS = Position('batch', 0, 0, 0, 0)
+
 # FIXME something is holding on to state somehow
 
+
+class _PhaseTimer:
+    def __init__(self, times, name):
+        self._times = times
+        self._name = name
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        elapsed = time.perf_counter() - self._start
+        self._times[self._name] = self._times.get(self._name, 0.0) + elapsed
+
+
+def _dump_tree(instrn_tree):
+    return lambda out: InstrnTreePrinter(out).start(instrn_tree)
+
+def _dump_scopes(scope):
+    return lambda out: ScopeTreePrinter(out).visit(scope)
+
+
 class Compiler:
-    def __init__(self):
+    def __init__(self, diag=None, max_call_depth=DEFAULT_MAX_CALL_DEPTH, inline=True, inline_profile=None,
+                 count_calls=False, prune=True, optimize=True, lower=True):
+        self.diag = diag or Diagnostics()
+        self.max_call_depth = max_call_depth
+        # calls to small functions are replaced by their bodies. inline_profile
+        # is the call_counts of an earlier run, to inline by how hot calls are.
+        self.inline = inline
+        self.inline_profile = inline_profile
+        self.count_calls = count_calls
+        # code nothing reaches is left out of the C++
+        self.prune = prune
+        # loop invariants are hoisted and common subexpressions shared
+        self.optimize = optimize
+        # arithmetic is lowered to the typed register code of ir.py
+        self.lower = lower
+        # name -> python implementation of a function written in foreign code
+        self.foreign_impls = {}
         self._reset()
         self.parser = Lark.open('syntax.lark', propagate_positions=True)
         self.exprn_parser = Lark.open('syntax.lark', parser='lalr', propagate_positions=True, start='exprn')
@@ -33,14 +89,43 @@ class Compiler:
 
 
 
-    def _reset(self):
-        self.context = Context()
+    def register_foreign(self, func_sym, impl):
+        # impl stands in for the foreign code of func_sym when running, it
+        # gets the arguments as python values and returns the result
+        self.foreign_impls[func_sym] = impl
+
+    def _reset(self, context=None):
+        self.context = context or Context()
         self.call_stack = CallStack()
         self.virtual_machine = VirtualMachine()
-        self.tree_runner = InstrnTreeRunner(self.virtual_machine, self.context, self.call_stack, self)
+        self.tree_runner = InstrnTreeRunner(self.virtual_machine, self.context, self.call_stack, self,
+                                            self.max_call_depth)
         self.tree_compiler = InstrnTreeCompiler(self.virtual_machine, self.context, self.call_stack, self)
+        self.purity = PurityAnalysis()
+        # the functions whose calls were inlined
+        self.inlined = []
+        # the functions left out of the C++
+        self.pruned = []
+        # the temporaries the optimizer introduced
+        self.optimized = []
+        # the expressions lowered to register code
+        self.lowered = 0
+        if self.count_calls:
+            self.tree_runner.call_counts = {}
         self.src_fname = None
         self.src = None
+        # the error the last file stopped on, None if it ran through
+        self.error = None
+        self.phase_times = {}
+        # the tree of the program load ran the globals of, and the classes
+        # it registered
+        self._loaded = None
+        self._types = {}
+        # func_sym -> (block of a Call, Func) reused by every call of func_sym
+        self._calls = {}
+
+    def _phase(self, name):
+        return _PhaseTimer(self.phase_times, name)
 
     def _set_file(self, src_fname, src=None):
         self._reset()
@@ -52,39 +137,33 @@ class Compiler:
             self.src = ''.join(src_file.readlines()).expandtabs(TAB_SIZE)
 
     def run_statement_code(self, src, pos):
-        src = src.expandtabs(TAB_SIZE)
+        src = ropes.materialize(src).expandtabs(TAB_SIZE)
         try:
             ast = self.parser.parse(src)
         except LarkError as e:
             raise LarkErrorWithPos(e, pos)
 
         instrn_tree = self.instruction_generator.gen_instrn_tree(ast, pos.filename+'mixin')
-
-        itp = InstrnTreePrinter()
-        itp.start(instrn_tree)
+        self.diag.dump(DEBUG, 'mixin_instrn_tree', _dump_tree(instrn_tree))
 
         scopes = self.scope_maker.make_scopes(instrn_tree, self.context.cur_scope)
         self.context.add_new_scopes(scopes)
-
-        scope_printer = ScopeTreePrinter()
-        scope_printer.visit(self.context.cur_scope)
-
+        self.diag.dump(DEBUG, 'mixin_scopes', _dump_scopes(self.context.cur_scope))
+        self._find_pure(instrn_tree)
 
         self.tree_runner.run(instrn_tree)
-        scope_printer.visit(self.context.cur_scope)
+        self.diag.dump(DEBUG, 'mixin_scopes', _dump_scopes(self.context.cur_scope))
 
 
     def run_exprn_code(self, src, pos):
-        src = src.expandtabs(TAB_SIZE)
+        src = ropes.materialize(src).expandtabs(TAB_SIZE)
         try:
             ast = self.exprn_parser.parse(src)
         except LarkError as e:
             raise LarkErrorWithPos(e, pos)
-        print(ast.pretty())
+        self.diag.dump(DEBUG, 'mixin_ast', lambda out: print(ast.pretty(), file=out))
         instrn_tree = self.instruction_generator.gen_instrn_tree(ast, self.src_fname)
-
-        itp = InstrnTreePrinter()
-        itp.start(instrn_tree)
+        self.diag.dump(DEBUG, 'mixin_instrn_tree', _dump_tree(instrn_tree))
 
         self.tree_runner.run(instrn_tree)
 
@@ -93,55 +172,240 @@ class Compiler:
     def run_exprn_tree(self, tree, pos):
         self.tree_runner.run(tree)
 
+    def _inline(self, instrn_tree):
+        inlined = Inliner(profile=self.inline_profile).inline(instrn_tree)
+        self.inlined = inlined
+        if inlined:
+            self.diag.log(INFO, 'inlining calls to: {}', ', '.join(inlined))
+            self.diag.dump(DEBUG, 'inlined_instrn_tree', _dump_tree(instrn_tree))
+
+    def _optimize(self, instrn_tree):
+        optimized = Optimizer().optimize(instrn_tree)
+        self.optimized = optimized
+        if optimized:
+            self.diag.log(INFO, 'optimizer temporaries: {}', ', '.join(optimized))
+            self.diag.dump(DEBUG, 'optimized_instrn_tree', _dump_tree(instrn_tree))
+
+    def _lower(self, instrn_tree):
+        self.lowered = Lowering(self.context).lower(instrn_tree)
+        self.diag.log(INFO, 'lowered {} expressions', self.lowered)
+        self.diag.dump(DEBUG, 'lowered_instrn_tree', _dump_tree(instrn_tree))
+
+    @property
+    def call_counts(self):
+        # function name -> calls made by the last run, with count_calls set
+        return self.tree_runner.call_counts
+
+    def _find_pure(self, instrn_tree):
+        memoized = self.purity.analyze(instrn_tree)
+        if memoized:
+            self.diag.log(INFO, 'memoizing pure functions: {}', ', '.join(memoized))
+
+    def memo_stats(self):
+        # function -> (hits, misses) of its memo, for the functions memoized
+        return self.purity.stats()
+
     def _on_error(self, error):
-        print('\n#### ERROR')
+        self.error = error
+        self.diag.log(ERROR, '\n#### ERROR')
         try:
             raise error
         except UnexpectedInput as e:
-            print(e)
-            print(e.get_context(self.src))
+            self.diag.log(ERROR, str(e))
+            self.diag.log(ERROR, e.get_context(self.src))
         except UnexpectedEOF as e:
-            print(e)
+            self.diag.log(ERROR, str(e))
         except LarkErrorWithPos as e:
-            print(e.lark_error)
-            print(e.pos)
-        print('####')
+            self.diag.log(ERROR, str(e.lark_error))
+            self.diag.log(ERROR, str(e.pos))
+        self.diag.log(ERROR, '####')
 
 
     def _run_file(self):
 
-        ast = self.parser.parse(self.src)
-
+        with self._phase('parse'):
+            ast = self.parser.parse(self.src)
+
+
+        self.diag.dump(DEBUG, 'ast', lambda out: print(ast.pretty(), file=out))
+        with self._phase('instrn_gen'):
+            instrn_tree = self.instruction_generator.gen_instrn_tree(ast, self.src_fname)
+        self.diag.dump(DEBUG, 'instrn_tree', _dump_tree(instrn_tree))
+        if self.inline:
+            with self._phase('inline'):
+                self._inline(instrn_tree)
+        if self.optimize:
+            with self._phase('optimize'):
+                self._optimize(instrn_tree)
+
+        with self._phase('scopes'):
+            scopes = self.scope_maker.make_scopes(instrn_tree)
+            self.context.add_new_scopes(scopes)
+        self.diag.dump(DEBUG, 'scopes', _dump_scopes(scopes[0]))
+        with self._phase('purity'):
+            self._find_pure(instrn_tree)
+        if self.lower:
+            with self._phase('lower'):
+                self._lower(instrn_tree)
 
-        print(ast.pretty())
-        instrn_tree = self.instruction_generator.gen_instrn_tree(ast, self.src_fname)
-
-        itp = InstrnTreePrinter()
-        itp.start(instrn_tree)
-
-        scopes = self.scope_maker.make_scopes(instrn_tree)
-        self.context.add_new_scopes(scopes)
-
-        scope_printer = ScopeTreePrinter()
-        scope_printer.visit(scopes[0])
+        with self.context.enter_scope(instrn_tree.uid):
+            with self._phase('globals'):
+                self.tree_runner.run(instrn_tree)
+            self.diag.dump(DEBUG, 'scopes', _dump_scopes(scopes[0]))
+        return instrn_tree
 
+    def _run_main(self, instrn_tree):
+        # the root scope persists, so the globals are still there
         with self.context.enter_scope(instrn_tree.uid):
-            self.tree_runner.run(instrn_tree)
-            scope_printer.visit(scopes[0])
-            self.run_exprn_code('main()', Position('nowhere', 0,0,0,0))
+            with self._phase('main'):
+                self.run_exprn_code('main()', Position('nowhere', 0,0,0,0))
 
     def run_file(self, fname, src=None):
-        print('~'*90)
-        print('Running File: ' + fname)
+        self.diag.log(INFO, '~'*90)
+        self.diag.log(INFO, 'Running File: ' + fname)
         self._set_file(fname, src)
         try:
-            self._run_file()
+            self._run_main(self._run_file())
         except LarkError as e:
             self._on_error(e)
-        print('~'*90)
+        self.diag.log(INFO, '~'*90)
+
+    def load(self, fname, src=None):
+        # runs the globals of fname, after which call runs its functions
+        self.diag.log(INFO, 'Loading File: ' + fname)
+        types = dict(typeSystem.types_)
+        self._set_file(fname, src)
+        try:
+            self._loaded = self._run_file()
+        except LarkError as e:
+            self._on_error(e)
+            return
+        self._types = {sym: type_ for sym, type_ in typeSystem.types_.items() if types.get(sym) is not type_}
+
+    def snapshot(self, fname, src=None):
+        # runs the globals of fname and returns the state they leave, as
+        # bytes run_snapshot can start main from any number of times
+        self.load(fname, src)
+        if self._loaded is None:
+            return None
+        return self._snapshot()
+
+    def _snapshot(self):
+        # the classes are pickled together with the context and tree so
+        # they are the types those refer to
+        state = {
+            'src_fname': self.src_fname,
+            'src': self.src,
+            'instrn_tree': self._loaded,
+            'context': self.context,
+            'types': self._types,
+            'purity': self.purity,
+            'inlined': self.inlined,
+            'pruned': self.pruned,
+            'optimized': self.optimized,
+            'lowered': self.lowered,
+        }
+        with self._phase('snapshot'):
+            return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+    def _restore(self, snapshot):
+        start = time.perf_counter()
+        state = pickle.loads(snapshot)
+        self._reset(state['context'])
+        self.phase_times['restore'] = time.perf_counter() - start
+        self.src_fname = state['src_fname']
+        self.src = state['src']
+        self._loaded = state['instrn_tree']
+        self._types = state['types']
+        typeSystem.types_.update(self._types)
+        self.purity = state['purity']
+        self.inlined = state['inlined']
+        self.pruned = state['pruned']
+        self.optimized = state['optimized']
+        self.lowered = state['lowered']
+
+    def run_snapshot(self, snapshot):
+        # runs main from the state snapshot returned, without parsing or
+        # running the globals again
+        self._restore(snapshot)
+        self.diag.log(INFO, '~'*90)
+        self.diag.log(INFO, 'Running Snapshot: ' + self.src_fname)
+        try:
+            self._run_main(self._loaded)
+        except LarkError as e:
+            self._on_error(e)
+        self.diag.log(INFO, '~'*90)
+
+    def _batch_call(self, func_sym):
+        entry = self._calls.get(func_sym)
+        if entry is not None:
+            return entry
+        func = self.context.read(func_sym, VALUE, _BATCH_POS).value(self.context, _BATCH_POS)
+        if not isinstance(func, Func):
+            raise IllegalOperation('calling {} from python'.format(func_sym), _BATCH_POS)
+        if func.is_iter:
+            raise IllegalOperation('calling an iterator from python', _BATCH_POS)
+        if any(isinstance(arg.type, Ref) for arg in func.args):
+            raise IllegalOperation('passing a reference from python', _BATCH_POS)
+        # the call site, and so what it resolves and caches, is kept
+        entry = self._calls[func_sym] = ([Call(func_sym, [], _BATCH_POS)], func)
+        return entry
+
+    def call(self, func_sym, *args):
+        # calls func_sym of the program load ran with python values, the
+        # result is a python value too. Globals keep what earlier calls did.
+        assert self._loaded is not None, 'nothing loaded'
+        vm = self.virtual_machine
+        with self.context.enter_scope(self._loaded.uid):
+            blk, func = self._batch_call(func_sym)
+            if len(args) != len(func.args):
+                raise ArgumentCountMismatch(func_sym, len(func.args), len(args), _BATCH_POS)
+            depth = vm.run_depth()
+            try:
+                for arg, value in zip(func.args, args):
+                    try:
+                        value = typeSystem.from_python(value, arg.type)
+                    except (TypeError, ValueError):
+                        raise TypeMismatchException(arg.type, type(value).__name__, _BATCH_POS)
+                    vm.run_push(RValue(value, arg.type))
+                self.tree_runner.run(blk)
+                if vm.run_depth() == depth:
+                    return None
+                result = vm.run_pop().rvalue(self.context, _BATCH_POS)
+            finally:
+                # a call that failed leaves its arguments behind
+                vm.run_truncate(depth)
+        if isinstance(func.rtn_type, Void):
+            return None
+        return typeSystem.to_python(result.value(), result.type)
+
+    def call_many(self, func_sym, arg_tuples, processes=None, chunksize=BATCH_CHUNK_SIZE):
+        # calls func_sym with each tuple of arguments in turn and returns an
+        # iterator over the results in the same order. With processes the
+        # calls are shared out among that many worker processes, each starting
+        # from the state the globals are in now and keeping globals of its own
+        # from then on. The workers are sent the foreign implementations
+        # registered, so those must be picklable: functions defined at the top
+        # of a module rather than lambdas or closures.
+        assert self._loaded is not None, 'nothing loaded'
+        with self.context.enter_scope(self._loaded.uid):
+            self._batch_call(func_sym)
+        if not processes:
+            return (self.call(func_sym, *args) for args in arg_tuples)
+        try:
+            pickle.dumps(self.foreign_impls)
+        except (pickle.PicklingError, AttributeError, TypeError) as e:
+            raise pickle.PicklingError('foreign implementations sent to worker processes must be picklable, '
+                                       'not lambdas or closures: {}'.format(e)) from e
+        init_args = (self._snapshot(), self.max_call_depth, self.foreign_impls)
+        return self._pool_calls(func_sym, arg_tuples, processes, chunksize, init_args)
+
+    def _pool_calls(self, func_sym, arg_tuples, processes, chunksize, init_args):
+        with multiprocessing.Pool(processes, _init_worker, init_args) as pool:
+            yield from pool.imap(_worker_call, ((func_sym, args) for args in arg_tuples), chunksize)
 
     def compile_statements(self, src,  pos):
-        src = src.expandtabs(TAB_SIZE)
+        src = ropes.materialize(src).expandtabs(TAB_SIZE)
         try:
             ast = self.parser.parse(src)
         except LarkError as e:
@@ -151,11 +415,12 @@ class Compiler:
 
         scopes = self.scope_maker.make_scopes(sub_tree, self.context.cur_scope)
         self.context.add_new_scopes(scopes)
+        self._find_pure(sub_tree)
 
         return sub_tree
 
     def compile_exprn_code(self, src,  pos):
-        src = src.expandtabs(TAB_SIZE)
+        src = ropes.materialize(src).expandtabs(TAB_SIZE)
         try:
             ast = self.exprn_parser.parse(src)
         except LarkError as e:
@@ -169,30 +434,45 @@ class Compiler:
 
 
     def _compile_file(self):
-        ast = self.parser.parse(self.src)
-
-        print(ast.pretty())
-        instrn_tree = self.instruction_generator.gen_instrn_tree(ast, self.src_fname)
-
-        itp = InstrnTreePrinter()
-        itp.start(instrn_tree)
-
-        scopes = self.scope_maker.make_scopes(instrn_tree)
-        self.context.add_new_scopes(scopes)
-
-        scope_printer = ScopeTreePrinter()
-        scope_printer.visit(scopes[0])
+        with self._phase('parse'):
+            ast = self.parser.parse(self.src)
+
+        self.diag.dump(DEBUG, 'ast', lambda out: print(ast.pretty(), file=out))
+        with self._phase('instrn_gen'):
+            instrn_tree = self.instruction_generator.gen_instrn_tree(ast, self.src_fname)
+        self.diag.dump(DEBUG, 'instrn_tree', _dump_tree(instrn_tree))
+        if self.inline:
+            with self._phase('inline'):
+                self._inline(instrn_tree)
+        if self.prune:
+            with self._phase('prune'):
+                self.pruned = DeadCode().prune(instrn_tree)
+            self.diag.dump(DEBUG, 'pruned_instrn_tree', _dump_tree(instrn_tree))
+        if self.optimize:
+            with self._phase('optimize'):
+                self._optimize(instrn_tree)
+
+        with self._phase('scopes'):
+            scopes = self.scope_maker.make_scopes(instrn_tree)
+            self.context.add_new_scopes(scopes)
+        self.diag.dump(DEBUG, 'scopes', _dump_scopes(scopes[0]))
+        with self._phase('purity'):
+            self._find_pure(instrn_tree)
+        if self.lower:
+            with self._phase('lower'):
+                self._lower(instrn_tree)
 
         with self.context.enter_scope(instrn_tree.uid):
-            code = self.tree_compiler.compile_tree(instrn_tree)
-            print('\n'.join(code))
-            compile_cpp(code)
+            with self._phase('emit'):
+                code = self.tree_compiler.compile_tree(instrn_tree)
+            self.diag.dump(DEBUG, 'cpp', lambda out: print('\n'.join(code), file=out))
+            with self._phase('gxx'):
+                compile_cpp(code, diag=self.diag)
 
 
 
     def compile_file(self, fname, src=None):
-        # print('~'*90)
-        print('Running File: ' + fname)
+        self.diag.log(INFO, 'Compiling File: ' + fname)
         self._set_file(fname, src)
 
         try:
@@ -204,8 +484,22 @@ class Compiler:
 
 
 
+# the compiler of a worker process of call_many
+_worker = None
+
+def _init_worker(snapshot, max_call_depth, foreign_impls):
+    global _worker
+    _worker = Compiler(max_call_depth=max_call_depth)
+    _worker.foreign_impls.update(foreign_impls)
+    _worker._restore(snapshot)
+
+def _worker_call(call):
+    func_sym, args = call
+    return _worker.call(func_sym, *args)
+
+
 def main():
-    compiler = Compiler()
+    compiler = Compiler(Diagnostics(DEBUG))
     # compiler.run_file('test_code/mixin.lang')
     # compiler.compile_file('test_code/func_call.lang')
     compiler.compile_file('test_code/basic.lang')
@@ -42,32 +42,29 @@ class Scope:
     def __init__(self):
         self.name = ''
         self.uid = None
-        self.instance_uid = None
         self.symbol_tbl = SymbolTable()
         self.persists = False
         self.parent = None
         self.symbol_values = {}
         self.children = []
         self.tmp_cnt = 0
-
-    def init_instance(self, instance_uid):
-        instance = Scope()
-        instance.name = self.name
-        instance.uid = self.uid
-        instance.instance_uid = instance_uid
-        assert self.instance_uid is None
-        instance.symbol_tbl = self.symbol_tbl
-        instance.persists = self.persists
-        assert self.persists
-        instance.parent = self.parent
-        instance.symbol_values = {}
-        instance.children = self.children
-        instance.tmp_cnt = self.tmp_cnt
-        return instance
+        # locals the optimizer introduced, plocal leaves them out
+        self.tmp_syms = set()
+        self.call_depth = 0
+        self._frame_scopes = None
+
+    def frame_scopes(self):
+        # this scope and every descendant whose values live and die with a call
+        if self._frame_scopes is None:
+            scopes = [self]
+            for scope in scopes:
+                scopes += (c for c in scope.children if not c.persists)
+            self._frame_scopes = scopes
+        return self._frame_scopes
 
     def __str__(self):
         l = []
-        l.append('name: {}, uid: {}, instance_uid: {}'.format(self.name, self.uid, self.instance_uid))
+        l.append('name: {}, uid: {}'.format(self.name, self.uid))
 
         if self.persists:
             l.append('PERSISTS')
@@ -86,6 +83,10 @@ class Scope:
 
         if field == VALUE:
             #     assert self.read(sym, TYPE) == value.type
+            slot = self.symbol_values.get(sym)
+            if slot is not None and slot.aliases:
+                slot.store(value, None)
+                return
             self.symbol_values[sym] = value
             return
 
@@ -94,9 +95,10 @@ class Scope:
 
     def read(self, sym, field, pos):
         if field == VALUE:
-            if sym in self.symbol_tbl and not self.symbol_values:
+            try:
+                return self.symbol_values[sym]
+            except KeyError:
                 raise ReadUninitializedValue(sym, pos)
-            return self.symbol_values[sym]
         return self.symbol_tbl.read(sym, field)
 
     def has_field(self,sym, field):
@@ -119,12 +121,13 @@ class ScopeTreeVisitor:
 
 
 class ScopeTreePrinter(ScopeTreeVisitor):
-    def __init__(self):
+    def __init__(self, out=None):
         self.indent_cnt = 0
+        self._out = out
 
     def _print(self, s):
         indent_str = self.indent_cnt * 4 * ' '
-        print( '\n'.join((indent_str + ln for ln in s.split('\n'))))
+        print( '\n'.join((indent_str + ln for ln in s.split('\n'))), file=self._out)
 
     def visit(self, scope):
         self._print(str(scope))
@@ -143,7 +146,7 @@ class ScopeEntry:
         pass
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._ctx._exit_scope()
+        self._ctx.pop_scope()
 
 class GentleScopeEntry:
     def __init__(self, ctx):
@@ -166,7 +169,9 @@ class Context:
         self._cur_scope = None
         self._scope_history = []
         self._root = None
-        self._instance_uid_count = 0
+        # bumped whenever a symbol some call site has cached is redeclared
+        self.epoch = 0
+        self._watched_syms = set()
 
     @property
     def cur_scope(self):
@@ -179,37 +184,91 @@ class Context:
             if not scope.parent:
                 assert self._root is None
                 self._root = scope
-
-    def init_obj(self, uid):
-        self._instance_uid_count += 1
-        instance_uid = ("obj", self._instance_uid_count)
-        base = self._scopes_by_uid[uid]
-        instance = base.init_instance(instance_uid)
-        if instance.parent:
-            instance.parent.children.append(instance)
-        self._scopes_by_uid[instance_uid] = instance
-        return instance_uid
-
+            parent = scope.parent
+            while parent:
+                parent._frame_scopes = None
+                parent = parent.parent
 
     def enter_scope(self, uid):
+        self.push_scope(uid)
+        return ScopeEntry(self)
+
+    def push_scope(self, uid):
         self._scope_history.append(self._cur_scope)
         self._cur_scope = self._scopes_by_uid[uid]
-        return ScopeEntry(self)
+
+    def pop_scope(self):
+        scope = self._cur_scope
+        if not scope.persists and scope.symbol_values:
+            scope.symbol_values.clear()
+        self._cur_scope = self._scope_history.pop()
+
+    def switch_scope(self, scope):
+        # cheap enter/exit for callers that remember the previous scope themselves
+        prev = self._cur_scope
+        self._cur_scope = scope
+        return prev
+
+    def scope(self, uid):
+        return self._scopes_by_uid[uid]
+
+    def watch(self, sym):
+        self._watched_syms.add(sym)
+
+    def rebound(self, sym):
+        # a value was stored to sym, calls that cached it must look it up again
+        if sym in self._watched_syms:
+            self.epoch += 1
+
+    def push_call_scope(self, scope):
+        # a scope that is already running a call gets fresh values for the
+        # new activation, the caller's are handed back to pop_call_scope
+        saved = None
+        if scope.call_depth:
+            saved = [(s, s.symbol_values) for s in scope.frame_scopes()]
+            for s, _ in saved:
+                s.symbol_values = {}
+        scope.call_depth += 1
+        self._scope_history.append(self._cur_scope)
+        self._cur_scope = scope
+        return saved
+
+    def pop_call_scope(self, saved):
+        self._cur_scope.call_depth -= 1
+        self.pop_scope()
+        if saved:
+            for scope, values in saved:
+                scope.symbol_values = values
+
+    def swap_frame_values(self, scope, values):
+        # exchanges the live values of scope's frame with those of a suspended
+        # activation kept in values, swapping again puts them back
+        for s in scope.frame_scopes():
+            values[s], s.symbol_values = s.symbol_values, values.get(s, {})
+
+    def resume_scopes(self, state):
+        # re-enters a scope stack saved by suspend_scopes, returns the mark to suspend it at
+        self._scope_history.append(self._cur_scope)
+        mark = len(self._scope_history)
+        cur, history = state
+        self._scope_history += history
+        self._cur_scope = cur
+        return mark
+
+    def suspend_scopes(self, mark):
+        state = (self._cur_scope, self._scope_history[mark:])
+        del self._scope_history[mark:]
+        self._cur_scope = self._scope_history.pop()
+        return state
 
     def _gently_enter_scope(self, uid):
         self._scope_history.append(self._cur_scope)
         self._cur_scope = self._scopes_by_uid[uid]
         return GentleScopeEntry(self)
 
-    def cur_scope_uid(self): # does not include instance_uid
+    def cur_scope_uid(self):
         return self._cur_scope.uid
 
-    def _exit_scope(self):
-        if not self._cur_scope.persists:
-            self._cur_scope.symbol_values = {}
-        self._cur_scope = self._scope_history.pop()
-
-
     def _gently_exit_scope(self):
         self._cur_scope = self._scope_history.pop()
 
@@ -224,6 +283,8 @@ class Context:
         if sym in self._cur_scope \
             and self._cur_scope.has_field(sym,VALUE):
             raise SymbolReassignment(sym, pos)
+        if sym in self._watched_syms:
+            self.epoch += 1
         self._cur_scope.insert(sym, TYPE, type_)
 
 
@@ -237,6 +298,7 @@ class Context:
 
 
     def assign_value(self, sym, value, pos):
+        self.rebound(sym)
         for scope in self._scope_hierarchy():
             if sym in scope:
                 scope.insert(sym, VALUE, value)
@@ -244,6 +306,7 @@ class Context:
         raise SymbolNotFound(sym, pos)
 
     def assign_value_at(self, uid, sym, value, pos):
+        self.rebound(sym)
         with self._gently_enter_scope(uid):
             for scope in self._scope_hierarchy():
                 if sym in scope:
@@ -259,6 +322,14 @@ class Context:
                 return scope.read(sym, field, pos)
         raise SymbolNotFound(sym, pos)
 
+    def values_holding(self, sym, scope_uid, pos):
+        # the values of the activation sym lives in, seen from scope_uid
+        with self._gently_enter_scope(scope_uid):
+            for scope in self._scope_hierarchy():
+                if sym in scope:
+                    return scope.symbol_values
+        raise SymbolNotFound(sym, pos)
+
     def read_from_scope(self, sym, scope_uid, field, pos):
         with self._gently_enter_scope(scope_uid):
             return self.read(sym, field, pos)
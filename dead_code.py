@@ -0,0 +1,209 @@
+# Drops what the C++ backend would emit for nothing: top level functions
+# nothing reaches from main or from the code around them, statements after
+# a return, branches of ifs on a constant and locals that are only ever
+# assigned. Mixins are compiled from strings, so every name in a string
+# literal counts as reached, as does every name in foreign code. A mixin of
+# anything but string literals joined together may name any function, so
+# then no function is dropped.
+import re
+import ropes
+from instructions import (ArrayDecl, ArrayLit, Assign, BinOp, Call, Decl, EndIter, Foreign, ForRange, IfElse,
+                          InitFunc, Inline, Mixin, MixinStatements, PLocal, Push, Pushi, Rtn, UnaryOp,
+                          WhileLoop, blocks_under)
+from type_system import Add, Float, Int, String
+
+_IDENT = re.compile(r'[A-Za-z_]\w*')
+
+# instructions that may refer to any local by name
+_OPAQUE_INSTRNS = (Mixin, MixinStatements, PLocal, Foreign)
+
+# how the instructions an assignment may be dropped with change the stack
+_PURE_EFFECTS = {Push: 1, Pushi: 1, BinOp: -1, UnaryOp: 0}
+
+
+def _walk(blk):
+    for blk in blocks_under(blk):
+        yield from blk
+
+
+def _references(blk):
+    syms = set()
+    for instrn in _walk(blk):
+        if isinstance(instrn, Call):
+            syms.add(instrn.func_sym)
+        elif isinstance(instrn, Push):
+            syms.add(instrn.sym)
+        elif isinstance(instrn, Pushi) and isinstance(instrn.value.type, String):
+            syms.update(_IDENT.findall(ropes.materialize(instrn.value.value())))
+        elif isinstance(instrn, Foreign):
+            syms.update(_IDENT.findall(instrn.code))
+        elif isinstance(instrn, (Mixin, MixinStatements)):
+            # a name may be split across the literals
+            syms.update(_IDENT.findall(_mixin_code(instrn.exprn_blks[0]) or ''))
+    return syms
+
+
+def _mixin_code(blk):
+    # the code a mixin of blk compiles, if blk only joins string literals
+    parts = []
+    for instrn in blk:
+        if isinstance(instrn, Pushi) and isinstance(instrn.value.type, String):
+            parts.append(ropes.materialize(instrn.value.value()))
+        elif not (isinstance(instrn, BinOp) and isinstance(instrn.op, Add)):
+            return None
+    return ''.join(parts)
+
+
+def _constant(blk):
+    # the truth of a condition that is a single number, else None
+    if len(blk) == 1 and isinstance(blk[0], Pushi) and isinstance(blk[0].value.type, (Int, Float)):
+        return bool(blk[0].value.value())
+    return None
+
+
+def _terminates(instrn):
+    if isinstance(instrn, (Rtn, EndIter)):
+        return True
+    return isinstance(instrn, IfElse) and bool(instrn.elseBlk) \
+        and _ends(instrn.ifBlk) and _ends(instrn.elseBlk)
+
+
+def _ends(blk):
+    return any(_terminates(instrn) for instrn in blk)
+
+
+def _local_uses(func):
+    # each Push in func is of the innermost local of its name declared
+    # before it in its scope, else of a parameter or global. Returns the
+    # (blk, decl) of every local, the decls read and, for each decl, the
+    # (blk, start, end) of the assignments to it that could be dropped.
+    decls = []
+    reads = set()
+    assigns = {}
+    # sym -> the Decl of the local it names, None for parameters
+    blks = [(func.instrns, {arg.sym: None for arg in func.args})]
+    for blk, visible in blks:
+        for i, instrn in enumerate(blk):
+            decl = visible.get(instrn.sym) if isinstance(instrn, Push) else None
+            if decl is not None:
+                end = _assign_end(blk, i)
+                if end is None:
+                    reads.add(decl)
+                else:
+                    assigns.setdefault(decl, []).append((blk, i, end))
+            # the blocks queued see the locals declared so far
+            blks += ((child, dict(visible)) for child in instrn.exprn_blks)
+            blks += ((child, dict(visible)) for child in instrn.child_blks.values())
+            for child in instrn.child_scopes.values():
+                inner = dict(visible)
+                if isinstance(instrn, ForRange):
+                    inner[instrn.typed_sym.sym] = None
+                elif isinstance(instrn, Inline):
+                    inner.update((param.sym, None) for param in instrn.params)
+                elif isinstance(instrn, InitFunc):
+                    inner.update((arg.sym, None) for arg in instrn.typed_func.value().args)
+                blks.append((child, inner))
+            if isinstance(instrn, (Decl, ArrayDecl)):
+                visible[instrn.typed_sym.sym] = instrn
+                decls.append((blk, instrn))
+    return decls, reads, assigns
+
+
+def _assign_end(blk, i):
+    # the index of the Assign that the Push at i is the target of, when what
+    # is assigned can be dropped without changing anything, else None
+    depth = 0
+    for j in range(i + 1, len(blk)):
+        instrn = blk[j]
+        if isinstance(instrn, Assign):
+            return j if depth == 1 else None
+        if isinstance(instrn, ArrayLit):
+            depth += 1 - instrn.n
+            continue
+        effect = _PURE_EFFECTS.get(instrn.__class__)
+        if effect is None or instrn.exprn_blks:
+            return None
+        depth += effect
+    return None
+
+
+class DeadCode:
+    def __init__(self):
+        # the functions dropped
+        self.pruned = []
+
+    def prune(self, instrn_tree):
+        # scopes keep the uids they have even when their first instruction goes
+        instrn_tree.uid = instrn_tree.uid
+        for instrn in _walk(instrn_tree):
+            for blk in instrn.child_scopes.values():
+                blk.uid = blk.uid
+
+        for instrn in _walk(instrn_tree):
+            for blk in instrn.child_scopes.values():
+                self._prune_blk(blk)
+            for blk in instrn.child_blks.values():
+                self._prune_blk(blk)
+        self._prune_blk(instrn_tree)
+
+        funcs = {instrn.typed_sym.sym: instrn for instrn in instrn_tree if isinstance(instrn, InitFunc)}
+        # the code around the functions always runs
+        reached = set()
+        todo = {'main'}
+        if any(isinstance(instrn, (Mixin, MixinStatements)) and _mixin_code(instrn.exprn_blks[0]) is None
+               for instrn in _walk(instrn_tree)):
+            todo |= set(funcs)
+        for instrn in instrn_tree:
+            if not isinstance(instrn, InitFunc):
+                todo |= _references([instrn])
+        while todo:
+            sym = todo.pop()
+            if sym in reached:
+                continue
+            reached.add(sym)
+            if sym in funcs:
+                todo |= _references(funcs[sym].typed_func.value().instrns)
+
+        self.pruned = [sym for sym in funcs if sym not in reached]
+        instrn_tree[:] = [instrn for instrn in instrn_tree
+                          if not (isinstance(instrn, InitFunc) and instrn.typed_sym.sym not in reached)]
+
+        for instrn in instrn_tree:
+            if isinstance(instrn, InitFunc):
+                self._drop_unused(instrn.typed_func.value())
+        return self.pruned
+
+    def _prune_blk(self, blk):
+        kept = []
+        for instrn in blk:
+            if isinstance(instrn, IfElse):
+                cond = _constant(instrn.condBlk)
+                if cond is not None:
+                    # the branch that never runs is left empty
+                    del (instrn.elseBlk if cond else instrn.ifBlk)[:]
+            elif isinstance(instrn, WhileLoop) and _constant(instrn.condBlk) is False \
+                    and instrn.__class__ is WhileLoop:
+                continue
+            kept.append(instrn)
+            if _terminates(instrn):
+                break
+        blk[:] = kept
+
+    def _drop_unused(self, func):
+        # locals that are declared and assigned but never read, in functions
+        # where nothing can read them by name
+        if any(isinstance(instrn, _OPAQUE_INSTRNS) for instrn in _walk(func.instrns)):
+            return
+        dropped = True
+        while dropped:
+            dropped = False
+            decls, reads, assigns = _local_uses(func)
+            for blk, decl in decls:
+                if decl in reads or (isinstance(decl, ArrayDecl) and decl.size):
+                    continue
+                # later assignments in a block first, so earlier indices hold
+                for assign_blk, start, end in sorted(assigns.get(decl, ()), key=lambda a: -a[1]):
+                    del assign_blk[start:end + 1]
+                blk.remove(decl)
+                dropped = True
+                break
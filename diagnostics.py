@@ -0,0 +1,39 @@
+import os
+import sys
+
+QUIET = 0
+ERROR = 1
+INFO = 2
+DEBUG = 3
+
+
+class Diagnostics:
+    def __init__(self, level=ERROR, dump_dir=None, dump_names=()):
+        self.level = level
+        # when set, dumps are written to files in dump_dir instead of stdout
+        self.dump_dir = dump_dir
+        # dumps listed here are produced whatever the level
+        self.dump_names = frozenset(dump_names)
+        self._dump_counts = {}
+
+    def log(self, level, msg, *args):
+        if level > self.level:
+            return
+        if args:
+            msg = msg.format(*args)
+        print(msg)
+
+    def dump(self, level, name, render):
+        # render(out) writes the dump to the file object out, it is only
+        # called when the dump is wanted so formatting costs nothing otherwise
+        if level > self.level and name not in self.dump_names:
+            return
+        if self.dump_dir is None:
+            render(sys.stdout)
+            return
+        os.makedirs(self.dump_dir, exist_ok=True)
+        count = self._dump_counts.get(name, 0)
+        self._dump_counts[name] = count + 1
+        fname = os.path.join(self.dump_dir, '{}.{}.txt'.format(name, count))
+        with open(fname, 'w') as out:
+            render(out)
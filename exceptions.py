@@ -52,8 +52,37 @@ class ReadUninitializedValue(VMRuntimeException):
         super().__init__('Reading uninitialized value: "' + sym +'"', pos)
         self.sym = sym
 
+class IndexOutOfRange(VMRuntimeException):
+    def __init__(self, index, length, pos):
+        super().__init__('Index {} out of range for an array of length {}.'.format(index, length), pos)
+        self.index = index
+        self.length = length
+
+class ArrayLengthMismatch(VMRuntimeException):
+    def __init__(self, left, right, pos):
+        super().__init__('Arrays of length {} and {} used together.'.format(left, right), pos)
+
 class MixinException(VMRuntimeException):
     def __init__(self, sym, pos):
         self.sym = sym
         super().__init__('The symbol {} is unknowable at compile time.'.format(sym), pos)
 
+class CallDepthExceeded(VMRuntimeException):
+    def __init__(self, max_depth, pos):
+        super().__init__('Maximum call depth of {} exceeded.'.format(max_depth), pos)
+        self.max_depth = max_depth
+
+class UnrollLimitExceeded(VMRuntimeException):
+    def __init__(self, limit, pos):
+        super().__init__('Static loop not unrolled within {} iterations.'.format(limit), pos)
+        self.limit = limit
+
+class ForeignCodeUnavailable(VMRuntimeException):
+    def __init__(self, func_sym, pos):
+        super().__init__('Foreign function "{}" has no python implementation to run.'.format(func_sym), pos)
+        self.func_sym = func_sym
+
+class ArgumentCountMismatch(VMRuntimeException):
+    def __init__(self, func_sym, expected, given, pos):
+        super().__init__('Function "{}" takes {} arguments, {} given.'.format(func_sym, expected, given), pos)
+        self.func_sym = func_sym
@@ -0,0 +1,248 @@
+# Replaces calls to small functions by copies of their bodies. A function
+# can be inlined when its body only uses its own arguments and locals, calls
+# nothing that is still a call, and returns once, at its end. The copy gets
+# its locals renamed so that the arguments, evaluated in the caller, can be
+# bound in the copy's scope without one hiding the other, and the final
+# return becomes the value the copy leaves on the stack. Functions only
+# become small enough once the calls in them are inlined, so candidates are
+# looked for again until no more are found, which leaves recursion alone.
+import copy
+from instruction_block import Block
+from instructions import (ArrayDecl, ArrayLit, Assign, BinOp, Call, Case, ClassDecl, Decl, ForRange,
+                          IfElse, Index, InitFunc, Inline, Instrn, Len, Member, Mixin,
+                          MixinStatements, Pop, Push, Pushi, Rtn, StaticForRange, StaticIfElse,
+                          StaticWhileLoop, Switch, UnaryOp, WhileLoop, all_syms, assigned_syms, blocks_under)
+from type_system import Ref, Void
+from typed_data import TSym
+
+# the most instructions a body inlined everywhere can have
+INLINE_SIZE_LIMIT = 40
+# the limit for functions a profile shows are called at least HOT_CALLS times
+INLINE_HOT_SIZE_LIMIT = 160
+HOT_CALLS = 1000
+
+_INLINABLE_INSTRNS = frozenset((Decl, ArrayDecl, ArrayLit, Assign, Push, Pushi, BinOp, UnaryOp, Index, Len,
+                                Member, Pop, IfElse, Switch, WhileLoop, ForRange, Inline))
+
+# expressions evaluated when compiling rather than when running
+_STATIC_INSTRNS = (StaticIfElse, StaticWhileLoop, StaticForRange, Mixin, MixinStatements)
+
+
+class _BodyScan:
+    # checks that a function body can be inlined, counting its instructions
+    # and collecting the names it declares
+    def __init__(self, func):
+        self.ok = True
+        self.size = 0
+        self.locals = {arg.sym for arg in func.args}
+        self._scopes = [set(self.locals)]
+        body = func.instrns
+        if not body or not isinstance(body[-1], Rtn) or not body[-1].exprn:
+            self.ok = False
+            return
+        self._blk(body[:-1])
+        self._blk(body[-1].exprn)
+
+    def _declare(self, sym):
+        self._scopes[-1].add(sym)
+        self.locals.add(sym)
+
+    def _blk(self, blk):
+        for instrn in blk:
+            if not self.ok:
+                return
+            self._instrn(instrn)
+
+    def _instrn(self, instrn):
+        self.size += 1
+        if type(instrn) not in _INLINABLE_INSTRNS:
+            self.ok = False
+            return
+        if isinstance(instrn, Push) and not any(instrn.sym in scope for scope in self._scopes):
+            # a global, the caller may have a local of that name
+            self.ok = False
+            return
+
+        for blk in instrn.exprn_blks:
+            self._blk(blk)
+        if isinstance(instrn, (Decl, ArrayDecl)):
+            self._declare(instrn.typed_sym.sym)
+        for blk in instrn.child_scopes.values():
+            if isinstance(instrn, ForRange):
+                self._scopes.append(set())
+                self._declare(instrn.typed_sym.sym)
+            elif isinstance(instrn, Inline):
+                # already renamed, its params are only seen in its body
+                self._scopes.append({param.sym for param in instrn.params})
+            else:
+                self._scopes.append(set())
+            self._blk(blk)
+            self._scopes.pop()
+
+
+def _declared_syms(func, fields=()):
+    # every name a caller declares somewhere, a call to a function of one of
+    # these names may not mean the function
+    syms = {arg.sym for arg in func.args} | set(fields)
+    for blk in blocks_under(func.instrns):
+        for instrn in blk:
+            if isinstance(instrn, (Decl, ArrayDecl, ForRange, InitFunc)):
+                syms.add(instrn.typed_sym.sym)
+            elif isinstance(instrn, ClassDecl):
+                syms.add(instrn.t_sym.sym)
+    return syms
+
+
+class Inliner:
+    def __init__(self, size_limit=INLINE_SIZE_LIMIT, profile=None):
+        self.size_limit = size_limit
+        # function name -> number of calls, from an earlier run. Functions it
+        # has as hot get a bigger limit and those it never saw called none.
+        self.profile = profile
+        # sym -> (Func, _BodyScan) of the functions calls to are inlined
+        self.inlined = {}
+        self._syms = set()
+        # names assigned to, they may come to mean another function
+        self._rebound = set()
+        self._n = 0
+
+    def _limit(self, sym):
+        if self.profile is None:
+            return self.size_limit
+        calls = self.profile.get(sym, 0)
+        if not calls:
+            return 0
+        return INLINE_HOT_SIZE_LIMIT if calls >= HOT_CALLS else self.size_limit
+
+    def _inlinable(self, sym, func):
+        if func.is_iter or isinstance(func.rtn_type, Void) \
+                or any(isinstance(arg.type, Ref) for arg in func.args):
+            return None
+        scan = _BodyScan(func)
+        if not scan.ok or scan.size > self._limit(sym):
+            return None
+        return scan
+
+    def inline(self, instrn_tree):
+        # rewrites the functions and methods at the top of instrn_tree in
+        # place, returns the names of the functions inlined
+        self._syms = all_syms(instrn_tree)
+        self._rebound = assigned_syms(instrn_tree)
+        funcs = []
+        methods = []
+        for instrn in instrn_tree:
+            if isinstance(instrn, InitFunc):
+                funcs.append((instrn.typed_sym.sym, instrn.typed_func.value()))
+            elif isinstance(instrn, ClassDecl):
+                fields = [tsym.sym for tsym in instrn.fields]
+                methods += ((method.typed_func.value(), fields) for method in instrn.methods)
+
+        found = True
+        while found:
+            found = False
+            for sym, func in funcs:
+                self._rewrite(func.instrns, _declared_syms(func))
+                if sym in self.inlined:
+                    continue
+                scan = self._inlinable(sym, func)
+                if scan is not None:
+                    self.inlined[sym] = (func, scan)
+                    found = True
+        for func, fields in methods:
+            self._rewrite(func.instrns, _declared_syms(func, fields))
+        return list(self.inlined)
+
+    def _rewrite(self, blk, caller_syms):
+        for i, instrn in enumerate(blk):
+            if isinstance(instrn, _STATIC_INSTRNS):
+                for child in instrn.child_blks.values():
+                    self._rewrite(child, caller_syms)
+                for child in instrn.child_scopes.values():
+                    self._rewrite(child, caller_syms)
+                continue
+            if isinstance(instrn, (InitFunc, ClassDecl, Inline)):
+                continue
+            if isinstance(instrn, ForRange):
+                # bounds is a block of its own made from the others
+                for exprn in (instrn.start, instrn.stop, instrn.step):
+                    self._rewrite(exprn, caller_syms)
+                instrn.bounds[:] = instrn.start + instrn.stop + instrn.step
+            else:
+                for exprn in instrn.exprn_blks:
+                    self._rewrite(exprn, caller_syms)
+            for child in instrn.child_blks.values():
+                self._rewrite(child, caller_syms)
+            for child in instrn.child_scopes.values():
+                self._rewrite(child, caller_syms)
+            if isinstance(instrn, Call) and instrn.func_sym in self.inlined \
+                    and instrn.func_sym not in caller_syms and instrn.func_sym not in self._rebound:
+                blk[i] = self._inline_call(instrn)
+
+    def _fresh_sym(self, sym, func_sym):
+        new_sym = '{}_{}{}'.format(sym, func_sym, self._n)
+        while new_sym in self._syms:
+            new_sym += '_'
+        self._syms.add(new_sym)
+        return new_sym
+
+    def _inline_call(self, call):
+        func, scan = self.inlined[call.func_sym]
+        self._n += 1
+        renames = {sym: self._fresh_sym(sym, call.func_sym) for sym in scan.locals}
+        cloner = _Cloner(renames, self._n)
+        body = cloner.blk(Block(func.instrns[:-1]))
+        body += cloner.blk(func.instrns[-1].exprn)
+        body.uid = (call.pos, self._n)
+        params = [TSym(renames[arg.sym], arg.type) for arg in func.args]
+        return Inline(call.func_sym, params, func.rtn_type, call.arg_exprns, body, call.pos)
+
+
+class _Cloner:
+    # copies blocks and the instructions in them, renaming syms. Blocks with
+    # a scope get a uid of their own so the copy has scopes of its own.
+    def __init__(self, renames, n):
+        self._renames = renames
+        self._n = n
+        self._copies = {}
+
+    def blk(self, blk):
+        try:
+            return self._copies[id(blk)]
+        except KeyError:
+            pass
+        new = Block()
+        self._copies[id(blk)] = new
+        new.persistent_scope = blk.persistent_scope
+        new += (self.instrn(instrn) for instrn in blk)
+        if blk.uid is not None:
+            new.uid = (blk.uid, self._n)
+        return new
+
+    def instrn(self, instrn):
+        try:
+            return self._copies[id(instrn)]
+        except KeyError:
+            pass
+        new = copy.copy(instrn)
+        self._copies[id(instrn)] = new
+        for attr, value in vars(instrn).items():
+            setattr(new, attr, self._value(value))
+        if isinstance(new, Push):
+            new.sym = self._renames.get(new.sym, new.sym)
+        elif isinstance(new, (Decl, ArrayDecl, ForRange)):
+            tsym = new.typed_sym
+            new.typed_sym = TSym(self._renames.get(tsym.sym, tsym.sym), tsym.type)
+        return new
+
+    def _value(self, value):
+        if isinstance(value, Block):
+            return self.blk(value)
+        if isinstance(value, Instrn):
+            return self.instrn(value)
+        if isinstance(value, Case):
+            return Case(value.value, self.blk(value.body), value.fallthru)
+        if isinstance(value, list):
+            return [self._value(v) for v in value]
+        if isinstance(value, dict):
+            return {k: self._value(v) for k, v in value.items()}
+        return value
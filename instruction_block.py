@@ -2,6 +2,7 @@ class Block(list):
     def __init__(self, *vargs, **kwargs):
         super().__init__(*vargs, **kwargs)
         self.persistent_scope = False
+        self._uid = None
 
 
 
@@ -13,8 +14,15 @@ class Block(list):
 
     @property
     def uid(self):
+        if self._uid is not None:
+            return self._uid
         return self.pos
 
+    @uid.setter
+    def uid(self, uid):
+        # pins the scope uid, for blocks that need a scope even when empty
+        self._uid = uid
+
 
     def addChildScope(self, newScope):
         self[0]._addChildScope(newScope)
@@ -1,22 +1,90 @@
-from typed_data import TSym, RValue, regNewType, typeFromString
+from typed_data import TSym, RValue, arrayType, regNewType, typeFromString
 from instruction_block import Block
 from lark.visitors import Interpreter
+from lark import Token, Tree
 from position import Position
 from instructions import (  ClassDecl, Func, Assign, InitFunc, Mixin, MixinStatements,
-                            ObjectInit, PLocal, Push, Pushi, Pop, Decl, IfElse, WhileLoop, Rtn,
-                            Call, BinOp, UnaryOp )
+                            PLocal, Push, Pushi, Pop, Decl, IfElse, WhileLoop, Rtn,
+                            Call, BinOp, UnaryOp, ForRange, StaticIfElse, StaticWhileLoop,
+                            StaticForRange, ArrayDecl, ArrayLit, Index, Len, Yield, EndIter,
+                            Case, Switch, Foreign, Member, MethodCall, PushSelf )
 from type_system import (   And, Eq, Gt, GtEq, Lt, LtEq, NotEq, Or,  Add, Sub, Mul,
-                            Div, Neg, Int, Float, String )
+                            Div, Neg, Int, Float, String, Iterator, Ref )
+from exceptions import IllegalOperation, UnrecognizedType
 import type_system as type_sys
 
 def _get_sym(sym):
     assert sym.data == 'sym'
     return str(sym.children[0])
 
-def _get_type(type_, pos):
+def _ref_count(type_):
+    # & modifiers come before the type name
+    mods = [c for c in type_.children if isinstance(c, Tree) and c.data == 'ref']
+    return sum(len(mod.children) for mod in mods)
+
+def _split_type(type_, pos):
+    # the type, and the size expression of an array whose size is only known at runtime
     assert type_.data == 'type'
-    return typeFromString(str(type_.children[0]), pos)
+    children = type_.children[1:] if _ref_count(type_) else type_.children
+    base = typeFromString(str(children[0]), pos)
+    if len(children) < 2:
+        return base, None
+
+    index = children[1]
+    if not index.children:
+        return arrayType(base, None, pos), None
+    size = index.children[0]
+    if size.data == 'integer':
+        n = int(RValue.fromString(str(size.children[0]), Int(), pos).value())
+        return arrayType(base, n, pos), None
+    return arrayType(base, None, pos), size
 
+def _get_type(type_, pos):
+    if _ref_count(type_):
+        raise IllegalOperation('reference outside a parameter', pos)
+    return _get_value_type(type_, pos)
+
+def _get_value_type(type_, pos):
+    type_, size = _split_type(type_, pos)
+    if size is not None:
+        raise IllegalOperation('runtime array size', pos)
+    return type_
+
+def _root_sym(tree):
+    # the variable an assignment target starts from
+    while tree.data in ('index_exprn', 'dot_exprn'):
+        tree = tree.children[0]
+    return _get_sym(tree) if tree.data == 'sym' else None
+
+def _may_change(block, sym):
+    # whether a function body may change its parameter sym: by assigning to
+    # it or to an element of it, or by passing it on to something that might
+    for tree in block.iter_subtrees():
+        if tree.data == 'assign' and _root_sym(tree.children[0]) == sym:
+            return True
+        if tree.data == 'func_call' and _get_sym(tree.children[0]) != 'len':
+            for arg in tree.children[1].children:
+                # an element or field of it may be passed on by reference too
+                if isinstance(arg, Tree) and _root_sym(arg) == sym:
+                    return True
+        if tree.data in ('dot_exprn', 'method_call_statement') and tree.children[-1].data == 'func_call' \
+                and _root_sym(tree.children[0]) == sym:
+            # a method that might change the object
+            return True
+        if tree.data in ('mixin_exprn', 'mixin_statement', 'foreign_code'):
+            return True
+    return False
+
+
+def _class_named(tree):
+    # the class an expression is the name of, if it is one
+    if tree.data != 'sym':
+        return None
+    try:
+        type_ = typeFromString(_get_sym(tree), None)
+    except UnrecognizedType:
+        return None
+    return type_ if isinstance(type_, type_sys.Class) else None
 
 def _get_sym_and_type(two_children, pos):
     return TSym(
@@ -25,10 +93,16 @@ def _get_sym_and_type(two_children, pos):
     )
 
 
+def _is_static(tree):
+    # the first child of an if/while/for is its modifier, void or COMPILE_TIME
+    mod = tree.children[0]
+    return isinstance(mod, Token) and mod.type == 'COMPILE_TIME'
+
+
 def add_position_arg(func):
     def wrapper(self, tree):
-        pos = Position(self._fname, tree.line, tree.column, tree.end_line, tree.end_column)
-        func(self, tree, pos)
+        pos = self._tree_pos(tree)
+        return func(self, tree, pos)
     return wrapper
 
 
@@ -57,6 +131,18 @@ class InstructionGenerator(Interpreter):
         self._fname = None
         self._instrn_recorder = _InstructionRecorder()
         self._funcs = []
+        # func_type of each function being generated, innermost last
+        self._func_types = []
+        # the fallthru statement ending the case being generated, if any
+        self._case_fallthru = None
+        # the class whose body is being generated, until a method body starts
+        self._class_body = None
+        # for each class being generated, the name of each of its methods
+        # mapped to whether it is static
+        self._class_methods = []
+        # for each function being generated, (class, is_static) for methods
+        # and None for the rest
+        self._method_of = []
 
     def gen_instrn_tree(self, ast, src_fname):
         self._fname = src_fname
@@ -69,10 +155,14 @@ class InstructionGenerator(Interpreter):
     def functions(self):
         return self._funcs
 
+    def _tree_pos(self, tree):
+        return Position(self._fname, tree.line, tree.column, tree.end_line, tree.end_column)
+
     def _visit_get_instrs(self, tree):
         self._instrn_recorder.push()
-        if len(tree.children):
-            self.visit(tree)
+        # a one statement block is inlined to that statement, which may have
+        # no children of its own (plocal)
+        self.visit(tree)
         instrns = self._instrn_recorder.pop()
         return instrns
 
@@ -174,6 +264,31 @@ class InstructionGenerator(Interpreter):
 
 
 
+    @add_position_arg
+    def array(self, tree, pos):
+        elem_type = _get_type(tree.children[0], pos)
+        exprns = tree.children[1].children if len(tree.children) > 1 else []
+        for exprn in exprns:
+            self.visit(exprn)
+        type_ = arrayType(elem_type, len(exprns), pos)
+        self._instrn_recorder.add_instrn(ArrayLit(type_, len(exprns), pos))
+
+    @add_position_arg
+    def index_exprn(self, tree, pos):
+        self.visit_children(tree)
+        self._instrn_recorder.add_instrn(Index(pos))
+
+    @add_position_arg
+    def dot_exprn(self, tree, pos):
+        obj, member = tree.children
+        if member.data == 'func_call':
+            self._method_call(obj, member, pos)
+            return
+        if member.data != 'sym':
+            raise IllegalOperation('member mixin', pos)
+        self.visit(obj)
+        self._instrn_recorder.add_instrn(Member(_get_sym(member), pos))
+
     @add_position_arg
     def sym(self, tree, pos):
         self._instrn_recorder.add_instrn(Push( _get_sym(tree), pos))
@@ -181,17 +296,26 @@ class InstructionGenerator(Interpreter):
 
     @add_position_arg
     def decl(self, tree, pos):
-        var = _get_sym_and_type(tree.children[0:2], pos)
+        type_, size = _split_type(tree.children[1], pos)
+        var = TSym(_get_sym(tree.children[0]), type_)
+        if isinstance(type_, type_sys.Array):
+            # arrays always start out holding their elements, zeroed
+            size = self._visit_get_instrs(size) if size is not None else Block()
+            self._instrn_recorder.add_instrn(ArrayDecl(var, size, pos))
+            return var
         self._instrn_recorder.add_instrn(Decl( var, pos))
+        return var
 
     @add_position_arg
     def decl_init(self, tree, pos):
         typed_sym = _get_sym_and_type(tree.children[0:2], pos)
-        exprn = tree.children[2]
+        exprn = self._visit_get_instrs(tree.children[2])
         self._instrn_recorder.add_instrn(Decl( typed_sym, pos ))
         self._instrn_recorder.add_instrn(Push( typed_sym.sym, pos))
-        self.visit(exprn)
+        for instrn in exprn:
+            self._instrn_recorder.add_instrn(instrn)
         self._instrn_recorder.add_instrn(Assign(pos))
+        return typed_sym, exprn
 
 
 # '''
@@ -220,24 +344,79 @@ class InstructionGenerator(Interpreter):
 
 # '''
 
-    @add_position_arg
-    def if_statement(self, tree, pos):
-        # children[0] is void
+    def _if_elif(self, tree, pos):
         cond = self._visit_get_instrs(tree.children[1])
         ifBlk = self._visit_get_instrs(tree.children[2])
-        elseBlk = self._visit_get_instrs(tree.children[3])
+        elseBlk = self._visit_get_instrs(tree.children[3]) if len(tree.children) >= 4 else Block()
+
+        if _is_static(tree):
+            self._instrn_recorder.add_instrn(StaticIfElse(cond, ifBlk, elseBlk, pos))
+        else:
+            self._instrn_recorder.add_instrn(IfElse(cond, ifBlk, elseBlk, pos))
 
-        self._instrn_recorder.add_instrn(IfElse(cond, ifBlk, elseBlk, pos))
+    @add_position_arg
+    def if_statement(self, tree, pos):
+        self._if_elif(tree, pos)
 
     @add_position_arg
     def elif_statement(self, tree, pos):
-        cond = self._visit_get_instrs(tree.children[1])
-        ifBlk = self._visit_get_instrs(tree.children[2])
-        elseBlk = self._visit_get_instrs(tree.children[3]) if len(tree.children) >= 4 else Block()
+        self._if_elif(tree, pos)
+
+    @add_position_arg
+    def static_if_elif(self, tree, pos):
+        self._if_elif(tree, pos)
+
+    @add_position_arg
+    def global_static_if_elif(self, tree, pos):
+        self._if_elif(tree, pos)
 
-        self._instrn_recorder.add_instrn(IfElse(cond, ifBlk, elseBlk, pos))
 
 
+    @add_position_arg
+    def switch_statement(self, tree, pos):
+        exprn = self._visit_get_instrs(tree.children[0])
+        # a one case body is inlined to the case
+        body = tree.children[1]
+        items = body.children if body.data == 'block' else [body]
+
+        cases = []
+        for item in items:
+            if item.data != 'case_statement':
+                raise IllegalOperation('statement outside a case', pos)
+            case = self._case(item)
+            if any(c.value == case.value for c in cases):
+                raise IllegalOperation('duplicate case {}'.format(case.value), pos)
+            cases.append(case)
+        self._instrn_recorder.add_instrn(Switch(exprn, cases, pos))
+
+    def _case(self, tree):
+        pos = self._tree_pos(tree)
+        label = tree.children[0]
+        if label.data != 'integer':
+            raise IllegalOperation('non constant case', pos)
+        value = int(RValue.fromString(str(label.children[0]), Int(), pos).value())
+
+        body = tree.children[1]
+        stmts = body.children if body.data == 'block' else [body]
+        fallthru = bool(stmts) and stmts[-1].data == 'fallthru_statement'
+        outer_fallthru = self._case_fallthru
+        self._case_fallthru = stmts[-1] if fallthru else None
+        try:
+            blk = self._visit_get_instrs(body)
+        finally:
+            self._case_fallthru = outer_fallthru
+        # the body gets a scope even when empty
+        blk.uid = pos
+        return Case(value, blk, fallthru)
+
+    @add_position_arg
+    def case_statement(self, tree, pos):
+        raise IllegalOperation('case outside a switch', pos)
+
+    @add_position_arg
+    def fallthru_statement(self, tree, pos):
+        if tree is not self._case_fallthru:
+            raise IllegalOperation('fallthru before the end of a case', pos)
 
     # @add_position_arg
     # def if_elif(self, tree, pos):
@@ -268,25 +447,89 @@ class InstructionGenerator(Interpreter):
         whileloop = WhileLoop(cond, loop, pos)
         self._instrn_recorder.add_instrn(whileloop)
 
+    def _static_while_loop(self, tree, pos, splice):
+        cond = self._visit_get_instrs(tree.children[1])
+        loop = self._visit_get_instrs(tree.children[2])
+        self._instrn_recorder.add_instrn(StaticWhileLoop(cond, loop, splice, pos))
+
+    @add_position_arg
+    def static_while_loop(self, tree, pos):
+        self._static_while_loop(tree, pos, False)
+
+    @add_position_arg
+    def global_static_while_loop(self, tree, pos):
+        self._static_while_loop(tree, pos, True)
+
+    def _for_parts(self, tree, pos):
+        # children[0] is the modifier
+        decl = tree.children[1]
+        sym = _get_sym(decl.children[0])
+        if decl.children[1].children:
+            type_ = _get_type(decl.children[1], pos)
+        else:
+            type_ = Int()
+
+        bounds = [self._visit_get_instrs(exprn) for exprn in tree.children[2].children]
+        if len(bounds) == 1:
+            bounds.insert(0, Block())
+        if len(bounds) == 2:
+            bounds.append(Block())
+        start, stop, step = bounds
+
+        loop = self._visit_get_instrs(tree.children[3])
+        # the loop variable lives in the body's scope, which must exist even if empty
+        loop.uid = self._tree_pos(decl)
+
+        return TSym(sym, type_), start, stop, step, loop
+
+    @add_position_arg
+    def for_loop(self, tree, pos):
+        self._instrn_recorder.add_instrn(ForRange(*self._for_parts(tree, pos), pos))
+
+    @add_position_arg
+    def static_for_loop(self, tree, pos):
+        self._instrn_recorder.add_instrn(StaticForRange(*self._for_parts(tree, pos), False, pos))
+
+    @add_position_arg
+    def global_static_for_loop(self, tree, pos):
+        self._instrn_recorder.add_instrn(StaticForRange(*self._for_parts(tree, pos), True, pos))
+
     @add_position_arg
     def func(self, tree, pos):
 
-        modifier_list = tree.children[0] # not implemented yet
+        modifiers = {m.data for m in tree.children[0].children}
         func_type = tree.children[1]
         sym = tree.children[2]
         rtn_type = tree.children[3]
         treeArgList = tree.children[4]
         block = tree.children[5]
 
-        func_type = func_type.data # not implemented yet
+        func_type = func_type.data
+        is_iter = func_type == 'it'
+
+        owner = self._class_body
+        if owner is None and modifiers:
+            raise IllegalOperation('{} outside a class'.format(' '.join(sorted(modifiers))), pos)
+        if modifiers == {'static', 'virtual'}:
+            raise IllegalOperation('static virtual', pos)
+        if owner is not None and is_iter:
+            raise IllegalOperation('iterator method', pos)
+        is_static = 'static' in modifiers
 
         #  get args
         treeArgList = treeArgList.children
         argTSyms = []
         argTypes = []
         for item in treeArgList:
-            argTSyms.append(_get_sym_and_type(item.children, pos))
-            argTypes.append(_get_type(item.children[1], pos))
+            arg_sym = _get_sym(item.children[0])
+            arg_type = _get_value_type(item.children[1], pos)
+            refs = _ref_count(item.children[1])
+            if refs > 1:
+                raise IllegalOperation('reference to a reference', pos)
+            if refs:
+                arg_type = Ref(arg_type, not _may_change(block, arg_sym))
+            argTSyms.append(TSym(arg_sym, arg_type))
+            argTypes.append(arg_type)
 
 
         # get sym and rtn type
@@ -294,29 +537,59 @@ class InstructionGenerator(Interpreter):
         # rtn_type = _get_type(tree.children[2], pos)
         rtn_type = _get_type(rtn_type, pos)
 
-        # init type
+        # init type, an it function returns an iterator over its rtn type
+        if is_iter:
+            rtn_type = Iterator(rtn_type)
         type_ = type_sys.Function(argTypes, rtn_type)
 
         # get block instructions
         # block = tree.children[3]
-        block = self._visit_get_instrs(block)
-
-        # make sure we end with a Rtn
-        if not block or not isinstance(block[-1], Rtn):
+        self._func_types.append(func_type)
+        self._method_of.append((owner, is_static) if owner is not None else None)
+        self._class_body = None
+        try:
+            block = self._visit_get_instrs(block)
+        finally:
+            self._func_types.pop()
+            self._method_of.pop()
+            self._class_body = owner
+
+        # make sure we end with a Rtn, iterators just run off the end and
+        # foreign code returns by itself
+        if not is_iter and (not block or not isinstance(block[-1], (Rtn, Foreign))):
             block += [Rtn([], pos)]
 
         # a function is a symbol, an arglist, and a block of code
         typed_sym = TSym(sym, type_)
-        func = Func(typed_sym, argTSyms, block, pos)
+        func = Func(typed_sym, argTSyms, block, pos, is_iter, 'virtual' in modifiers, is_static)
         typed_func = RValue(func, type_)
 
-        self._instrn_recorder.add_instrn(InitFunc(typed_sym, typed_func, pos))
+        init_func = InitFunc(typed_sym, typed_func, pos)
+        self._instrn_recorder.add_instrn(init_func)
+        return init_func
 
     @add_position_arg
     def func_call(self, tree, pos):
         sym = _get_sym(tree.children[0])
         callArgs = tree.children[1].children
+        if sym == 'len' and len(callArgs) == 1:
+            # builtin
+            self.visit(callArgs[0])
+            self._instrn_recorder.add_instrn(Len(pos))
+            return
         argInstrs = [self._visit_get_instrs(exprn) for exprn in callArgs]
+        method_of = self._method_of[-1] if self._method_of else None
+        if method_of and sym in self._class_methods[-1]:
+            # a method of the class the calling method belongs to
+            owner, in_static = method_of
+            if self._class_methods[-1][sym]:
+                call = MethodCall(None, sym, argInstrs, pos, owner)
+            elif in_static:
+                raise IllegalOperation('method call without an object', pos)
+            else:
+                call = MethodCall(Block([PushSelf(owner, pos)]), sym, argInstrs, pos)
+            self._instrn_recorder.add_instrn(call)
+            return
         self._instrn_recorder.add_instrn(Call(sym, argInstrs, pos))
 
 
@@ -325,13 +598,48 @@ class InstructionGenerator(Interpreter):
         self.visit_children(tree)
         self._instrn_recorder.add_instrn(Pop(pos))
 
+    @add_position_arg
+    def method_call_statement(self, tree, pos):
+        self._method_call(*tree.children, pos)
+        self._instrn_recorder.add_instrn(Pop(pos))
+
+    def _method_call(self, obj, call, pos):
+        sym = _get_sym(call.children[0])
+        args = [self._visit_get_instrs(exprn) for exprn in call.children[1].children]
+        cls = _class_named(obj)
+        if cls is not None:
+            self._instrn_recorder.add_instrn(MethodCall(None, sym, args, pos, cls))
+        else:
+            self._instrn_recorder.add_instrn(MethodCall(self._visit_get_instrs(obj), sym, args, pos))
+
     @add_position_arg
     def rtn(self, tree, pos):
         exprn = []
         if len(tree.children):
             exprn = self._visit_get_instrs(tree.children[0])
+        if self._in_iter():
+            if exprn:
+                raise IllegalOperation('return with a value from an iterator', pos)
+            self._instrn_recorder.add_instrn(EndIter(pos))
+            return
         self._instrn_recorder.add_instrn(Rtn(exprn, pos))
 
+    def _in_iter(self):
+        return bool(self._func_types) and self._func_types[-1] == 'it'
+
+    @add_position_arg
+    def yield_statement(self, tree, pos):
+        if not self._in_iter():
+            raise IllegalOperation('yield outside an iterator', pos)
+        exprn = self._visit_get_instrs(tree.children[0])
+        self._instrn_recorder.add_instrn(Yield(exprn, pos))
+
+    @add_position_arg
+    def foreign_code(self, tree, pos):
+        lang = _get_sym(tree.children[0])
+        code = str(tree.children[1])[3:-3]
+        self._instrn_recorder.add_instrn(Foreign(lang, code, pos))
+
     @add_position_arg
     def mixin_exprn(self, tree, pos):
         exprn = self._visit_get_instrs(tree.children[0])
@@ -346,31 +654,76 @@ class InstructionGenerator(Interpreter):
     @add_position_arg
     def class_decl(self, tree, pos):
         sym = _get_sym(tree.children[0])
-        contents = self._visit_get_instrs(tree.children[1])
-
-        uid = contents.uid
-
-        type_ = type_sys.Class(sym, uid)
-
-        # new type
-        regNewType(sym, type_)
+        base = None
+        if len(tree.children) == 3:
+            base = typeFromString(_get_sym(tree.children[1]), pos)
+            if not isinstance(base, type_sys.Class):
+                raise IllegalOperation('deriving from {}'.format(base), pos)
+
+        # registered up front so methods can take and return the class, its
+        # uid is only known once the contents are
+        type_ = type_sys.Class(sym, None, base)
+        regNewType(sym, type_, pos)
+
+        methods = {name: f.is_static for name, f in base.decl.vtable.items()} if base else {}
+        for item in tree.children[-1].children:
+            if item.data == 'func':
+                methods[_get_sym(item.children[2])] = any(m.data == 'static' for m in item.children[0].children)
+
+        self._class_methods.append(methods)
+        self._class_body = type_
+        try:
+            self._instrn_recorder.push()
+            fields, inits, methods = self.visit(tree.children[-1])
+            contents = self._instrn_recorder.pop()
+        finally:
+            self._class_methods.pop()
+            self._class_body = None
+        if not contents:
+            contents.uid = pos
+        type_.uid = contents.uid
+
+        for instrn in contents:
+            if isinstance(instrn, ArrayDecl) and instrn.size:
+                raise IllegalOperation('runtime sized array field', instrn.pos)
+            if isinstance(instrn, (Decl, ArrayDecl)):
+                if instrn.typed_sym.type == type_:
+                    raise IllegalOperation('field of its own class', instrn.pos)
+                if base and instrn.typed_sym.sym in base.decl.layout.offsets:
+                    raise IllegalOperation('field hiding one of {}'.format(base.name), instrn.pos)
+            if isinstance(instrn, InitFunc) and base:
+                self._check_override(instrn.typed_func.value(), base.decl.vtable)
 
-        # make init function
+        # ClassDecl registers init function
         tsym = TSym(sym, type_)
-        # arg_list = []
-        # preUsrInit = Block( [ObjectInit(type_, pos)] )
-        # rtn = Rtn(rtn_exprn, pos)
-        # init_block = Block([rtn])
-
-        # init_func = Func(tsym, arg_list, init_block, pos)
-        # t_init_func = RValue(init_func, type_)
+        type_.decl = ClassDecl(tsym,  contents, fields, inits, methods, pos)
+        self._instrn_recorder.add_instrn(type_.decl)
 
-        # ClassDecl registers init function
-        self._instrn_recorder.add_instrn(ClassDecl(tsym,  contents, pos))
+    def _check_override(self, func, vtable):
+        # a method with the name of a virtual one it inherits overrides it
+        base_func = vtable.get(func.typed_sym.sym)
+        if base_func is None or not base_func.is_virtual:
+            return
+        if func.is_static or func.typed_sym.type != base_func.typed_sym.type:
+            raise IllegalOperation('override of {} that changes its signature'.format(func.typed_sym.sym),
+                                   func.pos)
+        func.is_virtual = True
 
     @add_position_arg
     def class_content(self, tree, pos):
-        self.visit_children(tree)
+        # the typed syms of the fields, (typed sym, exprn) for each field that
+        # has an initializer, and the InitFuncs of the methods
+        fields, inits, methods = [], [], []
+        for item in tree.children:
+            member = self.visit(item)
+            if item.data == 'decl':
+                fields.append(member)
+            elif item.data == 'decl_init':
+                fields.append(member[0])
+                inits.append(member)
+            else:
+                methods.append(member)
+        return fields, inits, methods
 
     @add_position_arg
     def plocal(self, tree, pos):
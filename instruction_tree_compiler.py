@@ -1,14 +1,79 @@
-from exceptions import MixinException, ReadUninitializedValue
-from type_system import Void
-from typed_data import TFrag
+import re
+import textwrap
+import ropes
+from fixedint import MutableInt32
+from exceptions import (ArrayLengthMismatch, IllegalOperation, IndexOutOfRange, MixinException,
+                        ReadUninitializedValue, SymbolNotFound, TypeMismatchException, UnrollLimitExceeded)
+from instructions import BinOp, Call, Compute, EndIter, Index, Member, Push, Pushi, Rtn, UnaryOp
+from type_system import Array, Class, Div, Int, Iterator, Ref, String, Void, strip_ref, typeSystem
+from typed_data import RValue, TFrag, TSym
 from context import TYPE, VALUE
 from instruction_tree_visitor import InstrnTreePrinter, InstrnTreeVisitor
+from ir import Const, Load
+from diagnostics import DEBUG
+
+# helpers for array values, emitted ahead of the program
+_PRELUDE = '''
+template<class T, std::size_t N>
+std::vector<T> to_vector(const std::array<T, N>& a){
+    return std::vector<T>(a.begin(), a.end());
+}
+template<class Seq>
+std::ostream& print_seq(std::ostream& out, const Seq& seq){
+    out << "{";
+    for(std::size_t i = 0; i < seq.size(); i++){
+        out << (i ? ", " : "") << seq[i];
+    }
+    return out << "}";
+}
+template<class T>
+std::ostream& operator<<(std::ostream& out, const std::vector<T>& v){
+    return print_seq(out, v);
+}
+template<class T, std::size_t N>
+std::ostream& operator<<(std::ostream& out, const std::array<T, N>& a){
+    return print_seq(out, a);
+}
+[[noreturn]] void fail(const std::string& msg){
+    std::cerr << msg << std::endl;
+    std::exit(1);
+}
+template<class Seq>
+auto& checked_index(Seq&& seq, int i, const std::string& before, const std::string& between, const std::string& after){
+    if(i < 0 || static_cast<std::size_t>(i) >= seq.size()){
+        fail(before + std::to_string(i) + between + std::to_string(seq.size()) + after);
+    }
+    return seq[i];
+}
+inline int floor_div(int a, int b){
+    int q = a / b;
+    return (a % b != 0 && (a < 0) != (b < 0)) ? q - 1 : q;
+}'''.strip().split('\n')
 
 def _indent(strlist, n):
     for i in range(len(strlist)):
         strlist[i] = n*'    ' + strlist[i]
     return strlist
 
+# instructions that only compute a value, a block made of these can be
+# emitted as a single C++ expression
+_PURE_EXPRN_INSTRNS = (Push, Pushi, BinOp, UnaryOp, Compute)
+
+def _is_pure_exprn(blk):
+    return all(isinstance(instrn, _PURE_EXPRN_INSTRNS) for instrn in blk)
+
+# static loops unrolling to more iterations than this are assumed not to terminate
+STATIC_UNROLL_LIMIT = 10000
+
+# fragments that can be repeated without evaluating anything
+_SIMPLE_REPR = re.compile(r'[\w.]+')
+
+# ${sym} in foreign code, replaced by the C++ name of sym
+_FOREIGN_SYM = re.compile(r'\$\{(\w+)\}')
+
+def _is_int_literal(blk):
+    return len(blk) == 1 and isinstance(blk[0], Pushi) and isinstance(blk[0].value.type, Int)
+
 
 class InstrnTreeCompiler(InstrnTreeVisitor):
     def __init__(self, vm, ctx, call_stack, compiler):
@@ -20,6 +85,14 @@ class InstrnTreeCompiler(InstrnTreeVisitor):
         self._code = []
         self._num_indents = 0
         self._tmp_counters = {}
+        # when set, BinOp yields a parenthesised expression instead of a tmp
+        self._inline_exprns = False
+        # the return variable of each for over an iterator being emitted, the
+        # loop body is a lambda so returns inside it go through these
+        self._iter_bodies = []
+        # numbers the results of inlined calls, they are assigned from
+        # inside blocks that may have tmps of the same number
+        self._inline_cnt = 0
 
     def _next_tmp(self):
         scope_uid = self.ctx.cur_scope_uid()
@@ -33,24 +106,89 @@ class InstrnTreeCompiler(InstrnTreeVisitor):
             code = [code]
         self._code += _indent(code, self._num_indents)
 
+    def _add_check(self, cond, error):
+        # where the interpreter raises error, the C++ stops with its message
+        self._add_code('if({}){{ fail({}); }}'.format(cond, typeSystem.value_cpp_repr(str(error), String())))
+
 
     def compile_tree(self, instrn_blk):
+        self._add_code('#include <algorithm>')
+        self._add_code('#include <cstdlib>')
         self._add_code('#include <iostream>')
         self._add_code('#include <string>')
+        self._add_code('#include <vector>')
+        self._add_code('#include <array>')
+        self._add_code('#include <functional>')
+        self._add_code(list(_PRELUDE))
         self.visit_blk(instrn_blk)
         code = self._code
         self._code = []
         return code
 
+    def _coerce(self, frag, type_):
+        # a std::array where a std::vector is expected
+        if isinstance(type_, Array) and type_.size is None and frag.type.size is not None:
+            return TFrag('to_vector({})'.format(frag.repr), type_)
+        return frag
+
     def visit_Assign(self, assign):
         right = self.vm.comp_pop()
         left = self.vm.comp_pop()
         left.checkAssignOkay(right, assign.pos)
+        right = self._coerce(right, left.type)
         self._add_code( '{} = {};'.format(left.repr, right.repr))
 
+    def visit_ArrayDecl(self, decl):
+        tsym = decl.typed_sym
+        if decl.size:
+            self.visit_blk(decl.size)
+            size = self.vm.comp_pop()
+            if not isinstance(size.type, Int):
+                raise TypeMismatchException(Int(), size.type, decl.pos)
+            code = '{} {}({});'.format(tsym.type_repr, tsym.sym, size.repr)
+        else:
+            code = '{} {}{{}};'.format(tsym.type_repr, tsym.sym)
+        self.ctx.declare_symbol(tsym, decl.pos)
+        self._add_code(code)
+
+    def visit_ArrayLit(self, lit):
+        elem_type = lit.type.elem
+        elems = [self.vm.comp_pop() for _ in range(lit.n)]
+        elems.reverse()
+        reprs = []
+        for elem in elems:
+            elem.checkCanAssignTo(elem_type, lit.pos)
+            if elem.type != elem_type:
+                reprs.append('static_cast<{}>({})'.format(elem_type.repr, elem.repr))
+            else:
+                reprs.append(elem.repr)
+        self.vm.comp_push(TFrag('{}{{{}}}'.format(lit.type.repr, ', '.join(reprs)), lit.type))
+
+    def _pop_array(self, pos):
+        array = self.vm.comp_pop()
+        if not isinstance(array.type, Array):
+            raise IllegalOperation('index', pos)
+        return array
+
+    def visit_Index(self, index):
+        i = self.vm.comp_pop()
+        if not isinstance(i.type, Int):
+            raise TypeMismatchException(Int(), i.type, index.pos)
+        array = self._pop_array(index.pos)
+        # the message of the interpreter's error, around the index and length
+        parts = [typeSystem.value_cpp_repr(part, String())
+                 for part in str(IndexOutOfRange('{}', '{}', index.pos)).split('{}')]
+        self.vm.comp_push(TFrag('checked_index({}, {}, {})'.format(array.repr, i.repr, ', '.join(parts)), array.type.elem))
+
+    def visit_Len(self, len_):
+        array = self._pop_array(len_.pos)
+        self.vm.comp_push(TFrag('static_cast<int>({}.size())'.format(array.repr), Int()))
+
     def visit_Decl(self, decl):
         tsym = decl.typed_sym
         self.ctx.declare_symbol(tsym, decl.pos)
+        if decl.tmp:
+            self.ctx.cur_scope.tmp_syms.add(tsym.sym)
         self._add_code( '{} {};'.format(tsym.type_repr, tsym.sym))
 
     def visit_Push(self, push):
@@ -65,31 +203,114 @@ class InstrnTreeCompiler(InstrnTreeVisitor):
 
 
     def visit_Pop(self, pop):
-        self.vm.comp_pop()
-
+        # the value of a call statement, the call itself still has to run
+        frag = self.vm.comp_pop()
+        if not _SIMPLE_REPR.fullmatch(frag.repr):
+            self._add_code(frag.repr + ';')
 
-    def visit_BinOp(self, binop):
-        right = self.vm.comp_pop()
-        left = self.vm.comp_pop()
-        # res_type = op_res_type(binop.op, left.type, right.type, binop.pos)
-        res_type = left.opResType(binop.op, right, binop.pos)
 
+    def _bind(self, frag):
+        if _SIMPLE_REPR.fullmatch(frag.repr):
+            return frag
         tmp_name = 'tmp_{}'.format(self._next_tmp())
-        self.vm.comp_push(TFrag(tmp_name, res_type))
+        self._add_code('const auto& {} = {};'.format(tmp_name, frag.repr))
+        return TFrag(tmp_name, frag.type)
+
+    def _check_lengths(self, left, right, pos):
+        # the lengths are only known when running, the message is put together there
+        if left.type.size is not None and left.type.size == right.type.size:
+            return
+        l, r = left.repr + '.size()', right.repr + '.size()'
+        parts = [typeSystem.value_cpp_repr(part, String())
+                 for part in str(ArrayLengthMismatch('{}', '{}', pos)).split('{}')]
+        msg = 'std::string({}) + std::to_string(std::min({l}, {r})) + {} + std::to_string(std::max({l}, {r})) + {}'
+        self._add_code('if({} != {}){{ fail({}); }}'.format(l, r, msg.format(*parts, l=l, r=r)))
+
+    def _check_divisor(self, divisor, pos):
+        if isinstance(divisor.type, Array):
+            cond = 'std::find({d}.begin(), {d}.end(), 0) != {d}.end()'.format(d=divisor.repr)
+        else:
+            cond = '{} == 0'.format(divisor.repr)
+        self._add_check(cond, IllegalOperation('division by zero', pos))
+
+    def _elementwise(self, res_type, operands, elem_code, pos, divide=False):
+        # a loop filling a new array, elem_code(*elems) is the code for one
+        # element given the code for the operands' elements. when divide is
+        # set the last operand is checked for zeros first.
+        operands = [self._bind(frag) for frag in operands]
+        arrays = [frag for frag in operands if isinstance(frag.type, Array)]
+        if len(arrays) == 2:
+            self._check_lengths(*arrays, pos)
+        if divide:
+            self._check_divisor(operands[-1], pos)
+        array = arrays[0]
+        tmp_name = 'tmp_{}'.format(self._next_tmp())
+        if res_type.size is None:
+            self._add_code('{} {}({}.size());'.format(res_type.repr, tmp_name, array.repr))
+        else:
+            self._add_code('{} {};'.format(res_type.repr, tmp_name))
+
+        counter = 'for_{}'.format(self._next_tmp())
+        elems = [frag.repr + '[' + counter + ']' if isinstance(frag.type, Array) else frag.repr
+                 for frag in operands]
+        self._add_code('for(std::size_t {c} = 0; {c} < {}.size(); {c}++){{'.format(tmp_name, c=counter))
+        self._add_code(_indent(['{}[{}] = {};'.format(tmp_name, counter, elem_code(*elems))], 1))
+        self._add_code('}')
+        return TFrag(tmp_name, res_type)
+
+    def _binop(self, op, left, right, pos):
+        # res_type = op_res_type(op, left.type, right.type, pos)
+        res_type = left.opResType(op, right, pos)
+
+        if isinstance(res_type, Array):
+            if isinstance(op, Div) and isinstance(res_type.elem, Int):
+                # rounding down, as the interpreter divides arrays
+                return self._elementwise(res_type, (left, right), 'floor_div({}, {})'.format, pos, divide=True)
+            divide = isinstance(op, Div)
+            op = op.repr
+            return self._elementwise(res_type, (left, right), lambda l, r: '{} {} {}'.format(l, op, r), pos,
+                                     divide=divide)
+
+        if self._inline_exprns:
+            return TFrag('({} {} {})'.format(left.repr, op.repr, right.repr), res_type)
 
+        tmp_name = 'tmp_{}'.format(self._next_tmp())
         code = '{} {} = {} {} {};'.format(  res_type.repr,
                                             tmp_name,
                                             left.repr,
-                                            binop.op.repr,
+                                            op.repr,
                                             right.repr)
         self._add_code( code)
+        return TFrag(tmp_name, res_type)
 
+    def _unaryop(self, op, operand, pos):
+        if isinstance(operand.type, Array):
+            res_type = typeSystem.unary_op_res_type(op, operand.type, pos)
+            op = op.repr
+            return self._elementwise(res_type, (operand,), lambda elem: op + elem, pos)
+        return operand.unaryOpRes(op, self.ctx, pos)
 
+    def visit_BinOp(self, binop):
+        right = self.vm.comp_pop()
+        left = self.vm.comp_pop()
+        self.vm.comp_push(self._binop(binop.op, left, right, binop.pos))
 
     def visit_UnaryOp(self, unaryop):
         operand = self.vm.comp_pop()
-        res = operand.unaryOpRes(unaryop.op, self.ctx, unaryop.pos)
-        self.vm.comp_push(res)
+        self.vm.comp_push(self._unaryop(unaryop.op, operand, unaryop.pos))
+
+    def visit_Compute(self, compute):
+        regs = []
+        for op in compute.ops:
+            if op.__class__ is Load:
+                regs.append(TFrag(op.sym, op.type))
+            elif op.__class__ is Const:
+                regs.append(op.value.tfrag())
+            elif len(op.args) == 2:
+                regs.append(self._binop(op.op, regs[op.args[0]], regs[op.args[1]], op.pos))
+            else:
+                regs.append(self._unaryop(op.op, regs[op.args[0]], op.pos))
+        self.vm.comp_push(regs[-1])
 
 
     def visit_IfElse(self, ifelse):
@@ -114,7 +335,36 @@ class InstrnTreeCompiler(InstrnTreeVisitor):
 
 
 
+    def visit_Switch(self, switch):
+        self.visit_blk(switch.exprn)
+        value = self.vm.comp_pop()
+        if not isinstance(value.type, Int):
+            raise TypeMismatchException(Int(), value.type, switch.pos)
+
+        self._add_code('switch({}){{'.format(value.repr))
+        for case in switch.cases:
+            self._add_code('case {}: {{'.format(case.value))
+            with self.ctx.enter_scope(case.body.uid):
+                self._num_indents += 1
+                self.visit_blk(case.body)
+                if not case.fallthru and not (case.body and isinstance(case.body[-1], (Rtn, EndIter))):
+                    self._add_code('break;')
+                self._num_indents -= 1
+            self._add_code('}')
+        self._add_code('}')
+
     def visit_WhileLoop(self, whileloop):
+        if _is_pure_exprn(whileloop.condBlk):
+            self._inline_exprns = True
+            self.visit_blk(whileloop.condBlk)
+            self._inline_exprns = False
+            self._add_code('while({}){{'.format(self.vm.comp_pop().repr))
+            with self.ctx.enter_scope(whileloop.loop.uid):
+                self._num_indents += 1
+                self.visit_blk(whileloop.loop)
+                self._num_indents -= 1
+            self._add_code('}')
+            return
 
         self._add_code('while(1){')
         self._num_indents += 1
@@ -122,12 +372,186 @@ class InstrnTreeCompiler(InstrnTreeVisitor):
         self._add_code('if(!(' + str(self.vm.comp_pop().repr) +')){')
         self._add_code(_indent(['break;'], 1))
         self._add_code('}')
+        # the condition's tmps belong to the enclosing scope, keep the body's apart
+        self._add_code('{')
         with self.ctx.enter_scope(whileloop.loop.uid):
+            self._num_indents += 1
             self.visit_blk(whileloop.loop)
+            self._num_indents -= 1
+        self._add_code('}')
+        self._num_indents -= 1
+        self._add_code('}')
+
+
+
+    def _iter_call(self, for_range):
+        # the call making the iterator a for loop runs over, if it has one
+        if for_range.start or for_range.step or len(for_range.stop) != 1:
+            return None
+        call = for_range.stop[0]
+        if not isinstance(call, Call):
+            return None
+        func_type = self.ctx.read(call.func_sym, TYPE, call.pos)
+        if not isinstance(func_type.rtnType, Iterator):
+            return None
+        return call
+
+    def visit_ForRange(self, for_range):
+        call = self._iter_call(for_range)
+        if call is not None:
+            self._iter_for(for_range, call)
+            return
+        if not isinstance(for_range.typed_sym.type, Int):
+            raise TypeMismatchException(Int(), for_range.typed_sym.type, for_range.pos)
+
+        # python range semantics: bounds evaluated once, and the loop variable
+        # is a copy of a hidden counter so assigning to it can't skip values
+        bounds = []
+        for blk, default in ((for_range.start, '0'), (for_range.stop, None), (for_range.step, '1')):
+            if not blk:
+                bounds.append(default)
+                continue
+            self.visit_blk(blk)
+            bound = self.vm.comp_pop()
+            if not isinstance(bound.type, Int):
+                raise TypeMismatchException(Int(), bound.type, for_range.pos)
+            if not (len(blk) == 1 and isinstance(blk[0], Pushi)):
+                tmp_name = 'tmp_{}'.format(self._next_tmp())
+                self._add_code('int {} = {};'.format(tmp_name, bound.repr))
+                bound = TFrag(tmp_name, bound.type)
+            bounds.append(bound.repr)
+        start, stop, step = bounds
+        if for_range.step and (not _is_int_literal(for_range.step) or not int(step)):
+            self._add_check('{} == 0'.format(step), IllegalOperation('zero step for', for_range.pos))
+
+        counter = 'for_{}'.format(self._next_tmp())
+        if for_range.step and not _is_int_literal(for_range.step):
+            cond = '({s} > 0 ? {c} < {e} : {c} > {e})'.format(s=step, c=counter, e=stop)
+        elif int(step) < 0:
+            cond = '{} > {}'.format(counter, stop)
+        else:
+            cond = '{} < {}'.format(counter, stop)
+        self._add_code('for(int {c} = {}; {}; {c} += {}){{'.format(start, cond, step, c=counter))
+
+        tsym = for_range.typed_sym
+        with self.ctx.enter_scope(for_range.loop.uid):
+            self.ctx.declare_symbol(tsym, for_range.pos)
+            self._num_indents += 1
+            self._add_code('{} {} = {};'.format(tsym.type_repr, tsym.sym, counter))
+            self.visit_blk(for_range.loop)
+            self._num_indents -= 1
+        self._add_code('}')
+
+    def _iter_for(self, for_range, call):
+        # the generator calls the body back with each value, the body returns
+        # true to stop it early
+        func_type = self.ctx.read(call.func_sym, TYPE, call.pos)
+        elem_type = func_type.rtnType.elem
+        tsym = for_range.typed_sym
+        typeSystem.check_assign_okay(tsym.type, elem_type, for_range.pos)
+        args = self._call_args(call, func_type)
+
+        n = self._next_tmp()
+        stop, rtn, value = 'stop_{}'.format(n), 'rtn_{}'.format(n), 'value_{}'.format(n)
+        rtn_type = self._rtn_cpp_type()
+        if rtn_type != 'void':
+            self._add_code('{} {};'.format(rtn_type, rtn))
+        else:
+            rtn = None
+        self._add_code('bool {} = {}({}[&]({} {}) -> bool {{'.format(
+            stop, call.func_sym, args + ', ' if args else '', elem_type.repr, value))
+
+        self._iter_bodies.append(rtn)
+        with self.ctx.enter_scope(for_range.loop.uid):
+            self.ctx.declare_symbol(tsym, for_range.pos)
+            self._num_indents += 1
+            self._add_code('{} {} = {};'.format(tsym.type_repr, tsym.sym, value))
+            self.visit_blk(for_range.loop)
+            self._add_code('return false;')
+            self._num_indents -= 1
+        self._iter_bodies.pop()
+        self._add_code('});')
+
+        self._add_code('if({}){{'.format(stop))
+        self._num_indents += 1
+        self._emit_return(rtn)
         self._num_indents -= 1
         self._add_code('}')
 
+    def _rtn_cpp_type(self):
+        func = self.call_stack.peek()
+        return 'bool' if func.is_iter else func.rtn_type.repr
+
+    def _emit_return(self, repr):
+        # repr is None for a void return. Inside the body of a for over an
+        # iterator the value is stored for after the loop and the loop stopped.
+        if self._iter_bodies:
+            rtn = self._iter_bodies[-1]
+            if repr is not None:
+                self._add_code('{} = {};'.format(rtn, repr))
+            self._add_code('return true;')
+        else:
+            self._add_code('return {};'.format('' if repr is None else repr))
+
+    def _run_static(self, blk, pos, read=None):
+        # evaluates blk with the compile time interpreter and returns what
+        # read makes of the result on the vm, by default whether it is true.
+        # Values are only looked up when read, so it is tried here too.
+        try:
+            self.compiler.run_exprn_tree(blk, pos)
+            if read is None:
+                return self.vm.run_pop().value(self.ctx, pos)
+            return read()
+        except ReadUninitializedValue as e:
+            raise MixinException(e.sym, e.pos)
+
+    def visit_StaticIfElse(self, ifelse):
+        if self._run_static(ifelse.condBlk, ifelse.pos):
+            self.visit_blk(ifelse.ifBlk)
+        else:
+            self.visit_blk(ifelse.elseBlk)
+
+    def _unroll(self, loop, tsym=None, value=None):
+        # one iteration of a static loop. Spliced loops run in the enclosing
+        # scope, others get a C++ block per iteration.
+        if loop.splice:
+            if tsym:
+                self.ctx.assign_value(tsym.sym, value, loop.pos)
+            self.visit_blk(loop.loop)
+            return
+
+        self._add_code('{')
+        with self.ctx.enter_scope(loop.loop.uid):
+            self._num_indents += 1
+            if tsym:
+                self.ctx.init_symbol(tsym, value, loop.pos)
+                self._add_code('{} {} = {};'.format(tsym.type_repr, tsym.sym, value.repr))
+            self.visit_blk(loop.loop)
+            self._num_indents -= 1
+        self._add_code('}')
 
+    def visit_StaticWhileLoop(self, whileloop):
+        count = 0
+        while True:
+            if not self._run_static(whileloop.condBlk, whileloop.pos):
+                break
+            count += 1
+            if count > STATIC_UNROLL_LIMIT:
+                raise UnrollLimitExceeded(STATIC_UNROLL_LIMIT, whileloop.pos)
+            self._unroll(whileloop)
+
+    def visit_StaticForRange(self, for_range):
+        values = self._run_static(for_range.bounds, for_range.pos,
+                                  lambda: self.compiler.tree_runner.pop_range(for_range))
+        if len(values) > STATIC_UNROLL_LIMIT:
+            raise UnrollLimitExceeded(STATIC_UNROLL_LIMIT, for_range.pos)
+
+        tsym = for_range.typed_sym
+        if for_range.splice:
+            # the loop variable only exists at compile time
+            self.ctx.cur_scope.insert(tsym.sym, TYPE, tsym.type)
+        for value in values:
+            self._unroll(for_range, tsym, RValue(MutableInt32(value), tsym.type))
 
     def visit_InitFunc(self, init_func):
         self.ctx.init_symbol(init_func.typed_sym, init_func.typed_func, init_func.pos)
@@ -135,41 +559,121 @@ class InstrnTreeCompiler(InstrnTreeVisitor):
         func = init_func.typed_func.value(self.ctx, init_func.pos)
         with self.call_stack.push(func), self.ctx.enter_scope(func.instrns.uid):
             for arg in func.args:
-                self.ctx.declare_symbol(arg, func.pos)
-
-            arg_list = ', '.join(
-                ('{} {}'.format(a.type_repr, a.string)
-                for a in func.args)
-                )
-            self._add_code('{} {}({}){{'.format(func.typed_sym.type.rtnType.repr,
-                                                func.typed_sym.sym,
-                                                arg_list))
+                self.ctx.declare_symbol(TSym(arg.sym, strip_ref(arg.type)), func.pos)
+
+            args = ['{} {}'.format(a.type_repr, a.string) for a in func.args]
+            if func.is_iter:
+                # returns true when the consumer stopped it
+                args.append('const std::function<bool({})>& yield_'.format(func.rtn_type.elem.repr))
+            modifier = 'virtual ' if func.is_virtual else 'static ' if func.is_static else ''
+            self._add_code('{}{} {}({}){{'.format(modifier,
+                                                  self._rtn_cpp_type(),
+                                                  func.typed_sym.sym,
+                                                  ', '.join(args)))
             self._num_indents += 1
             self.visit_blk(func.instrns)
+            if func.is_iter:
+                self._add_code('return false;')
             self._num_indents -= 1
             self._add_code('}')
 
 
 
 
-    def visit_Call(self, call):
+    def _call_args(self, call, func_type):
         arg_code = ''
-        for arg_exprn in call.arg_exprns:
+        for arg_exprn, arg_type in zip(call.arg_exprns, func_type.argTypes):
             self.visit_blk(arg_exprn)
-            arg_code += (', '  if arg_code else '') + self.vm.comp_pop().repr
+            arg = self.vm.comp_pop()
+            if isinstance(arg_type, Ref):
+                if not arg_type.const:
+                    # only a variable, element or field of the exact type binds to T&
+                    if not (arg_exprn and isinstance(arg_exprn[-1], (Push, Index, Member))):
+                        raise IllegalOperation('temporary passed to a mutable reference', call.pos)
+                    if arg.type != arg_type.target and not (isinstance(arg.type, Class)
+                                                            and arg.type.derives(arg_type.target)):
+                        raise TypeMismatchException(arg_type.target, arg.type, call.pos)
+                arg_type = arg_type.target
+            arg = self._coerce(arg, arg_type)
+            arg_code += (', '  if arg_code else '') + arg.repr
+        return arg_code
 
-        call_code = '{}({})'.format(call.func_sym, arg_code)
-        type_ = self.ctx.read(call.func_sym, TYPE, call.pos).rtnType
+    def visit_Call(self, call):
+        func_type = self.ctx.read(call.func_sym, TYPE, call.pos)
+        if isinstance(func_type, Class):
+            if call.arg_exprns:
+                raise IllegalOperation('constructor arguments', call.pos)
+            self.vm.comp_push(TFrag('{}{{}}'.format(func_type.name), func_type))
+            return
+        type_ = func_type.rtnType
+        if isinstance(type_, Iterator):
+            raise IllegalOperation('iterator outside a for loop', call.pos)
+
+        call_code = '{}({})'.format(call.func_sym, self._call_args(call, func_type))
         self.vm.comp_push(TFrag(call_code, type_))
 
 
+    def visit_Inline(self, inline):
+        # the copied body goes in a block of its own, after the arguments are
+        # bound to its params, and stores its value in a variable outside it
+        args = []
+        for arg_exprn, param in zip(inline.arg_exprns, inline.params):
+            self.visit_blk(arg_exprn)
+            arg = self.vm.comp_pop()
+            arg.checkCanAssignTo(param.type, inline.pos)
+            args.append(self._coerce(arg, param.type))
+
+        result = 'inl_{}'.format(self._inline_cnt)
+        self._inline_cnt += 1
+        self._add_code('{} {};'.format(typeSystem.type_cpp_repr(inline.rtn_type), result))
+        self._add_code('{')
+        with self.ctx.enter_scope(inline.body.uid):
+            self._num_indents += 1
+            for param, arg in zip(inline.params, args):
+                self.ctx.declare_symbol(param, inline.pos)
+                self._add_code('{} {} = {};'.format(param.type_repr, param.sym, arg.repr))
+            self.visit_blk(inline.body)
+            value = self.vm.comp_pop()
+            value.checkCanAssignTo(inline.rtn_type, inline.pos)
+            self._add_code('{} = {};'.format(result, self._coerce(value, inline.rtn_type).repr))
+            self._num_indents -= 1
+        self._add_code('}')
+        self.vm.comp_push(TFrag(result, inline.rtn_type))
+
     def visit_Rtn(self, rtn):
         rtnVal = TFrag('', Void())
         if rtn.exprn:
             self.visit_blk(rtn.exprn)
             rtnVal = self.vm.comp_pop()
         self.call_stack.checkRtnTypeOkay(rtnVal, rtn.pos)
-        self._add_code( 'return {};'.format(rtnVal.repr))
+        rtnVal = self._coerce(rtnVal, self.call_stack.peek().rtn_type)
+        self._emit_return(rtnVal.repr if rtn.exprn else None)
+
+    def visit_Yield(self, yield_):
+        self.visit_blk(yield_.exprn)
+        value = self.vm.comp_pop()
+        elem_type = self.call_stack.peek().rtn_type.elem
+        value.checkCanAssignTo(elem_type, yield_.pos)
+        self._add_code('if(yield_({})){{'.format(self._coerce(value, elem_type).repr))
+        self._num_indents += 1
+        self._emit_return('true')
+        self._num_indents -= 1
+        self._add_code('}')
+
+    def visit_EndIter(self, end):
+        self._emit_return('false')
+
+    def visit_Foreign(self, foreign):
+        if foreign.lang != 'cpp':
+            raise IllegalOperation('foreign({}) code'.format(foreign.lang), foreign.pos)
+
+        def cpp_name(match):
+            # the symbol has to be visible here
+            self.ctx.read(match.group(1), TYPE, foreign.pos)
+            return match.group(1)
+
+        code = _FOREIGN_SYM.sub(cpp_name, textwrap.dedent(foreign.code).strip('\n'))
+        self._add_code(code.split('\n'))
 
     def visit_Mixin(self, mixin):
         self.compiler.run_exprn_tree(mixin.exprn, mixin.pos)
@@ -184,15 +688,91 @@ class InstrnTreeCompiler(InstrnTreeVisitor):
     def visit_MixinStatements(self, mixin):
         self.compiler.run_exprn_tree(mixin.statements, mixin.pos)
         s = self.vm.run_pop()
-        s = s.value(self.ctx, mixin.pos) +';'
+        s = ropes.materialize(s.value(self.ctx, mixin.pos)) + ';'
         sub_tree = self.compiler.compile_statements(s, mixin.pos)
-        InstrnTreePrinter().start(sub_tree)
+        self.compiler.diag.dump(DEBUG, 'mixin_instrn_tree',
+                                lambda out: InstrnTreePrinter(out).start(sub_tree))
         self.visit_blk(sub_tree)
 
 
+    def visit_ClassDecl(self, class_decl):
+        # a struct whose fields are value initialized, so Foo{} zeroes what
+        # has no initializer, and a printer for plocal
+        ctx = self.ctx
+        ctx.init_symbol(class_decl.t_sym, RValue(class_decl, class_decl.type), class_decl.pos)
+        name = class_decl.t_sym.sym
+        if class_decl.base:
+            self._add_code('struct {} : {} {{'.format(name, class_decl.base.t_sym.sym))
+        else:
+            self._add_code('struct {} {{'.format(name))
+        self._num_indents += 1
+        with ctx.enter_scope(class_decl.uid):
+            for tsym in class_decl.fields:
+                ctx.declare_symbol(tsym, class_decl.pos)
+            inits = {tsym.sym: self._field_init(tsym, exprn) for tsym, exprn in class_decl.own_inits}
+            for tsym in class_decl.own_fields:
+                self._add_code('{} {}{};'.format(tsym.type_repr, tsym.sym, inits.get(tsym.sym, '{}')))
+            for method in class_decl.methods:
+                self.visit_InitFunc(method)
+        self._num_indents -= 1
+        self._add_code('};')
+
+        fields = ' << ", " << '.join('o.' + tsym.sym for tsym in class_decl.fields)
+        self._add_code('std::ostream& operator<<(std::ostream& out, const {}& o){{'.format(name))
+        self._add_code(_indent(['return out << "{" << ' + fields + ' << "}";' if fields
+                                else 'return out << "{}";'], 1))
+        self._add_code('}')
+
+    def _field_init(self, tsym, exprn):
+        # the default member initializer of a field, it has to be a single expression
+        code, self._code = self._code, []
+        inline, self._inline_exprns = self._inline_exprns, True
+        try:
+            self.visit_blk(exprn)
+            value = self.vm.comp_pop()
+        finally:
+            statements, self._code = self._code, code
+            self._inline_exprns = inline
+        if statements:
+            raise IllegalOperation('field initializer that needs statements', exprn.pos)
+        value.checkCanAssignTo(tsym.type, exprn.pos)
+        return ' = ' + self._coerce(value, tsym.type).repr
+
+    def visit_MethodCall(self, call):
+        if call.obj_exprn is None:
+            decl = call.cls.decl
+            prefix = call.cls.name + '::'
+        else:
+            self.visit_blk(call.obj_exprn)
+            obj = self.vm.comp_pop()
+            if not isinstance(obj.type, Class):
+                raise IllegalOperation('method call on {}'.format(obj.type), call.pos)
+            decl = obj.type.decl
+            prefix = obj.repr + '.'
+        func = decl.vtable.get(call.method_sym)
+        if func is None:
+            raise SymbolNotFound(call.method_sym, call.pos)
+        if call.obj_exprn is None and not func.is_static:
+            raise IllegalOperation('method call without an object', call.pos)
+        code = '{}{}({})'.format(prefix, call.method_sym, self._call_args(call, func.typed_sym.type))
+        self.vm.comp_push(TFrag(code, func.rtn_type))
+
+    def visit_PushSelf(self, push):
+        self.vm.comp_push(TFrag('(*this)', push.type))
+
+    def visit_Member(self, member):
+        obj = self.vm.comp_pop()
+        if not isinstance(obj.type, Class):
+            raise IllegalOperation('member of {}'.format(obj.type), member.pos)
+        scope = self.ctx.scope(obj.type.uid)
+        if member.sym not in scope:
+            raise SymbolNotFound(member.sym, member.pos)
+        type_ = scope.read(member.sym, TYPE, member.pos)
+        self.vm.comp_push(TFrag('{}.{}'.format(obj.repr, member.sym), type_))
+
     def visit_PLocal(self, plocal):
-        inner_tbl = self.ctx.cur_scope.symbol_tbl._tbl
-        syms = sorted(inner_tbl.keys())
+        scope = self.ctx.cur_scope
+        syms = sorted(sym for sym in scope.symbol_tbl._tbl if sym not in scope.tmp_syms)
         self._add_code('std::cout << "vvvvv PLocal vvvvv" << std::endl;')
         for sym in syms:
             type_ = self.ctx.read(sym, TYPE, plocal.pos)
@@ -1,22 +1,443 @@
 from instructions import ClassDecl
-from type_system import Void
-from exceptions import RtnException
-from typed_data import LValue, RValue
+import objects
+import ropes
+from fixedint import MutableInt32
+from type_system import Array, Class, Int, Iterator, Ref, Void, strip_ref, typeSystem
+from exceptions import (CallDepthExceeded, ForeignCodeUnavailable, IllegalOperation, IndexOutOfRange,
+                        ReadUninitializedValue, RtnException, SymbolNotFound, TypeMismatchException)
+from typed_data import ElemLValue, FieldLValue, FieldValues, LValue, RefSlot, RValue, VarSlot
 from context import TYPE, VALUE
 from instruction_tree_visitor import InstrnTreeVisitor
+from ir import Load, Op
+
+DEFAULT_MAX_CALL_DEPTH = 10000
+
+# classes of object a method call site remembers before it stops caching
+POLYMORPHIC_CACHE_SIZE = 4
+
+
+# The runner keeps .lang control flow on an explicit stack of frames rather
+# than the python stack. A frame is a cursor into a block; when the cursor
+# runs off the end the frame is popped and its done() hook decides what
+# happens next. unwind() is called instead when a return or an exception
+# skips the rest of the block.
+
+class _Frame:
+    __slots__ = ('blk', 'i')
+
+    def __init__(self, blk):
+        self.blk = blk
+        self.i = 0
+
+    def done(self, runner):
+        pass
+
+    def unwind(self, runner):
+        pass
+
+
+class _ScopeFrame(_Frame):
+    __slots__ = ()
+
+    def done(self, runner):
+        runner.ctx.pop_scope()
+
+    unwind = done
+
+
+class _CaseFrame(_Frame):
+    # the body of one case of a switch, moves on to the next case's body
+    # when it falls through
+    __slots__ = ('switch', 'case_i')
+
+    def __init__(self, switch, case_i):
+        super().__init__(switch.cases[case_i].body)
+        self.switch = switch
+        self.case_i = case_i
+
+    def done(self, runner):
+        runner.ctx.pop_scope()
+        cases = self.switch.cases
+        if cases[self.case_i].fallthru and self.case_i + 1 < len(cases):
+            runner._enter_case(self.switch, self.case_i + 1)
+
+    def unwind(self, runner):
+        runner.ctx.pop_scope()
+
+
+class _ExprnFrame(_Frame):
+    # evaluates blk, then hands instrn to then() with the result on the vm
+    __slots__ = ('instrn', 'then')
+
+    def __init__(self, blk, instrn, then):
+        super().__init__(blk)
+        self.instrn = instrn
+        self.then = then
+
+    def done(self, runner):
+        self.then(self.instrn)
+
+
+class _WhileFrame(_Frame):
+    # alternates between the condition and the body of the loop. The body's
+    # scope is looked up once and its values are cleared in place between
+    # iterations, the condition is evaluated in the enclosing scope.
+    __slots__ = ('loop', 'in_body', 'scope', 'outer')
+
+    def __init__(self, loop, scope, outer):
+        super().__init__(loop.condBlk)
+        self.loop = loop
+        self.in_body = False
+        self.scope = scope
+        self.outer = outer
+
+    def _leave_body(self, ctx):
+        values = self.scope.symbol_values
+        if values and not self.scope.persists and self.scope is not self.outer:
+            values.clear()
+        ctx.switch_scope(self.outer)
+        self.in_body = False
+
+    def done(self, runner):
+        loop = self.loop
+        ctx = runner.ctx
+        if self.in_body:
+            self._leave_body(ctx)
+            self.blk = loop.condBlk
+        else:
+            if not runner.vm.run_pop().value(ctx, loop.pos):
+                return
+            ctx.switch_scope(self.scope)
+            self.in_body = True
+            self.blk = loop.loop
+        self.i = 0
+        runner._frames.append(self)
+
+    def unwind(self, runner):
+        if self.in_body:
+            self._leave_body(runner.ctx)
+
+
+class _ForRangeFrame(_Frame):
+    # runs the body once per value of a python range, the loop variable is a
+    # slot in the body's scope that is overwritten each iteration
+    __slots__ = ('values', 'sym', 'int_type', 'scope', 'outer', 'persists')
+
+    def __init__(self, for_range, it, scope, outer):
+        super().__init__(for_range.loop)
+        self.values = it
+        self.sym = for_range.typed_sym.sym
+        self.int_type = for_range.typed_sym.type
+        self.scope = scope
+        self.outer = outer
+        # a spliced loop runs in the enclosing scope, which must keep its values
+        self.persists = scope.persists or scope is outer
+
+    def next(self, ctx, frames):
+        for value in self.values:
+            break
+        else:
+            return
+        ctx.switch_scope(self.scope)
+        self.scope.symbol_values[self.sym] = RValue(MutableInt32(value), self.int_type)
+        self.i = 0
+        frames.append(self)
+
+    def done(self, runner):
+        self.unwind(runner)
+        self.next(runner.ctx, runner._frames)
+
+    def unwind(self, runner):
+        if not self.persists:
+            self.scope.symbol_values.clear()
+        runner.ctx.switch_scope(self.outer)
+
+
+class _Generator:
+    # a suspended activation of an it function: the frames it was running,
+    # its values and its scope stack, all off the runner while it waits
+    __slots__ = ('func', 'scope', 'values', 'frames', 'scopes', 'mark', 'finished')
+
+    def __init__(self, func, scope, values):
+        self.func = func
+        self.scope = scope
+        self.values = values
+        self.frames = [_GenFrame(func.instrns, self)]
+        self.scopes = (scope, [])
+        self.mark = None
+        self.finished = False
+
+
+class _GenFrame(_Frame):
+    # the bottom frame of a running generator, a yield suspends everything
+    # from here up
+    __slots__ = ('gen',)
+
+    def __init__(self, blk, gen):
+        super().__init__(blk)
+        self.gen = gen
+
+    def done(self, runner):
+        runner._suspend(self.gen, [])
+        self.gen.finished = True
+
+    unwind = done
+
+
+class _IterFrame(_Frame):
+    # a for loop over an iterator. Waits on an empty block while the
+    # generator runs above it, then runs the body with the yielded value.
+    __slots__ = ('gen', 'sym', 'type', 'loop', 'scope', 'outer', 'persists', 'in_body')
+
+    def __init__(self, for_range, gen, scope, outer):
+        super().__init__(())
+        self.gen = gen
+        self.sym = for_range.typed_sym.sym
+        self.type = for_range.typed_sym.type
+        self.loop = for_range.loop
+        self.scope = scope
+        self.outer = outer
+        self.persists = scope.persists or scope is outer
+        self.in_body = False
+
+    def next(self, runner):
+        self.blk = ()
+        self.i = 0
+        runner._frames.append(self)
+        runner._resume(self.gen)
+
+    def done(self, runner):
+        if self.in_body:
+            self.unwind(runner)
+            self.next(runner)
+            return
+        if self.gen.finished:
+            return
+        value = runner.vm.run_pop()
+        if value.type != self.type:
+            value = RValue(typeSystem.assign(self.type, value.type, value.value(), None), self.type)
+        runner.ctx.switch_scope(self.scope)
+        self.scope.symbol_values[self.sym] = value
+        self.in_body = True
+        self.blk = self.loop
+        self.i = 0
+        runner._frames.append(self)
+
+    def unwind(self, runner):
+        if self.in_body:
+            if not self.persists:
+                self.scope.symbol_values.clear()
+            runner.ctx.switch_scope(self.outer)
+            self.in_body = False
+
+
+class _ArgsFrame(_Frame):
+    # evaluates each argument expression of a call in turn, then hands the
+    # call to then()
+    __slots__ = ('exprns', 'call', 'then', 'arg_i')
+
+    def __init__(self, exprns, call, then):
+        super().__init__(exprns[0])
+        self.exprns = exprns
+        self.call = call
+        self.then = then
+        self.arg_i = 0
+
+    def done(self, runner):
+        self.arg_i += 1
+        if self.arg_i < len(self.exprns):
+            self.blk = self.exprns[self.arg_i]
+            self.i = 0
+            runner._frames.append(self)
+        else:
+            self.then(self.call)
+
+
+class _ObjectInitFrame(_Frame):
+    # runs the field initializers of a new object one after another, in its
+    # class's scope with the object's fields standing in for the scope's values
+    __slots__ = ('inits', 'init_i', 'obj', 'scope', 'saved')
+
+    def __init__(self, inits, obj, scope):
+        super().__init__(inits[0][1])
+        self.inits = inits
+        self.init_i = 0
+        self.obj = obj
+        self.scope = scope
+        self.saved = scope.symbol_values
+        scope.symbol_values = FieldValues(obj)
+
+    def done(self, runner):
+        tsym, exprn = self.inits[self.init_i]
+        layout = self.obj.layout
+        FieldLValue(self.obj, layout.offsets[tsym.sym], tsym.type).assign(runner.vm.run_pop(),
+                                                                           runner.ctx, exprn.pos)
+        self.init_i += 1
+        if self.init_i < len(self.inits):
+            self.blk = self.inits[self.init_i][1]
+            self.i = 0
+            runner._frames.append(self)
+        else:
+            self.unwind(runner)
+
+    def unwind(self, runner):
+        self.scope.symbol_values = self.saved
+        runner.ctx.pop_scope()
+
+
+class _FuncFrame(_Frame):
+    __slots__ = ('saved',)
+
+    def __init__(self, blk, saved):
+        super().__init__(blk)
+        self.saved = saved
+
+    def done(self, runner):
+        runner.ctx.pop_call_scope(self.saved)
+        runner.call_stack.pop()
+
+    unwind = done
+
+
+class _InlineFrame(_Frame):
+    # the body of an inlined call, done with its result on top of the vm
+    __slots__ = ('inline',)
+
+    def __init__(self, inline):
+        super().__init__(inline.body)
+        self.inline = inline
+
+    def done(self, runner):
+        inline = self.inline
+        result = runner.vm.run_pop().rvalue(runner.ctx, inline.pos)
+        typeSystem.check_assign_okay(inline.rtn_type, result.type, inline.pos)
+        runner.ctx.pop_scope()
+        runner.vm.run_push(result)
+
+    def unwind(self, runner):
+        runner.ctx.pop_scope()
+
+
+class _MemoFrame(_FuncFrame):
+    # the body of a memoized function, its result is remembered when it returns
+    __slots__ = ('memo', 'key')
+
+    def __init__(self, blk, saved, memo, key):
+        super().__init__(blk, saved)
+        self.memo = memo
+        self.key = key
+
+
+class _MethodFrame(_FuncFrame):
+    # the body of a method, the fields of its object stand in for the values
+    # of the class's scope until it returns
+    __slots__ = ('class_scope', 'class_values')
+
+    def __init__(self, blk, saved, class_scope, class_values):
+        super().__init__(blk, saved)
+        self.class_scope = class_scope
+        self.class_values = class_values
+
+    def done(self, runner):
+        self.class_scope.symbol_values = self.class_values
+        _FuncFrame.done(self, runner)
+
+    unwind = done
+
+
+class _CallSiteCache:
+    # what a Call resolved to, valid while ctx.epoch is unchanged
+    __slots__ = ('epoch', 'class_decl', 'func', 'scope', 'arg_plan')
+
+    def __init__(self, epoch, class_decl=None, func=None, scope=None, arg_plan=None):
+        self.epoch = epoch
+        self.class_decl = class_decl
+        self.func = func
+        self.scope = scope
+        # (sym, type) per argument, in the order they come off the vm
+        self.arg_plan = arg_plan
+
+
+class _MethodCacheEntry:
+    # what a method call resolved to for objects of one layout
+    __slots__ = ('layout', 'func', 'scope', 'class_scope', 'arg_plan')
+
+    def __init__(self, layout, func, scope, arg_plan):
+        self.layout = layout
+        self.func = func
+        self.scope = scope
+        self.class_scope = scope.parent
+        self.arg_plan = arg_plan
 
 
 class InstrnTreeRunner(InstrnTreeVisitor):
-    def __init__(self, vm, ctx, call_stack, compiler):
+    def __init__(self, vm, ctx, call_stack, compiler, max_call_depth=DEFAULT_MAX_CALL_DEPTH):
         super().__init__()
         self.vm = vm
         self.ctx = ctx
         self.call_stack = call_stack
         self.compiler = compiler
+        self.max_call_depth = max_call_depth
+        self._frames = []
+        self._handlers = {}
+        # function name -> calls made, when counting them
+        self.call_counts = None
 
 
+    def _handler(self, instrn_type):
+        method = getattr(self, 'visit_' + instrn_type.__name__, self.visit_children)
+        self._handlers[instrn_type] = method
+        return method
+
     def run(self, instrn_blk):
-        self.visit_blk(instrn_blk)
+        # run() is re-entered by mixins, base marks where this run's frames start
+        frames = self._frames
+        handlers = self._handlers
+        base = len(frames)
+        frames.append(_Frame(instrn_blk))
+        try:
+            while len(frames) > base:
+                try:
+                    frame = frames[-1]
+                    i = frame.i
+                    if i < len(frame.blk):
+                        frame.i = i + 1
+                        instrn = frame.blk[i]
+                        try:
+                            handler = handlers[instrn.__class__]
+                        except KeyError:
+                            handler = self._handler(instrn.__class__)
+                        handler(instrn)
+                    else:
+                        frames.pop()
+                        frame.done(self)
+                except RtnException:
+                    self._return(base)
+        except BaseException:
+            self._unwind(base)
+            raise
+
+    def visit_blk(self, blk):
+        self.run(blk)
+
+    def _return(self, base):
+        frames = self._frames
+        while len(frames) > base:
+            frame = frames.pop()
+            frame.unwind(self)
+            if frame.__class__ is _FuncFrame or frame.__class__ is _MethodFrame \
+                    or frame.__class__ is _GenFrame:
+                return
+            if frame.__class__ is _MemoFrame:
+                frame.memo.put(frame.key, self.vm.run_peek())
+                return
+        # the function was called from an enclosing run()
+        raise RtnException()
+
+    def _unwind(self, base):
+        frames = self._frames
+        while len(frames) > base:
+            frames.pop().unwind(self)
 
 
     def visit_Assign(self, assign):
@@ -26,6 +447,51 @@ class InstrnTreeRunner(InstrnTreeVisitor):
 
     def visit_Decl(self, decl):
         self.ctx.declare_symbol(decl.typed_sym, decl.pos)
+        if decl.tmp:
+            self.ctx.cur_scope.tmp_syms.add(decl.typed_sym.sym)
+
+    def visit_ArrayDecl(self, decl):
+        if decl.size:
+            self._frames.append(_ExprnFrame(decl.size, decl, self._do_array_decl))
+        else:
+            self._do_array_decl(decl)
+
+    def _do_array_decl(self, decl):
+        type_ = decl.typed_sym.type
+        if decl.size:
+            n = self._pop_int(decl.pos)
+            if n < 0:
+                raise IllegalOperation('negative size array', decl.pos)
+        else:
+            n = type_.size or 0
+        self.ctx.init_symbol(decl.typed_sym, RValue(typeSystem.zero_array(type_, n), type_), decl.pos)
+
+    def visit_ArrayLit(self, lit):
+        elem_type = lit.type.elem
+        values = []
+        for _ in range(lit.n):
+            value = self.vm.run_pop().rvalue(self.ctx, lit.pos)
+            values.append(typeSystem.assign(elem_type, value.type, value.value(), lit.pos))
+        values.reverse()
+        self.vm.run_push(RValue(typeSystem.make_array(lit.type, values), lit.type))
+
+    def _pop_array(self, pos):
+        value = self.vm.run_pop().rvalue(self.ctx, pos)
+        if not isinstance(value.type, Array):
+            raise IllegalOperation('index', pos)
+        return value
+
+    def visit_Index(self, index):
+        i = self._pop_int(index.pos)
+        array = self._pop_array(index.pos)
+        buf = array.value()
+        if not 0 <= i < len(buf):
+            raise IndexOutOfRange(i, len(buf), index.pos)
+        self.vm.run_push(ElemLValue(buf, i, array.type.elem))
+
+    def visit_Len(self, len_):
+        array = self._pop_array(len_.pos)
+        self.vm.run_push(RValue(MutableInt32(len(array.value())), Int()))
 
     def visit_Push(self, push):
         l_value = LValue(
@@ -52,106 +518,450 @@ class InstrnTreeRunner(InstrnTreeVisitor):
         operand = self.vm.run_pop()
         self.vm.run_push(operand.unaryOpRes(unaryop.op, self.ctx, unaryop.pos))
 
+    def visit_Compute(self, compute):
+        ctx = self.ctx
+        regs = compute.regs
+        i = 0
+        for op in compute.ops:
+            cls = op.__class__
+            if cls is Op:
+                args = op.args
+                if len(args) == 2:
+                    regs[i] = op.fn(regs[args[0]], regs[args[1]])
+                else:
+                    regs[i] = op.fn(regs[args[0]])
+            elif cls is Load:
+                try:
+                    value = op.scope.symbol_values[op.sym]
+                except KeyError:
+                    raise ReadUninitializedValue(op.sym, op.pos)
+                regs[i] = op.unbox(value.rvalue(ctx, op.pos).value())
+            else:
+                regs[i] = op.raw
+            i += 1
+        type_ = compute.type
+        result = regs[-1]
+        self.vm.run_push(RValue(MutableInt32(result) if type_.__class__ is Int else result, type_))
+
     def visit_IfElse(self, ifelse):
-        self.run(ifelse.condBlk)
+        self._frames.append(_ExprnFrame(ifelse.condBlk, ifelse, self._do_if))
+
+    def _do_if(self, ifelse):
         cond = self.vm.run_pop().value(self.ctx, ifelse.pos)
-        if cond:
-            with self.ctx.enter_scope(ifelse.ifBlk.uid):
-                self.run(ifelse.ifBlk)
-        else:
-            with self.ctx.enter_scope(ifelse.elseBlk.uid):
-                self.run(ifelse.elseBlk)
+        blk = ifelse.ifBlk if cond else ifelse.elseBlk
+        self.ctx.push_scope(blk.uid)
+        self._frames.append(_ScopeFrame(blk))
+
+    def visit_Switch(self, switch):
+        self._frames.append(_ExprnFrame(switch.exprn, switch, self._do_switch))
 
+    def _do_switch(self, switch):
+        case_i = switch.table.get(self._pop_int(switch.pos))
+        if case_i is not None:
+            self._enter_case(switch, case_i)
+
+    def _enter_case(self, switch, case_i):
+        self.ctx.push_scope(switch.cases[case_i].body.uid)
+        self._frames.append(_CaseFrame(switch, case_i))
+
+    # static constructs run like the dynamic ones, only the compiler unrolls them
+
+    def visit_StaticIfElse(self, ifelse):
+        self._frames.append(_ExprnFrame(ifelse.condBlk, ifelse, self._do_static_if))
+
+    def _do_static_if(self, ifelse):
+        cond = self.vm.run_pop().value(self.ctx, ifelse.pos)
+        self._frames.append(_Frame(ifelse.ifBlk if cond else ifelse.elseBlk))
+
+    def _loop_scope(self, loop):
+        if loop.splice:
+            return self.ctx.cur_scope
+        return self.ctx.scope(loop.loop.uid)
 
     def visit_WhileLoop(self, while_loop):
-        while True:
-            self.run(while_loop.condBlk)
-            cond = self.vm.run_pop()
-            if not cond.value(self.ctx, while_loop.pos):
-                break
-            with self.ctx.enter_scope(while_loop.loop.uid):
-                self.run(while_loop.loop)
+        ctx = self.ctx
+        scope = self._loop_scope(while_loop)
+        self._frames.append(_WhileFrame(while_loop, scope, ctx.cur_scope))
+
+    visit_StaticWhileLoop = visit_WhileLoop
+
+
+    def _pop_int(self, pos):
+        value = self.vm.run_pop().rvalue(self.ctx, pos)
+        if not isinstance(value.type, Int):
+            raise TypeMismatchException(Int(), value.type, pos)
+        return int(value.value())
+
+    def visit_ForRange(self, for_range):
+        self._frames.append(_ExprnFrame(for_range.bounds, for_range, self._do_for_range))
+
+    visit_StaticForRange = visit_ForRange
+
+    def pop_range(self, for_range):
+        # the evaluated bounds of for_range, as a python range
+        if not isinstance(for_range.typed_sym.type, Int):
+            raise TypeMismatchException(Int(), for_range.typed_sym.type, for_range.pos)
+        step = self._pop_int(for_range.pos) if for_range.step else 1
+        stop = self._pop_int(for_range.pos)
+        start = self._pop_int(for_range.pos) if for_range.start else 0
+        if not step:
+            raise IllegalOperation('zero step for', for_range.pos)
+        return range(start, stop, step)
+
+    def _do_for_range(self, for_range):
+        ctx = self.ctx
+        tsym = for_range.typed_sym
+        gen = None
+        if not for_range.start and not for_range.step \
+                and isinstance(self.vm.run_peek().type, Iterator):
+            iterator = self.vm.run_pop()
+            typeSystem.check_assign_okay(tsym.type, iterator.type.elem, for_range.pos)
+            gen = iterator.value(ctx, for_range.pos)
+        else:
+            it = iter(self.pop_range(for_range))
 
+        scope = self._loop_scope(for_range)
+        scope.insert(tsym.sym, TYPE, tsym.type)
+        if gen is not None:
+            _IterFrame(for_range, gen, scope, ctx.cur_scope).next(self)
+        else:
+            _ForRangeFrame(for_range, it, scope, ctx.cur_scope).next(ctx, self._frames)
+
+    def _resume(self, gen):
+        # puts gen's frames back on top of the stack, they run until a yield
+        # or the end of the function suspends them again
+        ctx = self.ctx
+        gen.mark = ctx.resume_scopes(gen.scopes)
+        ctx.swap_frame_values(gen.scope, gen.values)
+        self.call_stack.push_func(gen.func)
+        self._frames += gen.frames
+        gen.frames = None
+
+    def _suspend(self, gen, frames):
+        ctx = self.ctx
+        gen.frames = frames
+        ctx.swap_frame_values(gen.scope, gen.values)
+        gen.scopes = ctx.suspend_scopes(gen.mark)
+        self.call_stack.pop()
+
+    def visit_Yield(self, yield_):
+        self._frames.append(_ExprnFrame(yield_.exprn, yield_, self._do_yield))
+
+    def _do_yield(self, yield_):
+        value = self.vm.run_pop().rvalue(self.ctx, yield_.pos)
+        elem_type = self.call_stack.peek().rtn_type.elem
+        if value.type != elem_type:
+            value = RValue(typeSystem.assign(elem_type, value.type, value.value(), yield_.pos), elem_type)
+        frames = self._frames
+        base = len(frames) - 1
+        while frames[base].__class__ is not _GenFrame:
+            base -= 1
+        gen_frames = frames[base:]
+        del frames[base:]
+        self._suspend(gen_frames[0].gen, gen_frames)
+        self.vm.run_push(value)
+
+    def visit_EndIter(self, end):
+        raise RtnException()
 
     def visit_InitFunc(self, init_func):
         self.ctx.init_symbol(init_func.typed_sym, init_func.typed_func, init_func.pos)
 
     def visit_Call(self, call):
-        # Call
-        for instrns in call.arg_exprns:
-            self.run(instrns)
-
-        t_callable = self.ctx.read(call.func_sym, VALUE, call.pos)
-        callable = t_callable.value(self.ctx, call.pos)
+        if call.arg_exprns:
+            self._frames.append(_ArgsFrame(call.arg_exprns, call, self._do_call))
+        else:
+            self._do_call(call)
 
+    def _resolve_call(self, call):
+        ctx = self.ctx
+        ctx.watch(call.func_sym)
+        t_callable = ctx.read(call.func_sym, VALUE, call.pos)
+        callable = t_callable.value(ctx, call.pos)
 
         if isinstance(callable, ClassDecl):
-            self.initObject(callable)
+            cache = _CallSiteCache(ctx.epoch, class_decl=callable)
         else:
-
             func = callable
-            # Func
-            with self.call_stack.push(func), self.ctx.enter_scope(func.instrns.uid):
-                for arg in reversed(func.args):
-                    self.ctx.init_symbol(arg, self.vm.run_pop(), func.pos)
-                try:
-                    self.run(func.instrns)
-                except RtnException as e:
-                    pass
+            scope, arg_plan = self._arg_plan(func)
+            cache = _CallSiteCache(ctx.epoch, func=func, scope=scope, arg_plan=arg_plan)
+        call.cache = cache
+        return cache
+
+    def _do_call(self, call):
+        ctx = self.ctx
+        cache = call.cache
+        if cache is None or cache.epoch != ctx.epoch:
+            cache = self._resolve_call(call)
+
+        if cache.class_decl is not None:
+            if call.arg_exprns:
+                raise IllegalOperation('constructor arguments', call.pos)
+            self.initObject(cache.class_decl)
+            return
+
+        if self.call_stack.depth >= self.max_call_depth:
+            raise CallDepthExceeded(self.max_call_depth, call.pos)
+
+        arg_values = self._pop_args(cache.arg_plan, call.pos)
+
+        func = cache.func
+        if self.call_counts is not None:
+            self._count_call(func.typed_sym.sym)
+        if func.is_iter:
+            # nothing runs until a for loop asks for the first value
+            gen = _Generator(func, cache.scope, {cache.scope: dict(arg_values)})
+            self.vm.run_push(RValue(gen, func.rtn_type))
+            return
+
+        memo = func.memo
+        if memo is not None:
+            key = tuple([typeSystem.to_python(value.value(), value.type) for _, value in arg_values])
+            result = memo.get(key)
+            if result is not None:
+                self.vm.run_push(result)
+                return
+
+        self.call_stack.push_func(func)
+        saved = ctx.push_call_scope(cache.scope)
+        if memo is not None:
+            self._frames.append(_MemoFrame(func.instrns, saved, memo, key))
+        else:
+            self._frames.append(_FuncFrame(func.instrns, saved))
+        values = cache.scope.symbol_values
+        for sym, value in arg_values:
+            values[sym] = value
 
+    def _count_call(self, sym):
+        self.call_counts[sym] = self.call_counts.get(sym, 0) + 1
+
+    def visit_Inline(self, inline):
+        if inline.arg_exprns:
+            self._frames.append(_ArgsFrame(inline.arg_exprns, inline, self._do_inline))
+        else:
+            self._do_inline(inline)
+
+    def _do_inline(self, inline):
+        ctx = self.ctx
+        cache = inline.cache
+        if cache is None:
+            scope = ctx.scope(inline.body.uid)
+            for param in inline.params:
+                scope.insert(param.sym, TYPE, param.type)
+            cache = inline.cache = (scope, [(param.sym, param.type) for param in reversed(inline.params)])
+        if self.call_counts is not None:
+            self._count_call(inline.func_sym)
+        scope, arg_plan = cache
+        arg_values = self._pop_args(arg_plan, inline.pos)
+        ctx.push_scope(inline.body.uid)
+        values = scope.symbol_values
+        for sym, value in arg_values:
+            values[sym] = value
+        self._frames.append(_InlineFrame(inline))
+
+    def _pop_args(self, arg_plan, pos):
+        # resolve args while the caller's scope is still current
+        ctx = self.ctx
+        run_pop = self.vm.run_pop
+        arg_values = []
+        for sym, type_ in arg_plan:
+            if type_.__class__ is Ref:
+                arg_values.append((sym, self._bind_ref(run_pop(), type_, pos)))
+                continue
+            value = run_pop().rvalue(ctx, pos)
+            # arrays and objects are passed by value
+            if value.type.__class__ is not type_.__class__ or value.type != type_ \
+                    or type_.__class__ is Array or type_.__class__ is Class:
+                value = RValue(typeSystem.assign(type_, value.type, value.value(), pos), type_)
+            arg_values.append((sym, value))
+        return arg_values
+
+    def _arg_plan(self, func):
+        scope = self.ctx.scope(func.instrns.uid)
+        for arg in func.args:
+            scope.insert(arg.sym, TYPE, strip_ref(arg.type))
+        return scope, [(arg.sym, arg.type) for arg in reversed(func.args)]
+
+    def visit_MethodCall(self, call):
+        if call.operand_exprns:
+            self._frames.append(_ArgsFrame(call.operand_exprns, call, self._do_method_call))
+        else:
+            self._do_method_call(call)
+
+    def _do_method_call(self, call):
+        pos = call.pos
+        if call.obj_exprn is None:
+            obj = None
+            static_type = call.cls
+            layout = static_type.decl.layout
+        else:
+            recv = self.vm.run_peek(len(call.arg_exprns) + 1)
+            static_type = recv.type
+            if static_type.__class__ is not Class:
+                raise IllegalOperation('method call on {}'.format(static_type), pos)
+            obj = recv.rvalue(self.ctx, pos).value()
+            layout = obj.layout
+
+        # monomorphic sites hit the first entry, polymorphic ones one of the
+        # first few, past that the vtable is looked up every time
+        for entry in call.cache:
+            if entry.layout is layout:
+                break
+        else:
+            entry = self._resolve_method(call, static_type, layout)
+        func = entry.func
+
+        if self.call_stack.depth >= self.max_call_depth:
+            raise CallDepthExceeded(self.max_call_depth, pos)
+        arg_values = self._pop_args(entry.arg_plan, pos)
+        if obj is not None:
+            self.vm.run_pop()
+
+        ctx = self.ctx
+        self.call_stack.push_func(func)
+        saved = ctx.push_call_scope(entry.scope)
+        if func.is_static:
+            self._frames.append(_FuncFrame(func.instrns, saved))
+        else:
+            class_scope = entry.class_scope
+            self._frames.append(_MethodFrame(func.instrns, saved, class_scope, class_scope.symbol_values))
+            class_scope.symbol_values = FieldValues(obj)
+        values = entry.scope.symbol_values
+        for sym, value in arg_values:
+            values[sym] = value
+
+    def _resolve_method(self, call, static_type, layout):
+        # non virtual methods are those of the class the object is known as
+        func = static_type.decl.vtable.get(call.method_sym)
+        if func is None:
+            raise SymbolNotFound(call.method_sym, call.pos)
+        if func.is_virtual:
+            func = layout.vtable[call.method_sym]
+        if call.obj_exprn is None and not func.is_static:
+            raise IllegalOperation('method call without an object', call.pos)
+        scope, arg_plan = self._arg_plan(func)
+        entry = _MethodCacheEntry(layout, func, scope, arg_plan)
+        if len(call.cache) < POLYMORPHIC_CACHE_SIZE:
+            call.cache.append(entry)
+        return entry
+
+    def visit_PushSelf(self, push):
+        obj = self.ctx.scope(push.type.uid).symbol_values.obj
+        self.vm.run_push(RValue(obj, push.type))
+
+
+    def _bind_ref(self, arg, ref, pos):
+        # the value a reference parameter starts with: an alias of the
+        # variable or element passed, or for a const reference to anything
+        # else a value of its own
+        target_type = ref.target
+        if isinstance(arg, LValue):
+            if arg.type == target_type or (arg.type.__class__ is Class and arg.type.derives(target_type)):
+                return RefSlot(self._ref_target(arg, pos))
+            if not ref.const:
+                raise TypeMismatchException(target_type, arg.type, pos)
+        elif not ref.const:
+            raise IllegalOperation('temporary passed to a mutable reference', pos)
+        value = arg.rvalue(self.ctx, pos)
+        if value.type != target_type:
+            value = RValue(typeSystem.assign(target_type, value.type, value.value(), pos), target_type)
+        return value
+
+    def _ref_target(self, lvalue, pos):
+        if lvalue.__class__ is ElemLValue or lvalue.__class__ is FieldLValue:
+            return lvalue
+        values = self.ctx.values_holding(lvalue.sym, lvalue.scope_uid, pos)
+        slot = values.get(lvalue.sym)
+        if slot is not None and slot.aliases:
+            # passing a reference on
+            return slot.target
+        return VarSlot(values, lvalue.sym, lvalue.type)
 
     def visit_Rtn(self, rtn):
         if rtn.exprn:
-            self.run(rtn.exprn)
+            self._frames.append(_ExprnFrame(rtn.exprn, rtn, self._do_rtn))
         else:
             self.vm.run_push(RValue(None, Void()))
+            self._do_rtn(rtn)
+
+    def _do_rtn(self, rtn):
         rtnVal = self.vm.run_pop()
         self.call_stack.checkRtnTypeOkay(rtnVal, rtn.pos)
         self.vm.run_push(rtnVal.rvalue(self.ctx, rtn.pos))
         raise RtnException()
 
 
+    def visit_Foreign(self, foreign):
+        # global foreign code only means something to the C++ backend, in a
+        # function a registered python implementation returns in its place
+        if not self.call_stack.depth:
+            return
+        func = self.call_stack.peek()
+        if func.is_iter:
+            raise IllegalOperation('foreign code in an iterator', foreign.pos)
+        impl = self.compiler.foreign_impls.get(func.typed_sym.sym)
+        if impl is None:
+            raise ForeignCodeUnavailable(func.typed_sym.sym, foreign.pos)
+
+        ctx = self.ctx
+        args = [typeSystem.to_python(ctx.read(arg.sym, VALUE, foreign.pos).value(ctx, foreign.pos), arg.type)
+                for arg in func.args]
+        rtn_type = func.rtn_type
+        self.vm.run_push(RValue(typeSystem.from_python(impl(*args), rtn_type), rtn_type))
+        raise RtnException()
+
     def visit_Mixin(self, mixin):
-        self.run(mixin.exprn)
+        self._frames.append(_ExprnFrame(mixin.exprn, mixin, self._do_mixin))
+
+    def _do_mixin(self, mixin):
         s = self.vm.run_pop()
         self.compiler.run_exprn_code(s.value(self.ctx, mixin.pos), mixin.pos)
 
     def visit_MixinStatements(self, mixin):
-        self.run(mixin.statements)
-        s = self.vm.run_pop()
-        # code = s.value(self.ctx, mixin.pos) + ';'
+        self._frames.append(_ExprnFrame(mixin.statements, mixin, self._do_mixin_statements))
 
-        self.compiler.run_statement_code(s.value(self.ctx, mixin.pos)+';', mixin.pos)
+    def _do_mixin_statements(self, mixin):
+        s = self.vm.run_pop()
+        self.compiler.run_statement_code(ropes.materialize(s.value(self.ctx, mixin.pos)) + ';', mixin.pos)
 
     def visit_ClassDecl(self, class_decl):
-        # with self.ctx.enter_scope(class_decl.contents.uid):
-        #     self.visit_blk(class_decl.contents)
-
-        self.ctx.init_symbol(       class_decl.t_sym,
-                                    RValue(class_decl, class_decl.t_sym.type),
-                                    class_decl.pos)
-
-
-    def initObject(self, classDecl):
-        instance_id = self.ctx.init_obj(classDecl.uid)
-        self.vm.run_push(RValue(instance_id, classDecl.type))
-
-        with self.ctx.enter_scope(instance_id):
-            self.run(classDecl.contents)
-
-
-
-
-
-
-
-    # def visit_ObjectInit(self, obj_init):
-    #     instance_id = self.ctx.init_obj(obj_init.type.uid)
-    #     self.vm.run_push(RValue(instance_id, obj_init.type))
+        ctx = self.ctx
+        ctx.init_symbol(class_decl.t_sym, RValue(class_decl, class_decl.type), class_decl.pos)
+        scope = ctx.scope(class_decl.uid)
+        for tsym in class_decl.fields:
+            scope.insert(tsym.sym, TYPE, tsym.type)
+
+    def visit_Member(self, member):
+        obj = self.vm.run_pop().rvalue(self.ctx, member.pos)
+        if obj.type.__class__ is not Class:
+            raise IllegalOperation('member of {}'.format(obj.type), member.pos)
+        obj = obj.value()
+        layout = obj.layout
+        try:
+            i = layout.offsets[member.sym]
+        except KeyError:
+            raise SymbolNotFound(member.sym, member.pos)
+        self.vm.run_push(FieldLValue(obj, i, layout.types[i]))
+
+    def initObject(self, class_decl):
+        obj = objects.new(class_decl.layout)
+        self._init_fields(class_decl, obj)
+        self.vm.run_push(RValue(obj, class_decl.type))
+
+    def _init_fields(self, class_decl, obj):
+        # queues the initializers of obj and of the objects in its fields,
+        # so that the innermost run first
+        if class_decl.inits:
+            scope = self.ctx.scope(class_decl.uid)
+            self.ctx.push_scope(class_decl.uid)
+            self._frames.append(_ObjectInitFrame(class_decl.inits, obj, scope))
+        layout = obj.layout
+        for i in layout.object_offsets:
+            self._init_fields(layout.types[i].decl, obj.slots[i])
 
     def visit_PLocal(self, plocal):
-        localvar = self.ctx.cur_scope.symbol_values
-        localvar = sorted(localvar.items())
+        scope = self.ctx.cur_scope
+        localvar = sorted((sym, val) for sym, val in scope.symbol_values.items() if sym not in scope.tmp_syms)
         print('vvvvv PLocal vvvvv')
         for sym, val in localvar:
             print('{} ; {} ; {}'.format(sym, val.repr, val.type_repr))
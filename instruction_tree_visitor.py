@@ -23,24 +23,36 @@ class InstrnTreeVisitor:
     def visit_children(self, instrn):
         for name, child_scope in instrn.child_scopes.items():
             self.visit_new_scope(name, child_scope)
+        for name, child_blk in instrn.child_blks.items():
+            self.visit_child_blk(name, child_blk)
 
     def visit_new_scope(self, name, instrn_blk):
         self.visit_blk(instrn_blk)
 
+    def visit_child_blk(self, name, instrn_blk):
+        self.visit_blk(instrn_blk)
+
 
 
 class InstrnTreePrinter(InstrnTreeVisitor):
-    def __init__(self):
+    def __init__(self, out=None):
         super().__init__()
         self.indent = 0
+        self._out = out
 
     def visit_instrn(self, instrn):
-        print('    ' * self.indent + str(instrn))
+        print('    ' * self.indent + str(instrn), file=self._out)
         self.visit_children(instrn)
 
 
     def visit_new_scope(self, name, instrns):
-        print('    ' * self.indent + name)
+        print('    ' * self.indent + name, file=self._out)
+        self.indent += 1
+        self.visit_blk(instrns)
+        self.indent -= 1
+
+    def visit_child_blk(self, name, instrns):
+        print('    ' * self.indent + name + ' (spliced)', file=self._out)
         self.indent += 1
         self.visit_blk(instrns)
         self.indent -= 1
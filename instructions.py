@@ -1,29 +1,101 @@
 from position import Position
 from instruction_block import Block
 from typed_data import RValue, TSym
+from type_system import typeSystem
+
+
+def blocks_under(blk):
+    # blk and every block under it
+    blks = [blk]
+    for blk in blks:
+        for instrn in blk:
+            blks += instrn.exprn_blks
+            blks += instrn.child_blks.values()
+            blks += instrn.child_scopes.values()
+    return blks
+
+
+def all_syms(instrn_tree):
+    # every name used in instrn_tree
+    syms = set()
+    for blk in blocks_under(instrn_tree):
+        for instrn in blk:
+            for attr in ('sym', 'func_sym', 'method_sym'):
+                sym = getattr(instrn, attr, None)
+                if isinstance(sym, str):
+                    syms.add(sym)
+            for attr in ('typed_sym', 't_sym'):
+                tsym = getattr(instrn, attr, None)
+                if isinstance(tsym, TSym):
+                    syms.add(tsym.sym)
+            if isinstance(instrn, InitFunc):
+                syms.update(arg.sym for arg in instrn.typed_func.value().args)
+    return syms
+
+
+def assigned_syms(instrn_tree):
+    # every name instrn_tree assigns a new value to as a whole
+    syms = set()
+    for blk in blocks_under(instrn_tree):
+        if not any(isinstance(instrn, Assign) for instrn in blk):
+            continue
+        flow = simulate(blk)
+        if flow is None:
+            continue
+        operands = flow[1]
+        for i, instrn in enumerate(blk):
+            if isinstance(instrn, Assign) and isinstance(blk[operands[i][0]], Push):
+                syms.add(blk[operands[i][0]].sym)
+    return syms
 
 
 class Func:
-    def __init__(self, typed_sym, args, instrns, pos):
+    def __init__(self, typed_sym, args, instrns, pos, is_iter=False, is_virtual=False, is_static=False):
         assert isinstance(typed_sym, TSym)
         self.typed_sym = typed_sym
         self.args = args
         self.instrns = instrns
         self.pos = pos
+        # an it function, calling it makes an iterator over its yields
+        self.is_iter = is_iter
+        # results by argument values, for functions found to be pure
+        self.memo = None
+        # for methods: looked up in the object's class rather than the
+        # class it is known as, or called without an object
+        self.is_virtual = is_virtual
+        self.is_static = is_static
 
     @property
     def rtn_type(self):
         return self.typed_sym.type.rtnType
 
 
+class Case:
+    def __init__(self, value, body, fallthru):
+        self.value = value
+        self.body = body
+        # runs on into the next case's body
+        self.fallthru = fallthru
+
+
 class Instrn:
     def __init__(self, pos):
         self.pos = pos
         self.child_scopes = {}
+        # blocks that run in the scope of the instruction itself
+        self.child_blks = {}
+        # blocks computing values the instruction uses, also run in its scope
+        self.exprn_blks = []
 
     def _add_child_scope(self, name, child_scope):
         self.child_scopes[name] = child_scope
 
+    def _add_child_blk(self, name, child_blk):
+        self.child_blks[name] = child_blk
+
+    def _add_exprn_blk(self, exprn_blk):
+        self.exprn_blks.append(exprn_blk)
+
     def __repr__(self):
         s = self.__class__.__name__ + ' '
         # for k,v in vars(self).items():
@@ -49,10 +121,38 @@ class Assign(Instrn):
 
 
 class Decl(Instrn):
-    def __init__(self, typed_sym, pos):
+    def __init__(self, typed_sym, pos, tmp=False):
+        super().__init__(pos)
+        assert isinstance(typed_sym, TSym)
+        self.typed_sym = typed_sym
+        # a temporary the optimizer introduced, not one of the program's locals
+        self.tmp = tmp
+
+
+class ArrayDecl(Instrn):
+    def __init__(self, typed_sym, size, pos):
         super().__init__(pos)
         assert isinstance(typed_sym, TSym)
         self.typed_sym = typed_sym
+        # the number of elements when it is only known at runtime, else empty
+        self.size = size
+        self._add_exprn_blk(size)
+
+
+class ArrayLit(Instrn):
+    def __init__(self, type_, n, pos):
+        super().__init__(pos)
+        self.type = type_
+        # the elements are the top n values on the stack
+        self.n = n
+
+
+class Index(Instrn):
+    pass
+
+
+class Len(Instrn):
+    pass
 
 
 class Pushi(Instrn):
@@ -81,12 +181,54 @@ class Call(Instrn):
         super().__init__(pos)
         self.func_sym = func_sym
         self.arg_exprns = arg_exprns
+        for arg_exprn in arg_exprns:
+            self._add_exprn_blk(arg_exprn)
+        # inline cache, filled in by the runner
+        self.cache = None
+
+
+class Inline(Instrn):
+    # a call with a copy of the callee's body in its place. The arguments are
+    # evaluated into params, then body runs in a scope of its own and leaves
+    # the result on the stack.
+    def __init__(self, func_sym, params, rtn_type, arg_exprns, body, pos):
+        super().__init__(pos)
+        self.func_sym = func_sym
+        self.params = params
+        self.rtn_type = rtn_type
+        self.arg_exprns = arg_exprns
+        for arg_exprn in arg_exprns:
+            self._add_exprn_blk(arg_exprn)
+        self.body = body
+        self._add_child_scope('body', body)
+        # filled in by the runner
+        self.cache = None
 
 
 class Rtn(Instrn):
     def __init__(self, exprn, pos):
         super().__init__(pos)
         self.exprn = exprn
+        self._add_exprn_blk(exprn)
+
+
+class Yield(Instrn):
+    def __init__(self, exprn, pos):
+        super().__init__(pos)
+        self.exprn = exprn
+        self._add_exprn_blk(exprn)
+
+
+class EndIter(Instrn):
+    # a return from an it function
+    pass
+
+
+class Foreign(Instrn):
+    def __init__(self, lang, code, pos):
+        super().__init__(pos)
+        self.lang = lang
+        self.code = code
 
 
 class Pop(Instrn):
@@ -97,6 +239,7 @@ class IfElse(Instrn):
     def __init__(self, condBlk, ifBlk, elseBlk, pos):
         super().__init__(pos)
         self.condBlk = condBlk
+        self._add_exprn_blk(condBlk)
         self._add_child_scope('if_blk', ifBlk)
         self._add_child_scope('else_blk', elseBlk)
 
@@ -104,37 +247,127 @@ class IfElse(Instrn):
         self.elseBlk = elseBlk
 
 
+class Switch(Instrn):
+    def __init__(self, exprn, cases, pos):
+        super().__init__(pos)
+        self.exprn = exprn
+        self._add_exprn_blk(exprn)
+        self.cases = cases
+        # case value -> index into cases
+        self.table = {case.value: i for i, case in enumerate(cases)}
+        for i, case in enumerate(cases):
+            self._add_child_scope('case_{}'.format(i), case.body)
+
+
+class StaticIfElse(Instrn):
+    # the branch is picked at compile time and spliced into the enclosing scope
+    def __init__(self, condBlk, ifBlk, elseBlk, pos):
+        super().__init__(pos)
+        self.condBlk = condBlk
+        self._add_exprn_blk(condBlk)
+        self._add_child_blk('if_blk', ifBlk)
+        self._add_child_blk('else_blk', elseBlk)
+
+        self.ifBlk = ifBlk
+        self.elseBlk = elseBlk
+
+
 class WhileLoop(Instrn):
+    splice = False
+
     def __init__(self, condBlk, loop, pos):
         super().__init__(pos)
         self.condBlk = condBlk
+        self._add_exprn_blk(condBlk)
+        self.loop = loop
+
+        if self.splice:
+            self._add_child_blk('loop', loop)
+        else:
+            self._add_child_scope('loop', loop)
+
+
+class StaticWhileLoop(WhileLoop):
+    # unrolled at compile time. A spliced loop (global scope) has no scope of
+    # its own, its body runs in the enclosing scope.
+    def __init__(self, condBlk, loop, splice, pos):
+        self.splice = splice
+        super().__init__(condBlk, loop, pos)
+
+
+class ForRange(Instrn):
+    splice = False
+
+    def __init__(self, typed_sym, start, stop, step, loop, pos):
+        super().__init__(pos)
+        self.typed_sym = typed_sym
+        # start and step may be empty, meaning 0 and 1
+        self.start = start
+        self.stop = stop
+        self.step = step
+        # the bounds are evaluated once, in this order, before the first iteration
+        self.bounds = Block(start + stop + step)
+        self._add_exprn_blk(self.bounds)
         self.loop = loop
 
-        self._add_child_scope('loop', loop)
+        if self.splice:
+            self._add_child_blk('loop', loop)
+        else:
+            self._add_child_scope('loop', loop)
+
+
+class StaticForRange(ForRange):
+    # unrolled at compile time, spliced like StaticWhileLoop
+    def __init__(self, typed_sym, start, stop, step, loop, splice, pos):
+        self.splice = splice
+        super().__init__(typed_sym, start, stop, step, loop, pos)
 
 
 class Mixin(Instrn):
     def __init__(self, exprn, pos):
         super().__init__(pos)
         self.exprn = exprn
+        self._add_exprn_blk(exprn)
 
 
 class MixinStatements(Instrn):
     def __init__(self, statements, pos):
         super().__init__(pos)
         self.statements = statements
+        self._add_exprn_blk(statements)
 
 
 class ClassDecl(Instrn):
     def __init__(self, t_sym: TSym,
                  # preUsrInit:Block,
                  contents: Block,
+                 own_fields,
+                 own_inits,
+                 methods,
                  pos: Position):
         super().__init__(pos)
         self.t_sym = t_sym
         # self.preUsrInit = preUsrInit
         contents.persistent_scope = True
         self.contents = contents
+        # the members in contents by kind: the typed syms of the fields in
+        # declaration order, (typed sym, exprn) for each field that has an
+        # initializer, and the InitFuncs of the methods. fields and inits
+        # include the base class's, ahead of the class's own.
+        base = t_sym.type.base
+        self.base = base.decl if base else None
+        self.own_fields = own_fields
+        self.own_inits = own_inits
+        self.methods = methods
+        self.inits = (self.base.inits if base else []) + own_inits
+        self.fields = (self.base.fields if base else []) + self.own_fields
+        self.layout = typeSystem.class_layout(self.fields)
+
+        self.vtable = self.layout.vtable
+        if base:
+            self.vtable.update(self.base.vtable)
+        for method in self.methods:
+            self.vtable[method.typed_sym.sym] = method.typed_func.value()
         # self.t_init_func = t_init_func
         # if contents:
         self._add_child_scope('contents', contents)
@@ -151,6 +384,36 @@ class ClassDecl(Instrn):
         return self.t_sym.type
 
 
+class MethodCall(Instrn):
+    def __init__(self, obj_exprn, method_sym, arg_exprns, pos, cls=None):
+        super().__init__(pos)
+        # the object the method is called on, None when called through the
+        # name of its class cls
+        self.obj_exprn = obj_exprn
+        self.method_sym = method_sym
+        self.arg_exprns = arg_exprns
+        self.cls = cls
+        # evaluated ahead of the call, the object first
+        self.operand_exprns = ([obj_exprn] if obj_exprn is not None else []) + arg_exprns
+        for exprn in self.operand_exprns:
+            self._add_exprn_blk(exprn)
+        # inline cache, the method resolved for each class of object seen
+        self.cache = []
+
+
+class PushSelf(Instrn):
+    # the object a method was called on
+    def __init__(self, type_, pos):
+        super().__init__(pos)
+        self.type = type_
+
+
+class Member(Instrn):
+    def __init__(self, sym, pos):
+        super().__init__(pos)
+        self.sym = sym
+
+
 class ObjectInit(Instrn):
     def __init__(self, type_, pos: Position):
         super().__init__(pos)
@@ -160,3 +423,57 @@ class ObjectInit(Instrn):
 class PLocal(Instrn):
     def __init__(self, pos):
         super().__init__(pos)
+
+
+class Compute(Instrn):
+    # expression code lowered to straight-line code over registers, see ir.py.
+    # Each op writes the register numbered by its index, the last one is the
+    # value left on the stack.
+    def __init__(self, ops, pos):
+        super().__init__(pos)
+        self.ops = ops
+        # where the interpreter keeps the registers, unboxed. Nothing runs
+        # while a Compute does, so one set of them is enough.
+        self.regs = [None] * len(ops)
+
+    @property
+    def type(self):
+        return self.ops[-1].type
+
+
+# (values popped, values pushed) for instructions that are not statements
+_EFFECTS = {Push: (0, 1), Pushi: (0, 1), PushSelf: (0, 1), Call: (0, 1), MethodCall: (0, 1),
+            Inline: (0, 1), Compute: (0, 1), BinOp: (2, 1), Index: (2, 1), UnaryOp: (1, 1), Len: (1, 1),
+            Member: (1, 1), Assign: (2, 0), Pop: (1, 0)}
+
+
+def stack_effect(instrn):
+    if isinstance(instrn, ArrayLit):
+        return instrn.n, 1
+    return _EFFECTS.get(instrn.__class__, (0, 0))
+
+
+def simulate(blk):
+    # follows the stack through blk. Returns, for each instruction, the
+    # index the code computing its result starts at and the indices of the
+    # instructions its operands come from, and the (first, last) index of
+    # each statement, or None if blk pops more than it pushes.
+    starts = []
+    operands = []
+    stmts = []
+    stack = []
+    first = 0
+    for i, instrn in enumerate(blk):
+        pops, pushes = stack_effect(instrn)
+        if len(stack) < pops:
+            return None
+        args = stack[len(stack) - pops:]
+        del stack[len(stack) - pops:]
+        starts.append(starts[args[0]] if args else i)
+        operands.append(args)
+        if pushes:
+            stack.append(i)
+        elif not stack:
+            stmts.append((first, i))
+            first = i + 1
+    return starts, operands, stmts, len(stack)
@@ -0,0 +1,353 @@
+# A typed register form of expression code, run by the interpreter and
+# emitted by the C++ backend alike. Lowering happens once scopes are made:
+# each stretch of int and float arithmetic is replaced by a Compute holding
+# straight-line code in which every op writes a register of its own, so the
+# code is in SSA form. The type of every register and the scope every name
+# read lives in are worked out while lowering instead of by each backend
+# each time the code runs or is emitted. Constants are folded and a value
+# computed twice in a stretch, or a name read twice, gets one register.
+#
+# Only names whose scope is certain are read from registers: those declared
+# before the code in the scope they are found in, or anywhere in the global
+# scope or a class, and not past a scope code can be mixed into.
+#
+# The interpreter keeps registers unboxed: plain python ints and floats in
+# an array each Compute has, worked on by the python function each op was
+# given for the types it was lowered for. Only the result becomes an
+# RValue. The functions give what typeSystem.op_res does for the types.
+import math
+import operator
+from exceptions import VMRuntimeException
+from instructions import (ArrayDecl, BinOp, ClassDecl, Compute, Decl, ForRange, InitFunc, Inline, Mixin,
+                          MixinStatements, Push, Pushi, StaticForRange, StaticIfElse, StaticWhileLoop,
+                          UnaryOp, blocks_under, simulate)
+from type_system import (Add, And, Div, Eq, Float, Gt, GtEq, Int, Lt, LtEq, Mul, Neg, NotEq, Or, Sub, strip_ref,
+                         typeSystem)
+from typed_data import RValue
+
+_NUMBER_TYPES = (Int, Float)
+
+# ops folded when all they are applied to are constants. Division and the
+# logical ops are left to the backends, which don't agree on them.
+_FOLDABLE = (Add, Sub, Mul, Eq, NotEq, Gt, GtEq, Lt, LtEq, Neg)
+
+# code in scopes with these in them may declare names the tree doesn't show
+_OPAQUE_INSTRNS = (Mixin, MixinStatements, StaticIfElse, StaticWhileLoop, StaticForRange)
+
+
+def _wrap(value):
+    # an int as a 32 bit int holds it
+    return ((value + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+
+def _int(value):
+    # what MutableInt32(value // 1) holds
+    return _wrap(int(value // 1))
+
+
+_INT_OPS = {
+    Add: lambda l, r: ((l + r + 0x80000000) & 0xFFFFFFFF) - 0x80000000,
+    Sub: lambda l, r: ((l - r + 0x80000000) & 0xFFFFFFFF) - 0x80000000,
+    Mul: lambda l, r: ((l * r + 0x80000000) & 0xFFFFFFFF) - 0x80000000,
+    Div: lambda l, r: _int(l / r),
+    Eq: lambda l, r: 1 if l == r else 0,
+    NotEq: lambda l, r: 1 if l != r else 0,
+    Gt: lambda l, r: 1 if l > r else 0,
+    GtEq: lambda l, r: 1 if l >= r else 0,
+    Lt: lambda l, r: 1 if l < r else 0,
+    LtEq: lambda l, r: 1 if l <= r else 0,
+    And: lambda l, r: _int(l and r),
+    Or: lambda l, r: _int(l or r),
+}
+
+_FLOAT_OPS = {Add: operator.add, Sub: operator.sub, Mul: operator.mul, Div: operator.truediv}
+
+
+def _unboxed(op, arg_types, type_):
+    # the function of unboxed values doing op on values of arg_types
+    if len(arg_types) == 1:
+        return operator.neg if isinstance(type_, Float) else lambda value: _wrap(-value)
+    if isinstance(type_, Float):
+        if any(isinstance(arg_type, Int) for arg_type in arg_types):
+            # the int operand is made a float first
+            f = _FLOAT_OPS[op.__class__]
+            return lambda l, r: f(float(l), float(r))
+        return _FLOAT_OPS[op.__class__]
+    if all(isinstance(arg_type, Int) for arg_type in arg_types):
+        return _INT_OPS[op.__class__]
+    f = _INT_OPS[op.__class__]
+    return lambda l, r: f(float(l), float(r))
+
+
+def _unbox(value, type_):
+    return int(value) if isinstance(type_, Int) else float(value)
+
+
+class Load:
+    # the value of sym in scope
+    __slots__ = ('sym', 'scope', 'type', 'pos', 'unbox')
+
+    def __init__(self, sym, scope, type_, pos):
+        self.sym = sym
+        self.scope = scope
+        self.type = type_
+        self.pos = pos
+        self.unbox = int if isinstance(type_, Int) else float
+
+
+class Const:
+    __slots__ = ('value', 'type', 'raw')
+
+    def __init__(self, value):
+        self.value = value
+        self.type = value.type
+        # the value unboxed
+        self.raw = _unbox(value.value(), value.type)
+
+
+class Op:
+    # op applied to the registers numbered in args, one for unary ops
+    __slots__ = ('op', 'args', 'type', 'pos', 'arg_types', 'fn')
+
+    def __init__(self, op, args, type_, pos, arg_types):
+        self.op = op
+        self.args = args
+        self.type = type_
+        self.pos = pos
+        self.arg_types = arg_types
+        self.fn = _unboxed(op, arg_types, type_)
+
+    def __reduce__(self):
+        # fn is made again rather than pickled
+        return Op, (self.op, self.args, self.type, self.pos, self.arg_types)
+
+
+class _Scope:
+    # what lowering knows of a scope: the names declared in its blocks, and
+    # the ones declared ahead of the code being lowered
+    def __init__(self, scope, blk, seen=(), all_seen=False):
+        self.scope = scope
+        self.declared = {}
+        self.seen = set(seen)
+        self.all_seen = all_seen
+        self.opaque = scope is None
+        blks = [blk]
+        for blk in blks:
+            for instrn in blk:
+                if isinstance(instrn, _OPAQUE_INSTRNS):
+                    self.opaque = True
+                if isinstance(instrn, (Decl, ArrayDecl, InitFunc)):
+                    self.declare(instrn.typed_sym.sym, instrn.typed_sym.type)
+                elif isinstance(instrn, ClassDecl):
+                    self.declare(instrn.t_sym.sym, instrn.type)
+                blks += instrn.child_blks.values()
+
+    def declare(self, sym, type_):
+        # declared twice, which one a read means depends on when it runs
+        self.declared[sym] = None if sym in self.declared else strip_ref(type_)
+
+
+def _resolve(scopes, sym):
+    # (scope, type) of what sym means in the innermost of scopes, or None
+    for entry in reversed(scopes):
+        if entry.opaque:
+            return None
+        if sym in entry.declared:
+            type_ = entry.declared[sym]
+            if type_ is None or not (entry.all_seen or sym in entry.seen):
+                return None
+            return entry.scope, type_
+    return None
+
+
+def _fold(op, args, type_, pos):
+    # the constant op gives for the constants args, None if it isn't folded
+    if not isinstance(op, _FOLDABLE):
+        return None
+    if len(args) == 2:
+        (l, r) = args
+        value = typeSystem.op_res(op, l.value.value(), l.type, r.value.value(), r.type, pos)
+    else:
+        value = typeSystem.unary_op_res(op, args[0].value.value(), args[0].type, pos)
+    if isinstance(type_, Float):
+        value = float(value)
+        if not math.isfinite(value):
+            return None
+    return RValue(value, type_)
+
+
+def _key(value):
+    return value.type.__class__, typeSystem.to_python(value.value(), value.type)
+
+
+def _compact(ops):
+    # ops without those the result doesn't depend on, renumbered
+    used = [False] * len(ops)
+    used[-1] = True
+    for i in reversed(range(len(ops))):
+        if used[i] and isinstance(ops[i], Op):
+            for arg in ops[i].args:
+                used[arg] = True
+    numbers = {}
+    kept = []
+    for i, op in enumerate(ops):
+        if used[i]:
+            numbers[i] = len(kept)
+            if isinstance(op, Op):
+                op.args = tuple(numbers[arg] for arg in op.args)
+            kept.append(op)
+    return kept
+
+
+class Lowering:
+    def __init__(self, ctx):
+        self.ctx = ctx
+        # the Computes made and the expressions folded to a constant
+        self.computes = 0
+        self.folded = 0
+
+    def _scope(self, uid):
+        try:
+            return self.ctx.scope(uid)
+        except KeyError:
+            return None
+
+    def lower(self, instrn_tree):
+        # scopes are found by the uids of their blocks, which mustn't change
+        # when the first instruction of one is replaced
+        instrn_tree.uid = instrn_tree.uid
+        for blk in blocks_under(instrn_tree):
+            for instrn in blk:
+                for child in instrn.child_scopes.values():
+                    child.uid = child.uid
+        root = _Scope(self._scope(instrn_tree.uid), instrn_tree, all_seen=True)
+        self._blk(instrn_tree, [root], True)
+        return self.computes
+
+    def _child_scope(self, instrn, blk):
+        scope = self._scope(blk.uid)
+        if isinstance(instrn, InitFunc):
+            entry = _Scope(scope, blk)
+            for arg in instrn.typed_func.value().args:
+                entry.declare(arg.sym, arg.type)
+                entry.seen.add(arg.sym)
+        elif isinstance(instrn, ForRange):
+            entry = _Scope(scope, blk, seen=[instrn.typed_sym.sym])
+            entry.declare(instrn.typed_sym.sym, instrn.typed_sym.type)
+        elif isinstance(instrn, Inline):
+            entry = _Scope(scope, blk, seen=[param.sym for param in instrn.params])
+            for param in instrn.params:
+                entry.declare(param.sym, param.type)
+        elif isinstance(instrn, ClassDecl):
+            entry = _Scope(scope, blk, all_seen=True)
+            for tsym in instrn.fields:
+                if tsym.sym not in entry.declared:
+                    entry.declare(tsym.sym, tsym.type)
+        else:
+            entry = _Scope(scope, blk)
+        return entry
+
+    def _blk(self, blk, scopes, lower, static=False):
+        # lower: whether code in blk itself is lowered, the code in a class
+        # is also run for its field initializers. static: blk is part of
+        # code run while compiling, nothing in it is lowered.
+        entry = scopes[-1]
+        resolved = {}
+        for i, instrn in enumerate(blk):
+            if isinstance(instrn, Push):
+                found = _resolve(scopes, instrn.sym)
+                if found is not None:
+                    resolved[i] = found
+            child_static = static or isinstance(instrn, _OPAQUE_INSTRNS)
+            if isinstance(instrn, ForRange):
+                for exprn in (instrn.start, instrn.stop, instrn.step):
+                    self._blk(exprn, scopes, lower, child_static)
+                instrn.bounds[:] = instrn.start + instrn.stop + instrn.step
+            else:
+                for exprn in instrn.exprn_blks:
+                    self._blk(exprn, scopes, lower, child_static)
+            for child in instrn.child_blks.values():
+                self._blk(child, scopes, lower, child_static)
+            for child in instrn.child_scopes.values():
+                child_lower = not isinstance(instrn, ClassDecl) and (lower or isinstance(instrn, InitFunc))
+                self._blk(child, scopes + [self._child_scope(instrn, child)], child_lower, child_static)
+            if isinstance(instrn, (Decl, ArrayDecl, InitFunc)):
+                entry.seen.add(instrn.typed_sym.sym)
+            elif isinstance(instrn, ClassDecl):
+                entry.seen.add(instrn.t_sym.sym)
+        if lower and not static:
+            self._lower(blk, resolved)
+
+    def _lower(self, blk, resolved):
+        sim = simulate(blk)
+        if sim is None:
+            return
+        starts = sim[0]
+        lowered = []
+        lo = len(blk)
+        for end in reversed(range(len(blk))):
+            if end >= lo or not isinstance(blk[end], (BinOp, UnaryOp)):
+                continue
+            ops = self._build(blk, starts[end], end, resolved)
+            if ops is not None:
+                lowered.append((starts[end], end, ops))
+                lo = starts[end]
+        # from the end, so the indices of the rest hold
+        for start, end, ops in lowered:
+            pos = blk[start].pos
+            if isinstance(ops[-1], Const):
+                blk[start:end + 1] = [Pushi(ops[-1].value, pos)]
+                self.folded += 1
+            else:
+                blk[start:end + 1] = [Compute(ops, pos)]
+                self.computes += 1
+
+    def _build(self, blk, start, end, resolved):
+        # the ops computing what blk[start:end + 1] does, None if it can't
+        ops = []
+        regs = {}
+        stack = []
+
+        def add(key, make):
+            reg = regs.get(key)
+            if reg is None:
+                reg = regs[key] = len(ops)
+                ops.append(make())
+            stack.append(reg)
+
+        for i in range(start, end + 1):
+            instrn = blk[i]
+            if isinstance(instrn, Push):
+                found = resolved.get(i)
+                if found is None or not isinstance(found[1], _NUMBER_TYPES):
+                    return None
+                scope, type_ = found
+                add((Load, instrn.sym, id(scope)), lambda: Load(instrn.sym, scope, type_, instrn.pos))
+            elif isinstance(instrn, Pushi):
+                if not isinstance(instrn.value.type, _NUMBER_TYPES):
+                    return None
+                add((Const,) + _key(instrn.value), lambda: Const(instrn.value))
+            elif isinstance(instrn, (BinOp, UnaryOp)):
+                n = 2 if isinstance(instrn, BinOp) else 1
+                args = tuple(stack[len(stack) - n:])
+                del stack[len(stack) - n:]
+                arg_types = [ops[arg].type for arg in args]
+                try:
+                    if n == 2:
+                        type_ = typeSystem.op_res_type(instrn.op, arg_types[0], arg_types[1], instrn.pos)
+                    else:
+                        type_ = typeSystem.unary_op_res_type(instrn.op, arg_types[0], instrn.pos)
+                except VMRuntimeException:
+                    return None
+                if not isinstance(type_, _NUMBER_TYPES):
+                    return None
+                value = None
+                if all(isinstance(ops[arg], Const) for arg in args):
+                    value = _fold(instrn.op, [ops[arg] for arg in args], type_, instrn.pos)
+                if value is not None:
+                    add((Const,) + _key(value), lambda: Const(value))
+                else:
+                    add((Op, instrn.op.__class__, args), lambda: Op(instrn.op, args, type_, instrn.pos, arg_types))
+            else:
+                return None
+        return _compact(ops)
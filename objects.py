@@ -0,0 +1,43 @@
+# Storage behind .lang objects. An object is a flat list of slots, one per
+# field, at the offset its class's ClassLayout gives the field. Slots hold
+# plain values, not RValues. Objects belong to nothing but the values that
+# refer to them, so they go away with the last of those.
+import arrays
+
+
+class ClassLayout:
+    def __init__(self, syms, types, zero, array_offsets, object_offsets):
+        self.syms = syms
+        self.types = types
+        self.offsets = {sym: i for i, sym in enumerate(syms)}
+        # an object with every field zeroed, new objects start as a copy
+        self.zero = Object(self, zero)
+        # the slots that are copied along with the object
+        self.array_offsets = array_offsets
+        self.object_offsets = object_offsets
+        # the methods of the class by name, inherited ones included
+        self.vtable = {}
+
+
+class Object:
+    __slots__ = ('layout', 'slots')
+
+    def __init__(self, layout, slots):
+        self.layout = layout
+        self.slots = slots
+
+
+def new(layout):
+    return copy(layout.zero)
+
+
+def copy(obj):
+    # objects are values, a copy shares nothing with the original
+    layout = obj.layout
+    slots = obj.slots[:]
+    for i in layout.array_offsets:
+        slots[i] = arrays.copy(slots[i])
+    for i in layout.object_offsets:
+        slots[i] = copy(slots[i])
+    return Object(layout, slots)
+
@@ -0,0 +1,406 @@
+# Loop invariant code motion and common subexpression elimination, done on
+# the instruction tree so that the interpreter and the C++ both get them.
+# Only arithmetic on int and float locals is moved: such expressions can't
+# fail or change anything, so evaluating one earlier, or once instead of
+# twice, gives the same result. Division is left where it is as it may
+# fail on a zero that the code around it checks for. A local qualifies
+# when it is declared once in its function, not by reference, and has
+# been assigned before the code the expression is moved in front of. Only
+# reads in its scope after its declaration are of the local, the others
+# are of a global or field of the same name, which calls may change.
+#
+# An expression in a loop that reads no local the loop changes is computed
+# into a temporary just ahead of the loop. An expression computed more than
+# once in a block, with nothing in between changing what it reads, is
+# computed into a temporary ahead of the statement it first appears in.
+from instructions import (ArrayDecl, Assign, BinOp, Call, ClassDecl, Decl, ForRange, Foreign, IfElse,
+                          InitFunc, Inline, MethodCall, Mixin, MixinStatements, Push, Pushi, Rtn,
+                          StaticForRange, StaticIfElse, StaticWhileLoop, Switch, UnaryOp, WhileLoop, Yield,
+                          all_syms, simulate)
+from exceptions import VMRuntimeException
+from type_system import Div, Float, Int, typeSystem
+from typed_data import TSym
+
+# instructions after which what a function's locals hold can't be told
+_OPAQUE_INSTRNS = (Mixin, MixinStatements, Foreign, InitFunc, ClassDecl, StaticIfElse, StaticWhileLoop,
+                   StaticForRange)
+
+_NUMBER_TYPES = (Int, Float)
+
+
+def _exprn_blks(instrn):
+    # the blocks of instrn holding code, ForRange's bounds are made from
+    # the blocks it is made of
+    if isinstance(instrn, ForRange):
+        return [instrn.start, instrn.stop, instrn.step]
+    return instrn.exprn_blks
+
+
+def _blocks(blks):
+    blks = list(blks)
+    for blk in blks:
+        for instrn in blk:
+            blks += _exprn_blks(instrn)
+            blks += instrn.child_blks.values()
+            blks += instrn.child_scopes.values()
+    return blks
+
+
+def _modified(blks):
+    # the locals the code in blks may change, None if it can't be told
+    syms = set()
+    for blk in _blocks(blks):
+        sim = simulate(blk)
+        if sim is None:
+            return None
+        starts, operands, _, _ = sim
+        for i, instrn in enumerate(blk):
+            if isinstance(instrn, _OPAQUE_INSTRNS):
+                return None
+            if isinstance(instrn, (Decl, ArrayDecl, ForRange)):
+                syms.add(instrn.typed_sym.sym)
+            elif isinstance(instrn, Inline):
+                syms.update(param.sym for param in instrn.params)
+            elif isinstance(instrn, Assign):
+                target = blk[starts[operands[i][0]]]
+                if isinstance(target, Push):
+                    syms.add(target.sym)
+            elif isinstance(instrn, (Call, MethodCall)):
+                # an argument may be passed by reference
+                for exprn in instrn.exprn_blks:
+                    if exprn and isinstance(exprn[0], Push):
+                        syms.add(exprn[0].sym)
+    return syms
+
+
+def _local_reads(func, syms):
+    # the Pushes in func reading one of the locals syms
+    reads = set()
+    blks = [(func.instrns, {arg.sym for arg in func.args} & syms)]
+    for blk, visible in blks:
+        for instrn in blk:
+            if isinstance(instrn, Push) and instrn.sym in visible:
+                reads.add(instrn)
+            # the blocks queued see the locals declared so far
+            blks += ((exprn, set(visible)) for exprn in _exprn_blks(instrn))
+            blks += ((child, set(visible)) for child in instrn.child_blks.values())
+            for child in instrn.child_scopes.values():
+                inner = set(visible)
+                if isinstance(instrn, ForRange):
+                    inner.add(instrn.typed_sym.sym)
+                elif isinstance(instrn, Inline):
+                    inner.update(param.sym for param in instrn.params)
+                blks.append((child, inner & syms))
+            if isinstance(instrn, (Decl, ArrayDecl)) and instrn.typed_sym.sym in syms:
+                visible.add(instrn.typed_sym.sym)
+    return reads
+
+
+def _key_syms(key):
+    return {entry[1] for entry in key if entry[0] is Push}
+
+
+class _Exprn:
+    # code computing a value in blk[start:end + 1] that can be moved
+    def __init__(self, blk, start, end, key, type_, stmt=None):
+        self.blk = blk
+        self.start = start
+        self.end = end
+        self.key = key
+        self.type = type_
+        # for common subexpressions, the statement the code is part of
+        self.stmt = stmt
+
+    @property
+    def size(self):
+        return self.end - self.start + 1
+
+    def overlaps(self, other):
+        return self.blk is other.blk and self.start <= other.end and other.start <= self.end
+
+
+class Optimizer:
+    def __init__(self):
+        # the temporaries loop invariants and common subexpressions went to
+        self.hoisted = []
+        self.shared = []
+        self._syms = set()
+        self._n = 0
+        # sym -> type of the locals of the function being optimized that
+        # expressions may be moved across
+        self._types = {}
+        # the Pushes reading those locals
+        self._reads = set()
+
+    def optimize(self, instrn_tree):
+        # rewrites the functions and methods at the top of instrn_tree in
+        # place, returns the temporaries introduced
+        self._syms = all_syms(instrn_tree)
+        # scopes keep the uids they have when temporaries go in front
+        instrn_tree.uid = instrn_tree.uid
+        for blk in _blocks([instrn_tree]):
+            for instrn in blk:
+                for child in instrn.child_scopes.values():
+                    child.uid = child.uid
+
+        for instrn in instrn_tree:
+            if isinstance(instrn, InitFunc):
+                self._optimize_func(instrn.typed_func.value())
+            elif isinstance(instrn, ClassDecl):
+                for method in instrn.methods:
+                    self._optimize_func(method.typed_func.value())
+        return self.hoisted + self.shared
+
+    def _optimize_func(self, func):
+        blks = _blocks([func.instrns])
+        if any(isinstance(instrn, _OPAQUE_INSTRNS) for blk in blks for instrn in blk):
+            return
+        declared = [(arg.sym, arg.type) for arg in func.args]
+        for blk in blks:
+            for instrn in blk:
+                if isinstance(instrn, (Decl, ArrayDecl, ForRange)):
+                    declared.append((instrn.typed_sym.sym, instrn.typed_sym.type))
+                elif isinstance(instrn, Inline):
+                    declared += ((param.sym, param.type) for param in instrn.params)
+        counts = {}
+        for sym, _ in declared:
+            counts[sym] = counts.get(sym, 0) + 1
+        # a local declared twice may be two locals, one hiding the other
+        self._types = {sym: type_ for sym, type_ in declared
+                       if counts[sym] == 1 and isinstance(type_, _NUMBER_TYPES)}
+        if not self._types:
+            return
+        self._reads = _local_reads(func, set(self._types))
+
+        self._optimize_blk(func.instrns, {arg.sym for arg in func.args})
+        for blk in blks:
+            for instrn in blk:
+                if isinstance(instrn, ForRange):
+                    instrn.bounds[:] = instrn.start + instrn.stop + instrn.step
+
+    def _optimize_blk(self, blk, assigned):
+        # assigned: the locals known to hold a value when blk starts
+        sim = simulate(blk)
+        if sim is None:
+            return
+        starts, operands, stmts, depth = sim
+        entry = set(assigned)
+        assigned = set(assigned)
+        kept = []
+        for first, last in stmts:
+            if blk[last].__class__ in (WhileLoop, ForRange):
+                kept += self._hoist(blk[last], assigned)
+            for instrn in blk[first:last + 1]:
+                self._optimize_children(instrn, assigned)
+            kept += blk[first:last + 1]
+            sym = _assigned_sym(blk, first, last, operands)
+            if sym is not None:
+                assigned.add(sym)
+        # the code of an expression, in the blocks of instructions
+        rest = blk[stmts[-1][1] + 1 if stmts else 0:]
+        for instrn in rest:
+            self._optimize_children(instrn, assigned)
+        blk[:] = kept + rest
+        if not depth:
+            self._share(blk, entry)
+
+    def _optimize_children(self, instrn, assigned):
+        for exprn in _exprn_blks(instrn):
+            self._optimize_blk(exprn, assigned)
+        for child in instrn.child_blks.values():
+            self._optimize_blk(child, assigned)
+        for child in instrn.child_scopes.values():
+            if isinstance(instrn, ForRange):
+                self._optimize_blk(child, assigned | {instrn.typed_sym.sym})
+            elif isinstance(instrn, Inline):
+                self._optimize_blk(child, assigned | {param.sym for param in instrn.params})
+            else:
+                self._optimize_blk(child, assigned)
+
+    def _exprns(self, blk, syms, maximal):
+        # the code in blk that can be moved and reads only syms, with
+        # maximal only the code not part of a bigger such expression
+        sim = simulate(blk)
+        if sim is None:
+            return []
+        starts = sim[0]
+        exprns = []
+        lo = len(blk)
+        for end in reversed(range(len(blk))):
+            if maximal and end >= lo or not isinstance(blk[end], (BinOp, UnaryOp)):
+                continue
+            typed = self._typed(blk, starts[end], end, syms)
+            if typed is not None:
+                exprns.append(_Exprn(blk, starts[end], end, *typed))
+                lo = starts[end]
+        return exprns
+
+    def _typed(self, blk, start, end, syms):
+        # the key and type of the expression in blk[start:end + 1], None if
+        # it can't be moved
+        types = []
+        key = []
+        for instrn in blk[start:end + 1]:
+            if isinstance(instrn, Push):
+                if instrn.sym not in syms or instrn not in self._reads:
+                    return None
+                types.append(self._types[instrn.sym])
+                key.append((Push, instrn.sym))
+            elif isinstance(instrn, Pushi):
+                type_ = instrn.value.type
+                if not isinstance(type_, _NUMBER_TYPES):
+                    return None
+                types.append(type_)
+                key.append((Pushi, type_.__class__, typeSystem.to_python(instrn.value.value(), type_)))
+            elif isinstance(instrn, BinOp):
+                if isinstance(instrn.op, Div):
+                    return None
+                r_type = types.pop()
+                l_type = types.pop()
+                try:
+                    types.append(typeSystem.op_res_type(instrn.op, l_type, r_type, instrn.pos))
+                except VMRuntimeException:
+                    return None
+                key.append((BinOp, instrn.op.__class__))
+            elif isinstance(instrn, UnaryOp):
+                try:
+                    types.append(typeSystem.unary_op_res_type(instrn.op, types.pop(), instrn.pos))
+                except VMRuntimeException:
+                    return None
+                key.append((UnaryOp, instrn.op.__class__))
+            else:
+                return None
+        if not isinstance(types[-1], _NUMBER_TYPES):
+            return None
+        return tuple(key), types[-1]
+
+    def _temp(self, prefix, type_):
+        sym = '{}{}'.format(prefix, self._n)
+        self._n += 1
+        while sym in self._syms:
+            sym += '_'
+        self._syms.add(sym)
+        return TSym(sym, type_)
+
+    def _def(self, tsym, exprn, pos):
+        # the statements computing exprn into the temporary tsym
+        return [Decl(tsym, pos, tmp=True), Push(tsym.sym, pos)] \
+            + exprn.blk[exprn.start:exprn.end + 1] + [Assign(pos)]
+
+    def _hoist(self, loop, assigned):
+        # moves what doesn't change in loop out of it, returns the
+        # statements computing it, to go ahead of the loop
+        blks = [loop.loop] if isinstance(loop, ForRange) else [loop.condBlk, loop.loop]
+        modified = _modified(blks)
+        if modified is None:
+            return []
+        if isinstance(loop, ForRange):
+            modified.add(loop.typed_sym.sym)
+        syms = {sym for sym in self._types if sym in assigned and sym not in modified}
+        if not syms:
+            return []
+
+        defs = []
+        temps = {}
+        for blk in _blocks(blks):
+            replaced = {}
+            for exprn in self._exprns(blk, syms, True):
+                tsym = temps.get(exprn.key)
+                if tsym is None:
+                    tsym = temps[exprn.key] = self._temp('inv', exprn.type)
+                    defs += self._def(tsym, exprn, loop.pos)
+                    self.hoisted.append(tsym.sym)
+                replaced[exprn.start] = (exprn.end, tsym.sym)
+            if replaced:
+                blk[:] = _replace(blk, replaced)
+        return defs
+
+    def _share(self, blk, assigned):
+        # computes expressions found more than once in the statements of
+        # blk once, ahead of the statement they are first found in
+        starts, operands, stmts, _ = simulate(blk)
+        assigned = set(assigned)
+        flat = self._exprns(blk, self._types, False)
+        found = {}
+        groups = []
+        for n, (first, last) in enumerate(stmts):
+            stmt = blk[first:last + 1]
+            # a call may change what an argument passed by reference to it
+            # holds, after the expressions ahead of it are computed
+            if not any(isinstance(instrn, (Call, MethodCall)) for sub in _blocks([stmt]) for instrn in sub):
+                exprns = [exprn for exprn in flat if first <= exprn.end <= last]
+                for exprn_blk in _stmt_exprns(blk[last]):
+                    exprns += self._exprns(exprn_blk, self._types, False)
+                for exprn in exprns:
+                    if _key_syms(exprn.key) <= assigned:
+                        exprn.stmt = n
+                        found.setdefault(exprn.key, []).append(exprn)
+            modified = _modified([stmt])
+            for key in list(found):
+                if modified is None or _key_syms(key) & modified:
+                    groups.append(found.pop(key))
+            sym = _assigned_sym(blk, first, last, operands)
+            if sym is not None:
+                assigned.add(sym)
+        groups += found.values()
+
+        taken = []
+        defs = {}
+        replaced = {}
+        for group in sorted(groups, key=lambda group: -group[0].size):
+            group = [exprn for exprn in group if not any(exprn.overlaps(other) for other in taken)]
+            if len(group) < 2:
+                continue
+            taken += group
+            first = group[0]
+            tsym = self._temp('cse', first.type)
+            defs.setdefault(first.stmt, []).extend(self._def(tsym, first, first.blk[first.start].pos))
+            self.shared.append(tsym.sym)
+            for exprn in group:
+                replaced.setdefault(id(exprn.blk), (exprn.blk, {}))[1][exprn.start] = (exprn.end, tsym.sym)
+        if not defs:
+            return
+
+        for exprn_blk, exprn_replaced in replaced.values():
+            if exprn_blk is not blk:
+                exprn_blk[:] = _replace(exprn_blk, exprn_replaced)
+        stmt_starts = {first: n for n, (first, _) in enumerate(stmts)}
+        blk[:] = _replace(blk, replaced.get(id(blk), (blk, {}))[1],
+                          {i: defs[n] for i, n in stmt_starts.items() if n in defs})
+
+
+def _assigned_sym(blk, first, last, operands):
+    # the local the statement blk[first:last + 1] assigns to, if it is a
+    # plain assignment to one
+    if isinstance(blk[last], Assign) and isinstance(blk[first], Push) and operands[last][0] == first:
+        return blk[first].sym
+    return None
+
+
+def _stmt_exprns(instrn):
+    # the blocks a statement computes before it does anything
+    if isinstance(instrn, IfElse):
+        return [instrn.condBlk]
+    if isinstance(instrn, (Switch, Rtn, Yield)):
+        return [instrn.exprn]
+    if isinstance(instrn, ArrayDecl) and instrn.size:
+        return [instrn.size]
+    return []
+
+
+def _replace(blk, replaced, inserted=None):
+    # blk with the code replaced[start][0] ends with replaced by a push of
+    # replaced[start][1], and inserted[i] put ahead of the instruction at i
+    new = []
+    i = 0
+    while i < len(blk):
+        if inserted and i in inserted:
+            new += inserted[i]
+        if i in replaced:
+            end, sym = replaced[i]
+            new.append(Push(sym, blk[i].pos))
+            i = end + 1
+        else:
+            new.append(blk[i])
+            i += 1
+    return new
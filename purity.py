@@ -0,0 +1,138 @@
+# Finds the functions whose result depends on nothing but their arguments,
+# so the interpreter can remember results instead of running them again. A
+# function is pure when it only reads its own arguments and locals, has no
+# mixins, plocal or foreign code, and only calls pure functions. Only
+# functions of ints, floats and strings returning one of those are
+# memoized, those values can key a dict and are never changed in place.
+from collections import OrderedDict
+from instructions import (ArrayDecl, ClassDecl, Call, Decl, EndIter, ForRange, Foreign, InitFunc, Inline,
+                          MethodCall, Mixin, MixinStatements, PLocal, Push, PushSelf, StaticForRange,
+                          StaticIfElse, StaticWhileLoop, Yield, assigned_syms)
+from type_system import Float, Int, String
+
+# results kept per function
+MEMO_SIZE = 1024
+
+_VALUE_TYPES = (Int, Float, String)
+
+_IMPURE_INSTRNS = (Mixin, MixinStatements, PLocal, Foreign, InitFunc, ClassDecl, MethodCall, PushSelf,
+                   Yield, EndIter, StaticIfElse, StaticWhileLoop, StaticForRange)
+
+
+class Memo:
+    # the results of one function by argument values, the least recently
+    # used are dropped first
+    def __init__(self, size=MEMO_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+
+    def get(self, key):
+        try:
+            result = self._results[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._results.move_to_end(key)
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        self._results[key] = result
+        if len(self._results) > self.size:
+            self._results.popitem(last=False)
+
+
+class _BodyScan:
+    # walks a function body keeping track of the names declared in each
+    # scope, notes what it calls and whether it does anything impure
+    def __init__(self, func):
+        self.pure = True
+        self.callees = set()
+        self._scopes = [{arg.sym for arg in func.args}]
+        self._blk(func.instrns)
+
+    def _declared(self, sym):
+        return any(sym in scope for scope in self._scopes)
+
+    def _blk(self, blk):
+        for instrn in blk:
+            if not self.pure:
+                return
+            self._instrn(instrn)
+
+    def _instrn(self, instrn):
+        if isinstance(instrn, _IMPURE_INSTRNS):
+            self.pure = False
+            return
+        if isinstance(instrn, Push) and not self._declared(instrn.sym):
+            # a global
+            self.pure = False
+            return
+        if isinstance(instrn, Call):
+            self.callees.add(instrn.func_sym)
+
+        for blk in instrn.exprn_blks:
+            self._blk(blk)
+        if isinstance(instrn, (Decl, ArrayDecl)):
+            self._scopes[-1].add(instrn.typed_sym.sym)
+        for blk in instrn.child_blks.values():
+            self._blk(blk)
+        for blk in instrn.child_scopes.values():
+            if isinstance(instrn, ForRange):
+                self._scopes.append({instrn.typed_sym.sym})
+            elif isinstance(instrn, Inline):
+                self._scopes.append({param.sym for param in instrn.params})
+            else:
+                self._scopes.append(set())
+            self._blk(blk)
+            self._scopes.pop()
+
+
+def _memoizable(func):
+    return not func.is_iter \
+        and isinstance(func.rtn_type, _VALUE_TYPES) \
+        and all(isinstance(arg.type, _VALUE_TYPES) for arg in func.args)
+
+
+class PurityAnalysis:
+    def __init__(self):
+        # sym -> Func of every function given a memo so far
+        self.memoized = {}
+
+    def analyze(self, instrn_tree):
+        # looks at the functions defined at the top of instrn_tree, they
+        # may call functions found pure in earlier trees
+        calls = {}
+        for instrn in instrn_tree:
+            if not isinstance(instrn, InitFunc):
+                continue
+            func = instrn.typed_func.value()
+            if not _memoizable(func):
+                continue
+            scan = _BodyScan(func)
+            if scan.pure:
+                calls[instrn.typed_sym.sym] = (func, scan.callees)
+
+        # drop functions calling something impure until nothing changes,
+        # recursive functions stay in as long as the rest of them is pure.
+        # A name assigned to may come to mean another function.
+        rebound = assigned_syms(instrn_tree)
+        changed = True
+        while changed:
+            changed = False
+            for sym, (func, callees) in list(calls.items()):
+                if any(callee in rebound or (callee not in calls and callee not in self.memoized)
+                       for callee in callees):
+                    del calls[sym]
+                    changed = True
+
+        for sym, (func, _) in calls.items():
+            func.memo = Memo()
+            self.memoized[sym] = func
+        return list(calls)
+
+    def stats(self):
+        # sym -> (hits, misses)
+        return {sym: (func.memo.hits, func.memo.misses) for sym, func in self.memoized.items()}
@@ -0,0 +1,48 @@
+# String values built by concatenation. A rope is the first n pieces of a
+# list of strings and is only joined when the string is read, appending to
+# the newest rope over a list extends the list in place, so building a
+# string up in a loop is linear rather than quadratic.
+
+
+class Rope:
+    __slots__ = ('_parts', '_n', '_len', '_str')
+
+    def __init__(self, parts, n, length):
+        self._parts = parts
+        self._n = n
+        # the length of the joined string, kept so len and truthiness don't join
+        self._len = length
+        self._str = None
+
+    def __str__(self):
+        if self._str is None:
+            self._str = ''.join(self._parts[:self._n])
+        return self._str
+
+    def __len__(self):
+        return self._len
+
+    def __bool__(self):
+        return self._len > 0
+
+    def __repr__(self):
+        return '(Rope {!r})'.format(str(self))
+
+
+def concat(left, right):
+    # left and right are strs or ropes, neither is changed
+    if isinstance(left, Rope):
+        parts, n = left._parts, left._n
+        if len(parts) != n:
+            # another rope already grew this list past left
+            parts = parts[:n]
+    else:
+        parts, n = [left], 1
+    right = str(right)
+    parts.append(right)
+    return Rope(parts, n + 1, len(left) + len(right))
+
+
+def materialize(value):
+    # the python str of a string value
+    return str(value)
@@ -34,8 +34,14 @@ class ScopeMaker(InstrnTreeVisitor):
         self._scopes = []
         return scopes
 
+    def visit_children(self, instrn):
+        # inlined calls in expressions have scopes too
+        for exprn_blk in instrn.exprn_blks:
+            self.visit_blk(exprn_blk)
+        super().visit_children(instrn)
+
     def visit_new_scope(self, name:str, instrns:Block):
-        if not instrns:
+        if instrns.uid is None:
             return
         if len(self._scopes) == 0:
             assert name == 'root'
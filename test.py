@@ -1,8 +1,24 @@
-from exceptions import MixinException
+from exceptions import (ArgumentCountMismatch, ArrayLengthMismatch, CallDepthExceeded, ForeignCodeUnavailable,
+                        IllegalOperation, IndexOutOfRange, MixinException, ReadUninitializedValue, SymbolNotFound,
+                        TypeMismatchException, UnrollLimitExceeded)
 import unittest
+import gc
 import io
+import math
+import os
+import pickle
+import subprocess
 import sys
+import tempfile
+import time
 from compiler import Compiler
+import objects
+import ropes
+from type_system import Class
+from diagnostics import Diagnostics, QUIET
+from lark.exceptions import LarkError
+from benchmarks import runner
+from benchmarks.programs import SHAPES
 
 class Tester(unittest.TestCase):
 
@@ -34,6 +50,18 @@ class Tester(unittest.TestCase):
         return self.extractLocals( capturedOutput.getvalue())
 
 
+    def compileCode_getError(self, fname, src):
+        # what the compiled program writes to stderr, it must stop with an error
+        capturedOutput = io.StringIO()
+        sys.stdout = capturedOutput
+        try:
+            self.compiler.compile_file(fname, src)
+        finally:
+            sys.stdout = sys.__stdout__
+        completed = subprocess.run(['build/a.out'], universal_newlines=True, capture_output=True)
+        self.assertNotEqual(completed.returncode, 0)
+        return completed.stderr
+
     def preprocessLocals(self, locals):
         for sym, val, type_ in locals:
             if type_ == 'float':
@@ -120,6 +148,777 @@ class Tester(unittest.TestCase):
 
 
 
+    def test_recursion(self):
+        self.run_tests('recursion.lang', {
+            ('a', '3628800', 'int'),
+            ('b', '4501500', 'int'),
+        })
+
+    def test_callDepthLimit(self):
+        self.compiler = Compiler(max_call_depth=50)
+        with self.assertRaises(CallDepthExceeded):
+            self.runCode_getLocals('recursion.lang', '''
+                fn forever:int(n:int) {
+                    return forever(n + 1);
+                }
+                fn main:int() {
+                    x:int = forever(0);
+                    plocal;
+                    return 0;
+                }''')
+
+    def test_callSiteCacheInvalidation(self):
+        # the first call of f caches the global g, declaring the nested g
+        # must drop that cache so the second call sees the shadowing symbol
+        with self.assertRaises(ReadUninitializedValue):
+            self.runCode_getLocals('shadow.lang', '''
+                fn g:int() {
+                    return 1;
+                }
+                fn f:int() {
+                    r:int = g();
+                    fn g:int() {
+                        return 2;
+                    }
+                    return r;
+                }
+                fn main:int() {
+                    a:int = f();
+                    b:int = f();
+                    plocal;
+                    return 0;
+                }''')
+
+    def test_callSiteCacheRebinding(self):
+        # assigning another function to a name a call site cached must be
+        # seen by the next call, inlining and memos mustn't hide it either
+        self.assertEqual(self.runCode_getLocals('rebind.lang', '''
+            fn one:int() {
+                return 1;
+            }
+            fn two:int() {
+                return 2;
+            }
+            fn f:int(x:int) {
+                return one() * 10 + x;
+            }
+            fn main:int() {
+                a:int = f(1);
+                one = two;
+                b:int = f(1);
+                plocal;
+                return 0;
+            }'''), {('a', '11', 'int'), ('b', '21', 'int')})
+        self.assertEqual(self.runCode_getLocals('rebind.lang', '''
+            fn one:int() {
+                return 1;
+            }
+            fn two:int() {
+                return 2;
+            }
+            fn main:int() {
+                a:int = 0;
+                i:int = 0;
+                while i < 2 {
+                    a = a * 10 + one();
+                    one = two;
+                    i = i + 1;
+                }
+                plocal;
+                return 0;
+            }'''), {('a', '12', 'int'), ('i', '2', 'int')})
+
+    def test_loops(self):
+        self.run_tests('loops.lang', {
+            ('i', '4', 'int'),
+            ('grid', '210', 'int'),
+            ('k', '4', 'int'),
+            ('calls', '4', 'int'),
+            ('same', '1', 'int'),
+        })
+
+    def test_naturalWhile(self):
+        with tempfile.TemporaryDirectory() as dump_dir:
+            self.compiler = Compiler(Diagnostics(dump_dir=dump_dir, dump_names=('cpp',)))
+            self.compileFile('loops.lang')
+            with open(os.path.join(dump_dir, 'cpp.0.txt')) as cpp:
+                code = cpp.read()
+        self.assertIn('while((i < 4)){', code)
+        # in the copy of triangle inlined into the condition below
+        self.assertRegex(code, r'while\(n_\w+\)\{')
+        # the condition calls a function, so it keeps the general shape
+        self.assertIn('while(1){', code)
+
+    def test_forLoops(self):
+        self.run_tests('for_loops.lang', {
+            ('a', '10', 'int'),
+            ('b', '123', 'int'),
+            ('c', '147', 'int'),
+            ('d', '531', 'int'),
+            ('e', '303', 'int'),
+            ('f', '20', 'int'),
+            ('g', '7', 'int'),
+            ('n', '6', 'int'),
+        })
+
+    def test_forZeroStep(self):
+        src = '''
+            fn main:int() {
+                step:int = 0;
+                for i:int in 0..3..step {
+                }
+                return 0;
+            }'''
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('zero_step.lang', src)
+        self.assertIn('zero step for', self.compileCode_getError('zero_step.lang', src))
+
+    def test_staticConstructs(self):
+        self.run_tests('static.lang', {
+            ('a', '10', 'int'),
+            ('b', '103', 'int'),
+            ('c', '5', 'int'),
+            ('d', '7', 'int'),
+        })
+
+    def test_staticWhile(self):
+        src = '''
+            fn main:int() {
+                n:int = 0;
+                #while n < 3 {
+                    n = n + 1;
+                }
+                plocal;
+                return 0;
+            }'''
+        # the interpreter runs it like a while, the compiler can't know n
+        self.assertEqual(self.runCode_getLocals('static_while.lang', src), {('n', '3', 'int')})
+        with self.assertRaises(MixinException):
+            self.compileCode_getLocals('static_while.lang', src)
+        with self.assertRaises(UnrollLimitExceeded):
+            self.compileCode_getLocals('static_while.lang', '''
+                fn main:int() {
+                    #while 1 {
+                    }
+                    return 0;
+                }''')
+
+    def test_staticForRuntimeBounds(self):
+        src = '''
+            fn main:int() {
+                n:int = 3;
+                s:int = 0;
+                #for i:int in 0..n {
+                    s = s + i;
+                }
+                plocal;
+                return 0;
+            }'''
+        self.assertEqual(self.runCode_getLocals('static_for.lang', src), {('n', '3', 'int'), ('s', '3', 'int')})
+        with self.assertRaises(MixinException):
+            self.compileCode_getLocals('static_for.lang', src)
+
+    def test_arrays(self):
+        self.run_tests('arrays.lang', {
+            ('bumped', '100', 'int'),
+            ('copy', '{1, 6, 7, 8}', 'std::vector<int>'),
+            ('empty', '{}', 'std::vector<float>'),
+            ('first', '5', 'int'),
+            ('fixed', '{0, 7, 0, 14}', 'std::array<int, 4>'),
+            ('last', '8', 'int'),
+            ('lit', '{5, 6, 7, 8}', 'std::vector<int>'),
+            ('m', '0', 'int'),
+            ('n', '4', 'int'),
+            ('sq', '{0, 1, 4, 9, 16}', 'std::vector<int>'),
+            ('sqsum', '51', 'int'),
+            ('sum', '26', 'int'),
+        })
+
+    def test_arrayIndexOutOfRange(self):
+        with self.assertRaises(IndexOutOfRange):
+            self.runCode_getLocals('index.lang', '''
+                fn main:int() {
+                    xs:int[3];
+                    x:int = xs[-1];
+                    plocal;
+                    return 0;
+                }''')
+        src = '''
+            fn main:int() {
+                a:int[] = :int{1, 2, 3};
+                k:int = 5;
+                v:int = a[k];
+                plocal;
+                return 0;
+            }'''
+        with self.assertRaises(IndexOutOfRange):
+            self.runCode_getLocals('index.lang', src)
+        self.assertIn('Index 5 out of range for an array of length 3.', self.compileCode_getError('index.lang', src))
+        self.assertIn('Index -1 out of range for an array of length 3.',
+                      self.compileCode_getError('index.lang', src.replace('k:int = 5', 'k:int = -1')))
+
+    def test_arrayOperators(self):
+        self.run_tests('array_ops.lang', {
+            ('a', '{1, 2, 3, 4}', 'std::vector<int>'),
+            ('b', '{0, 1, 2, 3}', 'std::vector<int>'),
+            ('fixed', '{2147483647, 0, 0}', 'std::array<int, 3>'),
+            ('flipped', '{11, 12, 13, 14}', 'std::vector<int>'),
+            ('halves', '{1, 2, 2, 3}', 'std::vector<int>'),
+            ('less', '{0, 0, 1, 1}', 'std::vector<int>'),
+            ('mixed', '{1.5, 2.5, 3.5, 4.5}', 'std::vector<float>'),
+            ('neg_halves', '{-4, 3, -2}', 'std::vector<int>'),
+            ('neg_quot', '{-4, 3, -2}', 'std::vector<int>'),
+            ('prod', '{0, 1, 4}', 'std::vector<int>'),
+            ('scaled', '{2, 5, 8, 11}', 'std::vector<int>'),
+            ('sum', '{1, 3, 5, 7}', 'std::vector<int>'),
+            ('total', '5', 'int'),
+            ('wrapped', '{-2147483648, 1, 1}', 'std::array<int, 3>'),
+        })
+
+    def test_arrayLengthMismatch(self):
+        src = '''
+            fn main:int() {
+                a:int[] = :int{1, 2};
+                b:int[] = :int{1, 2, 3};
+                c:int[] = a + b;
+                plocal;
+                return 0;
+            }'''
+        with self.assertRaises(ArrayLengthMismatch):
+            self.runCode_getLocals('mismatch.lang', src)
+        self.assertIn('Arrays of length 2 and 3 used together.', self.compileCode_getError('mismatch.lang', src))
+
+    def test_arrayDivideByZero(self):
+        src = '''
+            fn main:int() {
+                a:int[] = :int{4, 5, 6};
+                b:int[] = :int{2, 0, 3};
+                c:int[] = a / b;
+                plocal;
+                return 0;
+            }'''
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('divide.lang', src)
+        self.assertIn('The division by zero operation is illegal', self.compileCode_getError('divide.lang', src))
+        src = src.replace('a / b', 'a / (b[1] * 2)')
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('divide.lang', src)
+        self.assertIn('The division by zero operation is illegal', self.compileCode_getError('divide.lang', src))
+
+    def test_generators(self):
+        self.run_tests('generators.lang', {
+            ('a', '246', 'int'),
+            ('b', '12345', 'int'),
+            ('c', '8', 'int'),
+            ('d', '0', 'int'),
+            ('f', '1.5', 'float'),
+        })
+
+    def test_yieldOutsideIterator(self):
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('yield.lang', '''
+                fn main:int() {
+                    yield 1;
+                    return 0;
+                }''')
+
+    def test_iteratorOutsideFor(self):
+        with self.assertRaises(IllegalOperation):
+            self.compileCode_getLocals('iter.lang', '''
+                it one:int() {
+                    yield 1;
+                }
+                fn main:int() {
+                    x:int = one();
+                    return 0;
+                }''')
+
+    def test_switch(self):
+        self.run_tests('switch.lang', {
+            ('a', '10', 'int'),
+            ('b', '21', 'int'),
+            ('c', '1', 'int'),
+            ('d', '99', 'int'),
+            ('e', '40', 'int'),
+            ('f', '0', 'int'),
+            ('g', '3', 'int'),
+        })
+
+    def test_switchErrors(self):
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('dup.lang', '''
+                fn main:int() {
+                    switch 1 {
+                        case 1 { }
+                        case 1 { }
+                    }
+                    return 0;
+                }''')
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('fallthru.lang', '''
+                fn main:int() {
+                    switch 1 {
+                        case 1 {
+                            fallthru;
+                            x:int = 1;
+                        }
+                    }
+                    return 0;
+                }''')
+
+    def test_foreign(self):
+        self.compiler.register_foreign('norm2', math.hypot)
+        self.compiler.register_foreign('total', sum)
+        self.run_tests('foreign.lang', {
+            ('h', '2.5', 'float'),
+            ('t', '12', 'int'),
+        })
+
+    def test_foreignUnavailable(self):
+        with self.assertRaises(ForeignCodeUnavailable):
+            self.runFile('foreign.lang')
+
+    def test_ropes(self):
+        self.run_tests('ropes.lang', {
+            ('a', '100', 'int'),
+            ('b', '25', 'int'),
+        })
+
+    def test_ropeAppendsLinear(self):
+        def build(n):
+            start = time.perf_counter()
+            s = 'x'
+            for _ in range(n):
+                s = ropes.concat(s, 'ab')
+                self.assertTrue(s)
+            self.assertEqual(len(s), 1 + 2*n)
+            return time.perf_counter() - start
+        # linear appends take about 4 times as long for 4 times as many,
+        # quadratic ones 16 times
+        small = min(build(5000) for _ in range(3))
+        large = min(build(20000) for _ in range(3))
+        self.assertLess(large / small, 8)
+
+    def test_refs(self):
+        self.run_tests('refs.lang', {
+            ('a', '2', 'int'),
+            ('b', '12', 'int'),
+            ('c', '{7, 7, 7}', 'std::vector<int>'),
+            ('d', '14', 'int'),
+            ('e', '{1, 3, 3}', 'std::vector<int>'),
+            ('f', '3', 'int'),
+            ('g', '8', 'int'),
+            ('h', '1.5', 'float'),
+            ('k', '{5, 5}', 'std::vector<int>'),
+            ('n', '3', 'int'),
+            ('p', '{1}', 'Pt'),
+        })
+
+    def test_refErrors(self):
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('temp_ref.lang', '''
+                fn bump:void(x:&int) {
+                    x = x + 1;
+                }
+                fn main:int() {
+                    bump(1);
+                    return 0;
+                }''')
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('local_ref.lang', '''
+                fn main:int() {
+                    x:&int = 1;
+                    return 0;
+                }''')
+
+    def test_classes(self):
+        self.run_tests('classes.lang', {
+            ('bar', '{{5, 0, 3, 7}, 1.5, {0, 3, 0}}', 'Bar'),
+            ('c', '3', 'int'),
+            ('fx', '5', 'int'),
+            ('my_instance', '{100, 101, 3, 7}', 'Foo'),
+            ('s', '211', 'int'),
+            ('y', '100', 'int'),
+        })
+
+    def test_undeclaredClassesDiffer(self):
+        # classes whose contents aren't generated yet have no uid
+        a, b = Class('A', None), Class('B', None)
+        self.assertNotEqual(a, b)
+        self.assertEqual(a, a)
+
+    def test_objects(self):
+        self.run_tests('objects.lang', {
+            ('a', '{1, 0}', 'Point'),
+            ('b', '{2, 0}', 'Point'),
+            ('box', '{{1, 0}, {0, 7}, {3, 0}}', 'Box'),
+            ('copy', '{{9, 0}, {0, 8}, {4, 0}}', 'Box'),
+            ('m', '101', 'int'),
+            ('total', '499500', 'int'),
+        })
+
+    def test_objectsReclaimed(self):
+        def live():
+            # the zeroed object of each class lives as long as the class
+            gc.collect()
+            return sum(isinstance(o, objects.Object) and o is not o.layout.zero for o in gc.get_objects())
+        before = live()
+        with open('test_code/objects.lang') as srcfile:
+            self.runCode_getLocals('objects.lang', srcfile.read())
+        self.assertEqual(live(), before)
+
+    def test_memoizedPureFunctions(self):
+        self.run_tests('memo.lang', {
+            ('a', '75025', 'int'),
+            ('b', '10945', 'int'),
+            ('c', 4.5, 'float'),
+            ('d', '6', 'int'),
+            ('e', '8', 'int'),
+        })
+        with open('test_code/memo.lang') as srcfile:
+            self.runCode_getLocals('memo.lang', srcfile.read())
+        stats = self.compiler.memo_stats()
+        self.assertEqual(set(stats), {'fib', 'sq', 'fib_sum'})
+        # every fib(n) below 26 is worked out once
+        self.assertEqual(stats['fib'], (43, 26))
+        # sq is small enough to be inlined where it is called
+        self.assertEqual(stats['sq'], (0, 0))
+
+    def test_inlining(self):
+        self.run_tests('inline.lang', {
+            ('a', '16', 'int'),
+            ('b', '25', 'int'),
+            ('c', '42', 'int'),
+            ('d', '12', 'int'),
+            ('e', '50', 'int'),
+            ('f', '120', 'int'),
+            ('g', '6', 'int'),
+            ('h', '36', 'int'),
+            ('m', 3.0, 'float'),
+            ('nums', '{1, 2, 3, 6}', 'std::vector<int>'),
+            ('p', '{3, 4}', 'Point'),
+            ('x', '3', 'int'),
+        })
+        # capped reads a global and fact is recursive
+        self.assertEqual(set(self.compiler.inlined), {'sq', 'norm2', 'clamp', 'total', 'mean'})
+
+    def test_inliningProfile(self):
+        with open('test_code/inline.lang') as srcfile:
+            src = srcfile.read()
+        self.compiler = Compiler(count_calls=True)
+        locals = self.runCode_getLocals('inline.lang', src)
+        profile = self.compiler.call_counts
+        # inlined calls count too
+        self.assertEqual(profile['sq'], 12)
+        self.assertEqual(profile['norm2'], 1)
+        self.assertEqual(profile['fact'], 5)
+
+        # functions the profile never saw called are left alone, and mean
+        # still calls total
+        del profile['total']
+        self.compiler = Compiler(inline_profile=profile)
+        self.assertEqual(self.runCode_getLocals('inline.lang', src), locals)
+        self.assertEqual(set(self.compiler.inlined), {'sq', 'norm2', 'clamp'})
+
+    def test_deadCode(self):
+        self.run_tests('dead_code.lang', {
+            ('a', '120', 'int'),
+            ('b', '12', 'int'),
+            ('c', '2', 'int'),
+            ('r', '5', 'int'),
+        })
+        # from_mixin is only named in a string
+        self.assertEqual(set(self.compiler.pruned), {'unused', 'unused_helper'})
+
+        with tempfile.TemporaryDirectory() as dump_dir:
+            self.compiler = Compiler(Diagnostics(dump_dir=dump_dir, dump_names=('cpp',)))
+            self.compileFile('dead_code.lang')
+            with open(os.path.join(dump_dir, 'cpp.0.txt')) as cpp:
+                code = cpp.read()
+        self.assertNotIn('unused', code)
+        self.assertNotIn('scratch', code)
+        self.assertNotIn('twice', code)
+        self.assertNotIn('return 0;\n}\nint main', code)
+
+        # the name the mixin calls is only put together when compiling
+        src = '''
+            fn helper_a:int() {
+                return 42;
+            }
+            fn pick:string(n:int) {
+                s:string = "helper_";
+                return s + "a";
+            }
+            fn main:int() {
+                x:int = mixin(pick(0) + "()");
+                plocal;
+                return 0;
+            }'''
+        self.compiler = Compiler()
+        self.assertEqual(self.compileCode_getLocals('built_mixin.lang', src), {('x', '42', 'int')})
+        self.assertEqual(self.compiler.pruned, [])
+        self.assertEqual(self.runCode_getLocals('built_mixin.lang', src), {('x', '42', 'int')})
+
+    def test_loopOptimizations(self):
+        self.run_tests('loop_opt.lang', {
+            ('g', '198', 'int'),
+            ('h', '60912', 'int'),
+            ('p', '33.0', 'float'),
+            ('q', '12', 'int'),
+            ('r', '60', 'int'),
+            ('s', '25', 'int'),
+        })
+
+        with tempfile.TemporaryDirectory() as dump_dir:
+            self.compiler = Compiler(Diagnostics(dump_dir=dump_dir, dump_names=('cpp',)), inline=False)
+            self.compileFile('loop_opt.lang')
+            with open(os.path.join(dump_dir, 'cpp.0.txt')) as cpp:
+                code = cpp.read()
+        optimized = self.compiler.optimized
+        # two in grid and poly, one in guarded, and (a + b) twice in shared
+        self.assertEqual(len([sym for sym in optimized if sym.startswith('inv')]), 5)
+        self.assertEqual(len([sym for sym in optimized if sym.startswith('cse')]), 2)
+        # w * h - 1 ahead of both loops, y * w ahead of the inner one
+        self.assertRegex(code, r'inv\d = tmp_\d+;\n\s*int tmp_\d+ = h;\n\s*for')
+        self.assertRegex(code, r'int y = for_\d+;\n\s*int inv\d;\n\s*int tmp_\d+ = y \* w;')
+        self.assertIn('while((i < inv', code)
+        # k changes through the reference bump takes, a / b may divide by 0
+        self.assertRegex(code, r'int i = for_\d+;\n\s*int tmp_\d+ = k \* 10;')
+        self.assertRegex(code, r'if\(inv\d\)\{\n\s*int tmp_\d+ = a / b;')
+
+    def test_lowering(self):
+        self.run_tests('lowering.lang', {
+            ('area', '6', 'int'),
+            ('box', '{2, 3}', 'Box'),
+            ('f', '-11.0', 'float'),
+            ('h', '1118', 'int'),
+            ('s', '55', 'int'),
+            ('t', '7', 'int'),
+        })
+        self.assertGreater(self.compiler.lowered, 0)
+
+        with tempfile.TemporaryDirectory() as dump_dir:
+            self.compiler = Compiler(Diagnostics(dump_dir=dump_dir, dump_names=('cpp',)), inline=False)
+            self.compileFile('lowering.lang')
+            with open(os.path.join(dump_dir, 'cpp.0.txt')) as cpp:
+                code = cpp.read()
+        # constants are folded once, for both backends
+        self.assertIn('t = 7;', code)
+        self.assertIn('x * 4.5;', code)
+        self.assertIn('tmp_0 + -20;', code)
+
+    def test_unboxedRegisters(self):
+        # lowered code works on python ints and floats, it has to give what
+        # the RValues the rest of the interpreter uses give
+        src = '''
+            fn ops:int(m:int, big:int, n:int, x:float) {
+                a:int = m * m + 1;
+                b:int = big + n - 2;
+                c:int = (0 - n - 4) / 2;
+                d:float = x * n + n / 4;
+                e:int = (n and x) + (0 or n * 2) + (n > 2) + -big;
+                f:float = -x - n;
+                plocal;
+                return 0;
+            }
+            fn main:int() {
+                r:int = ops(65536, 2147483647, 3, 2.5);
+                return 0;
+            }'''
+        expected = {
+            ('a', '1', 'int'),
+            ('b', '-2147483648', 'int'),
+            ('c', '-4', 'int'),
+            ('d', '7.5', 'float'),
+            ('e', '-2147483638', 'int'),
+            ('f', '-5.5', 'float'),
+            ('m', '65536', 'int'),
+            ('big', '2147483647', 'int'),
+            ('n', '3', 'int'),
+            ('x', '2.5', 'float'),
+        }
+        self.assertEqual(self.runCode_getLocals('unboxed.lang', src), expected)
+        self.assertGreater(self.compiler.lowered, 0)
+        self.compiler = Compiler(lower=False)
+        self.assertEqual(self.runCode_getLocals('unboxed.lang', src), expected)
+
+    def runSnapshot_getLocals(self, snapshot):
+        capturedOutput = io.StringIO()
+        sys.stdout = capturedOutput
+        try:
+            self.compiler.run_snapshot(snapshot)
+        finally:
+            sys.stdout = sys.__stdout__
+        return self.extractLocals(capturedOutput.getvalue())
+
+    def test_snapshot(self):
+        with open('test_code/methods.lang') as srcfile:
+            src = srcfile.read()
+        expected = self.runCode_getLocals('methods.lang', src)
+        snapshot = self.compiler.snapshot('methods.lang', src)
+        self.compiler = Compiler()
+        self.assertEqual(self.runSnapshot_getLocals(snapshot), expected)
+        self.assertNotIn('parse', self.compiler.phase_times)
+
+        # each run starts from the globals as they were, not as main left them
+        snapshot = self.compiler.snapshot('snapshot.lang', '''
+            class Counter {
+                n:int;
+            }
+            total:int = 40;
+            fn main:int() {
+                total = total + 2;
+                c:Counter = Counter();
+                c.n = total;
+                plocal;
+                return 0;
+            }''')
+        for _ in range(2):
+            self.assertEqual(self.runSnapshot_getLocals(snapshot), {('c', '{42}', 'Counter')})
+
+    def test_batchCalls(self):
+        self.compiler.load('batch.lang', '''
+            calls:int = 0;
+            fn scale:float(x:float, k:int) {
+                calls = calls + 1;
+                return x * k;
+            }
+            fn count:int() {
+                return calls;
+            }
+            fn shout:string(s:string) {
+                return s + "!";
+            }
+            fn bump:void(n:int) {
+                calls = calls + n;
+            }
+            fn at:int(i:int) {
+                a:int[] = :int{1, 2};
+                return a[i] + 1;
+            }
+            fn main:int() {
+                return 0;
+            }''')
+        self.assertEqual(self.compiler.call('shout', 'hi'), 'hi!')
+        self.assertIsNone(self.compiler.call('bump', 10))
+        args = [(i / 2, i) for i in range(10)]
+        expected = [i / 2 * i for i in range(10)]
+        self.assertEqual(list(self.compiler.call_many('scale', args)), expected)
+        self.assertEqual(self.compiler.call('count'), 20)
+        self.assertEqual(list(self.compiler.call_many('scale', args, processes=2, chunksize=3)), expected)
+        # the workers had globals of their own
+        self.assertEqual(self.compiler.call('count'), 20)
+        with self.assertRaises(ArgumentCountMismatch):
+            self.compiler.call('scale', 1.0)
+        with self.assertRaises(SymbolNotFound):
+            self.compiler.call('missing')
+        # a failed call leaves nothing on the stack for the calls after it
+        depth = self.compiler.virtual_machine.run_depth()
+        with self.assertRaises(TypeMismatchException):
+            self.compiler.call('scale', 1.0, 'many')
+        with self.assertRaises(IndexOutOfRange):
+            self.compiler.call('at', 5)
+        self.assertEqual(self.compiler.virtual_machine.run_depth(), depth)
+        self.assertEqual(self.compiler.call('count'), 20)
+
+        # checked when call_many is called, not when the results are read
+        with self.assertRaises(SymbolNotFound):
+            self.compiler.call_many('missing', args)
+        self.compiler.register_foreign('scale', lambda x, k: x * k)
+        with self.assertRaises(pickle.PicklingError):
+            self.compiler.call_many('scale', args, processes=2)
+
+    def test_methods(self):
+        self.run_tests('methods.lang', {
+            ('a1', '0', 'int'),
+            ('a2', '9', 'int'),
+            ('a3', '6', 'int'),
+            ('b', '5', 'int'),
+            ('c', '{5, 1}', 'Counter'),
+            ('d1', '91', 'int'),
+            ('d2', '61', 'int'),
+            ('m', '{5, 5}', 'Counter'),
+            ('mn', '5', 'int'),
+            ('n2', '2', 'int'),
+            ('r', '{0, 3, 2}', 'Rect'),
+            ('shape', '{0}', 'Shape'),
+            ('sq', '{4, 3}', 'Square'),
+            ('t', '150', 'int'),
+        })
+
+    def test_megamorphicCall(self):
+        # more classes than a call site caches still dispatch correctly
+        classes = ''.join('class C{0} : B {{ fn v:int(){{ return {0}; }} }}\n'.format(i) for i in range(6))
+        calls = ''.join('c{0}:C{0} = C{0}();\n'.format(i) for i in range(6)) + \
+                ''.join('t = t + get(c{}) + get(c{});\n'.format(i, 5 - i) for i in range(6))
+        src = 'class B { virtual fn v:int(){ return 100; } }\n' + classes + \
+              'fn get:int(b:&B){ return b.v(); }\n' + \
+              'fn main:int(){ t:int = 0;\n' + calls + 'v:int = t; plocal; return 0; }'
+        self.assertIn(('v', '30', 'int'), self.runCode_getLocals('mega.lang', src))
+
+    def test_methodErrors(self):
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('virtual_fn.lang', '''
+                virtual fn f:int() { return 0; }
+                fn main:int() { return 0; }''')
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('static_self.lang', '''
+                class S {
+                    fn f:int() { return 0; }
+                    static fn g:int() { return f(); }
+                }
+                fn main:int() { return 0; }''')
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('override.lang', '''
+                class O { virtual fn f:int() { return 0; } }
+                class P : O { fn f:float() { return 0.5; } }
+                fn main:int() { return 0; }''')
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('no_object.lang', '''
+                class N { fn f:int() { return 0; } }
+                fn main:int() {
+                    x:int = N.f();
+                    return 0;
+                }''')
+        with self.assertRaises(SymbolNotFound):
+            self.compileCode_getLocals('no_method.lang', '''
+                class A { fn f:int() { return 0; } }
+                fn main:int() {
+                    a:A = A();
+                    x:int = a.g();
+                    return 0;
+                }''')
+
+    def test_classErrors(self):
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('ctor_args.lang', '''
+                class A { x:int; }
+                fn main:int() {
+                    a:A = A(1);
+                    return 0;
+                }''')
+        with self.assertRaises(SymbolNotFound):
+            self.compileCode_getLocals('no_field.lang', '''
+                class A { x:int; }
+                fn main:int() {
+                    a:A = A();
+                    y:int = a.y;
+                    return 0;
+                }''')
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('not_obj.lang', '''
+                fn main:int() {
+                    a:int = 1;
+                    y:int = a.y;
+                    return 0;
+                }''')
+        with self.assertRaises(IllegalOperation):
+            self.runCode_getLocals('int_class.lang', '''
+                class int { x:int; }
+                fn main:int() {
+                    return 0;
+                }''')
+
     # def test_big(self):
     #     self.run_tests('big.lang', {
     #         ('a', '-5', 'int'),
@@ -144,4 +943,49 @@ class Tester(unittest.TestCase):
 
     def test_mixinErrors(self):
         with self.assertRaises(MixinException):
-            self.compileFile('mixin_fail.lang')
\ No newline at end of file
+            self.compileFile('mixin_fail.lang')
+
+
+    def test_benchmarkPrograms(self):
+        for shape in SHAPES:
+            result = runner.measure(shape, 4, 'run')
+            self.assertIsNone(result['error'], shape)
+            self.assertIn('main', result['phases'])
+
+    def test_errorRecorded(self):
+        self.compiler = Compiler(Diagnostics(level=QUIET))
+        self.compiler.run_file('basic.lang', 'fn main:int() { x:int = ; }')
+        self.assertIsInstance(self.compiler.error, LarkError)
+        self.compiler.run_file('basic.lang', 'fn main:int() { return 0; }')
+        self.assertIsNone(self.compiler.error)
+
+    def test_quietByDefault(self):
+        with open('test_code/basic.lang') as srcfile:
+            src = srcfile.read()
+        output = io.StringIO()
+        sys.stdout = output
+        try:
+            self.compiler.run_file('basic.lang', src)
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertNotIn('func_blk', output.getvalue())
+        self.assertIn('x ; 100 ; int', output.getvalue())
+
+    def test_quietCompile(self):
+        self.compiler = Compiler(Diagnostics(level=QUIET))
+        output = io.StringIO()
+        sys.stdout = output
+        try:
+            self.compiler.compile_file('basic.lang', 'fn main:int() { x:int = 1; plocal; return 0; }')
+        finally:
+            sys.stdout = sys.__stdout__
+        self.assertNotIn('rtn:', output.getvalue())
+        self.assertIn('x ; 1 ; int', output.getvalue())
+
+    def test_dumpToFile(self):
+        with tempfile.TemporaryDirectory() as dump_dir:
+            self.compiler = Compiler(Diagnostics(dump_dir=dump_dir, dump_names=('cpp', 'ast')))
+            self.compileCode_getLocals('basic.lang', 'fn main:int() { x:int = 1; plocal; return 0; }')
+            self.assertEqual(sorted(os.listdir(dump_dir)), ['ast.0.txt', 'cpp.0.txt'])
+            with open(os.path.join(dump_dir, 'cpp.0.txt')) as cpp:
+                self.assertIn('int main(){', cpp.read())
@@ -1,6 +1,9 @@
 from pampy import match, _
 from fixedint import *
-from exceptions import IllegalOperation, TypeMismatchException, UnrecognizedType
+from exceptions import ArrayLengthMismatch, IllegalOperation, TypeMismatchException, UnrecognizedType
+import arrays
+import objects
+import ropes
 import re
 import codecs
 
@@ -63,12 +66,62 @@ class _Num(Type): pass
 class Int(_Num): pass
 class Float(_Num): pass
 class String(Type): pass
+class Array(Type):
+    def __init__(self, elem, size=None):
+        self.elem = elem
+        # only fixed size arrays carry their size in the type
+        self.size = size
+
+    def __str__(self):
+        return '{}[{}]'.format(self.elem, '' if self.size is None else self.size)
+
+    def __eq__(self, other):
+        return self.__class__ == other.__class__ \
+            and self.elem == other.elem and self.size == other.size
+
+    def __hash__(self):
+        return hash((self.__class__, self.elem, self.size))
+
+class Iterator(Type):
+    # what calling an it function gives, only a for loop can consume it
+    def __init__(self, elem):
+        self.elem = elem
+
+    def __str__(self):
+        return 'it {}'.format(self.elem)
+
+    def __eq__(self, other):
+        return self.__class__ == other.__class__ and self.elem == other.elem
+
+    def __hash__(self):
+        return hash((self.__class__, self.elem))
+
+class Ref(Type):
+    # a reference parameter, const when the function never changes it
+    def __init__(self, target, const=False):
+        self.target = target
+        self.const = const
+
+    def __str__(self):
+        return '{}&{}'.format('const ' if self.const else '', self.target)
+
+    def __eq__(self, other):
+        return self.__class__ == other.__class__ \
+            and self.target == other.target and self.const == other.const
+
+    def __hash__(self):
+        return hash((self.__class__, self.target, self.const))
+
+def strip_ref(type_):
+    # the type a parameter has inside its function
+    return type_.target if isinstance(type_, Ref) else type_
+
 class CustomType(Type):
     def __init__(self, uid):
         self.uid = uid
 
     def __hash__(self):
-        return hash(self.__class__, self.uid)
+        return hash((self.__class__, self.uid))
 
     def __eq__(self, other):
         return self.uid == other.uid and self.__class__ == other.__class__
@@ -80,9 +133,33 @@ class Function(CustomType):
         self.rtnType = rtnType
 
 class Class(CustomType):
-    def __init__(self, name, uid):
+    def __init__(self, name, uid, base=None):
         super().__init__(uid)
         self.name = name
+        # the Class this one derives from
+        self.base = base
+        # the ClassDecl, set once the class has been generated
+        self.decl = None
+
+    def __eq__(self, other):
+        # until its contents are generated a class has no uid, and is only
+        # the same as itself
+        if self.uid is None:
+            return self is other
+        return super().__eq__(other)
+
+    def __hash__(self):
+        # the name, as the uid changes once the contents are generated
+        return hash((self.__class__, self.name))
+
+    def derives(self, other):
+        # whether an object of this class can be taken for an other
+        type_ = self
+        while type_ is not None:
+            if type_ == other:
+                return True
+            type_ = type_.base
+        return False
 
 # class Object(CustomType):
 #     def __init__(self, cls):
@@ -123,18 +200,23 @@ class Neg(_UnaryOp): pass
 
 
 
+_BUILTIN_TYPES = {
+    'int': Int(),
+    'float': Float(),
+    'string': String(),
+    'void': Void(),
+}
+
 class _TypeSystem:
 
     def __init__(self):
-        self.types_ = {
-            'int': Int(),
-            'float': Float(),
-            'string': String(),
-            'void': Void(),
-        }
-
-    def reg_new_type(self, str_rep, type_):
-        assert str_rep not in self.types_
+        self.types_ = dict(_BUILTIN_TYPES)
+
+    def reg_new_type(self, str_rep, type_, pos):
+        # the registry outlives a compile, so a class seen again replaces its
+        # earlier self, only the builtin types are off limits
+        if str_rep in _BUILTIN_TYPES:
+            raise IllegalOperation('redefining {}'.format(str_rep), pos)
         self.types_[str_rep] = type_
 
 
@@ -154,11 +236,76 @@ class _TypeSystem:
 
 
 
+    def make_array_type(self, elem, size, pos):
+        if not isinstance(elem, _Num):
+            raise UnrecognizedType('{}[]'.format(elem), pos)
+        return Array(elem, size)
+
+    def _array_kind(self, type_):
+        return match(type_.elem, Int, arrays.INT,
+                                 Float, arrays.FLOAT)
+
+    def make_array(self, type_, values):
+        # values are already converted to the element type
+        return arrays.new(self._array_kind(type_), [self._array_item(v, type_.elem) for v in values])
+
+    def zero_array(self, type_, n):
+        return arrays.zeros(self._array_kind(type_), n)
+
+    def zero_value(self, type_):
+        # what a field starts out as when nothing initializes it, as C++
+        # value initialization leaves it
+        return match(type_,
+            Int,    lambda _: MutableInt32(0),
+            Float,  lambda _: 0.0,
+            String, lambda _: '',
+            Array,  lambda t: self.zero_array(t, t.size or 0)
+        )
+
+    def class_layout(self, fields):
+        # fields are the typed syms of a class's fields, in declaration order
+        types = [f.type for f in fields]
+        zero = [t.decl.layout.zero if isinstance(t, Class) else self.zero_value(t) for t in types]
+        return objects.ClassLayout([f.sym for f in fields], types, zero,
+                                   [i for i, t in enumerate(types) if isinstance(t, Array)],
+                                   [i for i, t in enumerate(types) if isinstance(t, Class)])
+
+    def _array_item(self, value, elem_type):
+        return int(value) if isinstance(elem_type, Int) else float(value)
+
+    def _elem_value(self, value, elem_type):
+        return MutableInt32(value) if isinstance(elem_type, Int) else value
+
+    def array_load(self, buf, i, elem_type):
+        return self._elem_value(arrays.get(buf, i), elem_type)
+
+    def array_store(self, buf, i, value, elem_type):
+        arrays.put(buf, i, self._array_item(value, elem_type))
+
+    def to_python(self, value, type_):
+        # a value as handed to a python foreign implementation
+        return match(strip_ref(type_), Int,    lambda _: int(value),
+                                       String, lambda _: ropes.materialize(value),
+                                       _,      lambda _: value)
+
+    def from_python(self, value, type_):
+        return match(type_,
+            Int,    lambda _: MutableInt32(int(value)),
+            Float,  lambda _: float(value),
+            String, lambda _: str(value),
+            Array,  lambda t: self.make_array(t, list(value)),
+            Void,   lambda _: None
+        )
+
     def value_cpp_repr(self, value, type_) :
         s = match(type_,
             Int,  lambda _ : str(int(value)),
             _Num, lambda _ : str(value),
-            String, lambda _:'"' + _encode_escapes(value) + '"'
+            String, lambda _:'"' + _encode_escapes(ropes.materialize(value)) + '"',
+            Array, lambda t: '{' + ', '.join(self.value_cpp_repr(v, t.elem)
+                                             for v in arrays.to_list(value)) + '}',
+            Class, lambda _: '{' + ', '.join(self.value_cpp_repr(v, t)
+                                             for v, t in zip(value.slots, value.layout.types)) + '}'
         )
         return s
 
@@ -168,6 +315,10 @@ class _TypeSystem:
             Float, 'float',
             String, 'std::string',
             Void, 'void',
+            Array, lambda t: 'std::vector<{}>'.format(self.type_cpp_repr(t.elem)) if t.size is None
+                        else 'std::array<{}, {}>'.format(self.type_cpp_repr(t.elem), t.size),
+            Ref, lambda t: ('const {}&' if t.const else '{}&').format(self.type_cpp_repr(t.target)),
+            Class, lambda t: t.name,
             _, "no_repr"
         )
 
@@ -178,7 +329,7 @@ class _TypeSystem:
                     Mul,  '*',
                     Div,  '/',
                     Neg,  '-',
-                    Eq,   '=',
+                    Eq,   '==',
                     NotEq,'!=',
                     Gt,   '>',
                     GtEq, '>=',
@@ -195,6 +346,9 @@ class _TypeSystem:
                             (_Num, _Num),       True,
                             (String, String),   True,
                             (Void, Void),       True,
+                            # a fixed size array can go where any size is allowed
+                            (Array, Array),     lambda l_type, r_type: l_type.elem == r_type.elem and
+                                                    l_type.size in (None, r_type.size),
                             (_,_),              lambda l_type, r_type: l_type == r_type):
             raise TypeMismatchException(l_type, r_type, pos)
 
@@ -206,6 +360,9 @@ class _TypeSystem:
         return match( (l_type, r_type),
                 (Int, _Num),    lambda a,b: r_value // 1,
                 (Float, _Num),  lambda a,b: float(r_value),
+                # arrays and objects are values, assigning one copies it
+                (Array, Array), lambda a,b: arrays.copy(r_value),
+                (Class, Class), lambda a,b: objects.copy(r_value),
                 (_, _),         lambda a,b: r_value
         )
 
@@ -214,6 +371,7 @@ class _TypeSystem:
     def _unary_op_valid(self, op, type_):
         return match(op,
                     Neg, lambda _: match(type_, _Num, True,
+                                                Array, lambda t: isinstance(t.elem, _Num),
                                                 _,   False),
                     _, False)
 
@@ -239,7 +397,21 @@ class _TypeSystem:
                 Neg, lambda _: type_)
 
 
+    def _array_op_res_type(self, op, l_type, r_type, pos):
+        l_elem = l_type.elem if isinstance(l_type, Array) else l_type
+        r_elem = r_type.elem if isinstance(r_type, Array) else r_type
+        if not isinstance(l_elem, _Num) or not isinstance(r_elem, _Num):
+            raise TypeMismatchException(l_type, r_type, pos)
+        sizes = {t.size for t in (l_type, r_type) if isinstance(t, Array) and t.size is not None}
+        if len(sizes) > 1:
+            raise TypeMismatchException(l_type, r_type, pos)
+        size = sizes.pop() if sizes else None
+        return Array(self.op_res_type(op, l_elem, r_elem, pos), size)
+
     def op_res_type(self, op, l_type, r_type, pos):
+        if isinstance(l_type, Array) or isinstance(r_type, Array):
+            return self._array_op_res_type(op, l_type, r_type, pos)
+
         ARITHMETIC = Union[Add, Sub, Mul, Div]
         COMPARE = Union[Eq, NotEq, Gt, GtEq, Lt, LtEq]
         BOOLEAN = Union[And, Or]
@@ -259,14 +431,74 @@ class _TypeSystem:
 
 
     def unary_op_res(self, op, value, type_, pos):
+        if isinstance(type_, Array):
+            neg = lambda v: self._array_item(-self._elem_value(v, type_.elem), type_.elem)
+            return arrays.apply(self._ufunc_name(op, type_), neg, self._array_kind(type_), value)
         res = match (op,
                         Neg, lambda _: -value)
         return res
 
+    def _ufunc_name(self, op, res_type):
+        return match(op,
+                    Add,   'add',
+                    Sub,   'subtract',
+                    Mul,   'multiply',
+                    Div,   lambda _: 'floor_divide' if isinstance(res_type.elem, Int) else 'true_divide',
+                    Neg,   'negative',
+                    Eq,    'equal',
+                    NotEq, 'not_equal',
+                    Gt,    'greater',
+                    GtEq,  'greater_equal',
+                    Lt,    'less',
+                    LtEq,  'less_equal',
+                    And,   'logical_and',
+                    Or,    'logical_or',
+        )
+
+    def _array_op_res(self, op, l_value, l_type, r_value, r_type, pos):
+        # element wise, with the same results op_res gives element by element
+        res_type = self.op_res_type(op, l_type, r_type, pos)
+        operands = []
+        elem_types = []
+        for value, type_ in ((l_value, l_type), (r_value, r_type)):
+            if isinstance(type_, Array):
+                elem_types.append(type_.elem)
+            else:
+                value = self._array_item(value, type_)
+                elem_types.append(type_)
+            operands.append(value)
+
+        lengths = {len(v) for v, t in ((l_value, l_type), (r_value, r_type)) if isinstance(t, Array)}
+        if len(lengths) > 1:
+            raise ArrayLengthMismatch(*sorted(lengths), pos)
+        if isinstance(op, Div):
+            divisor = operands[1]
+            zero = arrays.any_zero(divisor) if isinstance(r_type, Array) else not divisor
+            if zero:
+                raise IllegalOperation('division by zero', pos)
+
+        l_elem, r_elem = elem_types
+        def op_elem(a, b):
+            res = self.op_res(op, self._elem_value(a, l_elem), l_elem,
+                                  self._elem_value(b, r_elem), r_elem, pos)
+            return self._array_item(res, res_type.elem)
+
+        return arrays.apply(self._ufunc_name(op, res_type), op_elem,
+                            self._array_kind(res_type), *operands)
+
     def op_res(self, op, l_value, l_type, r_value, r_type, pos):
+        if isinstance(l_type, Array) or isinstance(r_type, Array):
+            return self._array_op_res(op, l_value, l_type, r_value, r_type, pos)
 
 
         res_type = self.op_res_type(op, l_type, r_type, pos)
+        if isinstance(res_type, String):
+            # only Add is valid on strings
+            return ropes.concat(l_value, r_value)
+        if isinstance(l_type, Float) or isinstance(r_type, Float):
+            # fixedint would truncate the float instead
+            l_value = float(l_value)
+            r_value = float(r_value)
         res = match (op,
                     Add,   lambda _: l_value + r_value,
                     Sub,   lambda _: l_value - r_value,
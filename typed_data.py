@@ -1,6 +1,7 @@
 from type_system import typeSystem
 import type_system as type_sys
 import context
+from exceptions import ReadUninitializedValue
 
 class _Typed:
     @property
@@ -8,7 +9,7 @@ class _Typed:
         return typeSystem.type_cpp_repr(self.type)
 
     def checkCanAssignTo(self, type_,  pos):
-        typeSystem.check_assign_okay(self.type, type_, pos)
+        typeSystem.check_assign_okay(type_, self.type, pos)
 
     def checkAssignOkay(self, other, pos):
         typeSystem.check_assign_okay(self.type, other.type, pos)
@@ -19,11 +20,17 @@ class _Typed:
 def typeFromString(string, pos):
     return typeSystem.make_type(string, pos)
 
-def regNewType(strRep, type_):
-    return typeSystem.reg_new_type(strRep, type_)
+def regNewType(strRep, type_, pos):
+    return typeSystem.reg_new_type(strRep, type_, pos)
+
+def arrayType(elem, size, pos):
+    return typeSystem.make_array_type(elem, size, pos)
 
 
 class RValue(_Typed):
+    # true for values that stand in for a variable elsewhere
+    aliases = False
+
     def __init__(self, value, type):
         self.type = type
         self._value = value
@@ -97,7 +104,7 @@ class LValue(_Typed):
 
     def rvalue(self, ctx, pos):
         rvalue = ctx.read_from_scope(self.sym, self.scope_uid, context.VALUE, pos)
-        return rvalue
+        return rvalue.rvalue(ctx, pos)
 
     def value(self, ctx, pos):
         return self.rvalue(ctx, pos).value()
@@ -122,6 +129,103 @@ class LValue(_Typed):
         return self.sym
 
 
+class ElemLValue(LValue):
+    # an element of an array buffer, checked to be in range
+    def __init__(self, buf, index, type_):
+        self.buf = buf
+        self.index = index
+        self.type = type_
+
+    def assign(self, t_value, ctx, pos):
+        rvalue = t_value.rvalue(ctx, pos)
+        value = typeSystem.assign(self.type, rvalue.type, rvalue.value(), pos)
+        typeSystem.array_store(self.buf, self.index, value, self.type)
+
+    def rvalue(self, ctx, pos):
+        return RValue(typeSystem.array_load(self.buf, self.index, self.type), self.type)
+
+
+class FieldLValue(LValue):
+    # a field of an object, by its offset in the object's slots
+    def __init__(self, obj, offset, type_):
+        self.obj = obj
+        self.offset = offset
+        self.type = type_
+
+    def assign(self, t_value, ctx, pos):
+        rvalue = t_value.rvalue(ctx, pos)
+        self.obj.slots[self.offset] = typeSystem.assign(self.type, rvalue.type, rvalue.value(), pos)
+
+    def rvalue(self, ctx, pos):
+        return RValue(self.obj.slots[self.offset], self.type)
+
+
+class FieldValues:
+    # stands in for the values of a class's scope while code runs for one
+    # object, the fields are read from and written to its slots
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __getitem__(self, sym):
+        layout = self.obj.layout
+        i = layout.offsets[sym]
+        return RValue(self.obj.slots[i], layout.types[i])
+
+    def get(self, sym, default=None):
+        return self[sym] if sym in self.obj.layout.offsets else default
+
+    def __setitem__(self, sym, value):
+        self.obj.slots[self.obj.layout.offsets[sym]] = value.value()
+
+    def __contains__(self, sym):
+        return sym in self.obj.layout.offsets
+
+    def items(self):
+        return [(sym, self[sym]) for sym in self.obj.layout.syms]
+
+
+class VarSlot(LValue):
+    # a variable of one activation, found once so it outlives scope lookups
+    def __init__(self, values, sym, type_):
+        self.values = values
+        self.sym = sym
+        self.type = type_
+
+    def assign(self, t_value, ctx, pos):
+        rvalue = t_value.rvalue(ctx, pos)
+        value = typeSystem.assign(self.type, rvalue.type, rvalue.value(), pos)
+        if ctx is not None:
+            ctx.rebound(self.sym)
+        self.values[self.sym] = RValue(value, self.type)
+
+    def rvalue(self, ctx, pos):
+        try:
+            return self.values[self.sym]
+        except KeyError:
+            raise ReadUninitializedValue(self.sym, pos)
+
+
+class RefSlot(RValue):
+    # the value of a reference parameter, reads and writes go through to the
+    # VarSlot or ElemLValue it was bound to
+    aliases = True
+
+    def __init__(self, target):
+        self.target = target
+        self.type = target.type
+
+    @property
+    def _value(self):
+        return self.target.rvalue(None, None).value()
+
+    def rvalue(self, ctx, pos):
+        # a copy, so storing it elsewhere doesn't alias
+        return self.target.rvalue(ctx, pos)
+
+    def store(self, value, pos):
+        self.target.assign(value, None, pos)
+
+
 class TFrag(_Typed):
     def __init__(self, fragment, type):
         self.fragment = fragment
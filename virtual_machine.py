@@ -20,8 +20,14 @@ class VirtualMachine:
     def run_pop(self):
         return self._run_stack.pop()
 
-    def run_peek(self):
-        return self._run_stack[-1]
+    def run_peek(self, depth=1):
+        return self._run_stack[-depth]
+
+    def run_depth(self):
+        return len(self._run_stack)
+
+    def run_truncate(self, depth):
+        del self._run_stack[depth:]
 
     def __str__(self):
         s =  'VM:\n\tRunStack' + str(self._run_stack) \